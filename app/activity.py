@@ -0,0 +1,253 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, DateTimeField, F, IntegerField, Max, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest, Substr, TruncDate
+from django.utils import timezone
+
+from . import archive
+from .models import ActivityStats, ArchivedSegment, Chat, DailyActivity, Message
+
+# Characters of the newest message kept on its chat for the chat list (Chat.last_message_preview).
+PREVIEW_CHARS = 200
+# Days shown by the parent dashboard: the default, and the most `?days=` may ask for.
+DEFAULT_DAYS = 14
+MAX_DAYS = 90
+
+
+def chat_owners(messages):
+    """`{chat_id: user_id}` for the chats of `messages`; queries only for chats not loaded yet."""
+    owners = {message.chat_id: message.chat.user_id for message in messages if Message.chat.is_cached(message)}
+    missing = {message.chat_id for message in messages} - owners.keys()
+    if missing:
+        owners.update(Chat.objects.filter(id__in=missing).values_list("id", "user_id"))
+    return owners
+
+
+def tally(messages):
+    """
+    Groups messages by the owner of their chat:
+    `({user_id: [sent, ai_replies, last_sent_at]}, {(user_id, date): [sent, ai_replies]})`.
+    """
+    owners = chat_owners(messages)
+    totals = defaultdict(lambda: [0, 0, None])
+    days = defaultdict(lambda: [0, 0])
+    for message in messages:
+        user_id = owners.get(message.chat_id)
+        if user_id is None:
+            continue
+        column = 1 if message.ai else 0
+        totals[user_id][column] += 1
+        days[user_id, timezone.localdate(message.timestamp)][column] += 1
+        if not message.ai and (totals[user_id][2] is None or message.timestamp > totals[user_id][2]):
+            totals[user_id][2] = message.timestamp
+    return totals, days
+
+
+def add(model, lookup, sent, ai_replies, last_active_at=None):
+    """Adds to the counters of the `model` row matching `lookup`, creating it when missing."""
+    changes = {"messages": F("messages") + sent, "ai_replies": F("ai_replies") + ai_replies}
+    if last_active_at is not None:
+        value = Value(last_active_at, output_field=DateTimeField())
+        changes["last_active_at"] = Greatest(Coalesce("last_active_at", value), value)
+    if model.objects.filter(**lookup).update(**changes):
+        return
+    extra = {"last_active_at": last_active_at} if last_active_at is not None else {}
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, messages=sent, ai_replies=ai_replies, **extra)
+    except IntegrityError:
+        # Created by a concurrent request in the meantime.
+        model.objects.filter(**lookup).update(**changes)
+
+
+def subtract(model, lookup, sent, ai_replies):
+    model.objects.filter(**lookup).update(
+        messages=Greatest(F("messages") - sent, Value(0)),
+        ai_replies=Greatest(F("ai_replies") - ai_replies, Value(0)),
+    )
+
+
+def newest_by_chat(messages):
+    """`{chat_id: (message count, newest message)}`."""
+    chats = {}
+    for message in messages:
+        count, newest = chats.get(message.chat_id, (0, None))
+        if newest is None or (message.timestamp, message.pk or 0) >= (newest.timestamp, newest.pk or 0):
+            newest = message
+        chats[message.chat_id] = (count + 1, newest)
+    return chats
+
+
+def latest_messages():
+    return Message.objects.filter(chat=OuterRef("pk")).order_by("-timestamp", "-id")
+
+
+def record_messages(messages):
+    """
+    Adds newly saved `messages` to their chats (count, preview, last activity) and to
+    their chat owners' stats: one UPDATE per chat, owner and day, never a COUNT.
+    Called by the Message post_save receiver, and by bulk_create callers, which send
+    no signals.
+    """
+    for chat_id, (count, newest) in newest_by_chat(messages).items():
+        # Older messages (an imported history) count, but do not replace the preview.
+        is_newest = Q(message_count=0) | Q(last_activity_at__lte=newest.timestamp)
+        Chat.objects.filter(pk=chat_id).update(
+            message_count=F("message_count") + count,
+            last_message_preview=Case(
+                When(is_newest, then=Value(newest.content[:PREVIEW_CHARS])), default=F("last_message_preview")
+            ),
+            last_activity_at=Case(When(is_newest, then=Value(newest.timestamp)), default=F("last_activity_at")),
+        )
+    totals, days = tally(messages)
+    for (user_id, date), (sent, ai_replies) in days.items():
+        add(DailyActivity, {"user_id": user_id, "date": date}, sent, ai_replies)
+    for user_id, (sent, ai_replies, last_sent_at) in totals.items():
+        add(ActivityStats, {"user_id": user_id}, sent, ai_replies, last_sent_at)
+
+
+def forget_messages(messages):
+    """
+    Takes deleted `messages` out of the stats. Their chats get the preview and time
+    of the newest message left; the owners' last-active time is kept.
+    """
+    latest = latest_messages()
+    for chat_id, (count, _) in newest_by_chat(messages).items():
+        Chat.objects.filter(pk=chat_id).update(
+            message_count=Greatest(F("message_count") - count, Value(0)),
+            last_message_preview=Coalesce(Substr(Subquery(latest.values("content")[:1]), 1, PREVIEW_CHARS), Value("")),
+            last_activity_at=Coalesce(Subquery(latest.values("timestamp")[:1]), F("created_at")),
+        )
+    totals, days = tally(messages)
+    for (user_id, date), (sent, ai_replies) in days.items():
+        subtract(DailyActivity, {"user_id": user_id, "date": date}, sent, ai_replies)
+    for user_id, (sent, ai_replies, _) in totals.items():
+        subtract(ActivityStats, {"user_id": user_id}, sent, ai_replies)
+
+
+def forget_chat(chat):
+    """
+    Takes every message of `chat`, archived ones included, out of its owner's stats
+    before the chat is deleted: one GROUP BY, then one UPDATE per table, however many
+    messages go with it (their own post_delete receivers skip cascaded deletes).
+    """
+    days = defaultdict(lambda: [0, 0])
+    rows = Message.objects.filter(chat=chat).order_by().values("ai").annotate(day=TruncDate("timestamp"), count=Count("id"))
+    for row in rows:
+        days[row["day"]][1 if row["ai"] else 0] += row["count"]
+    for data in chat.archived_segments.values_list("data", flat=True):
+        for _, _, ai, _, _, timestamp in archive.decode(data):
+            days[timezone.localdate(timestamp)][1 if ai else 0] += 1
+    if not days:
+        return
+
+    def per_day(column):
+        whens = [When(date=date, then=Value(counts[column])) for date, counts in days.items()]
+        return Case(*whens, default=Value(0), output_field=IntegerField())
+
+    DailyActivity.objects.filter(user_id=chat.user_id, date__in=list(days)).update(
+        messages=Greatest(F("messages") - per_day(0), Value(0)),
+        ai_replies=Greatest(F("ai_replies") - per_day(1), Value(0)),
+    )
+    subtract(
+        ActivityStats, {"user_id": chat.user_id},
+        sum(sent for sent, _ in days.values()), sum(ai_replies for _, ai_replies in days.values()),
+    )
+
+
+def rebuild_chats(chats):
+    """
+    Recomputes the count, preview and last activity of `chats` from their messages,
+    in one UPDATE. Archived chats keep the values they had when they were archived.
+    """
+    latest = latest_messages()
+    counts = Message.objects.filter(chat=OuterRef("pk")).order_by().values("chat").annotate(count=Count("id"))
+    return chats.filter(archived_up_to=0).update(
+        message_count=Coalesce(Subquery(counts.values("count"), output_field=IntegerField()), Value(0)),
+        last_message_preview=Coalesce(Substr(Subquery(latest.values("content")[:1]), 1, PREVIEW_CHARS), Value("")),
+        last_activity_at=Coalesce(Subquery(latest.values("timestamp")[:1]), F("created_at")),
+    )
+
+
+def rebuild(messages, batch_size=2000):
+    """
+    Recomputes all user stats from the `messages` queryset with two GROUP BY queries,
+    plus the archived messages, and returns the number of users with activity.
+    """
+    grouped = messages.order_by().values("chat__user_id", "ai")
+
+    totals = defaultdict(lambda: [0, 0, None])
+    for row in grouped.annotate(count=Count("id"), last=Max("timestamp")):
+        user = totals[row["chat__user_id"]]
+        user[1 if row["ai"] else 0] = row["count"]
+        if not row["ai"]:
+            user[2] = row["last"]
+    days = defaultdict(lambda: [0, 0])
+    for row in grouped.annotate(day=TruncDate("timestamp"), count=Count("id")):
+        days[row["chat__user_id"], row["day"]][1 if row["ai"] else 0] = row["count"]
+
+    # Archived messages (app/archive.py) still count.
+    for user_id, data in ArchivedSegment.objects.values_list("chat__user_id", "data").iterator(chunk_size=100):
+        for _, _, ai, _, _, timestamp in archive.decode(data):
+            totals[user_id][1 if ai else 0] += 1
+            days[user_id, timezone.localdate(timestamp)][1 if ai else 0] += 1
+            if not ai and (totals[user_id][2] is None or timestamp > totals[user_id][2]):
+                totals[user_id][2] = timestamp
+
+    with transaction.atomic():
+        ActivityStats.objects.all().delete()
+        DailyActivity.objects.all().delete()
+        ActivityStats.objects.bulk_create(
+            (
+                ActivityStats(user_id=user_id, messages=sent, ai_replies=ai_replies, last_active_at=last)
+                for user_id, (sent, ai_replies, last) in totals.items()
+            ),
+            batch_size=batch_size,
+        )
+        DailyActivity.objects.bulk_create(
+            (
+                DailyActivity(user_id=user_id, date=date, messages=sent, ai_replies=ai_replies)
+                for (user_id, date), (sent, ai_replies) in days.items()
+            ),
+            batch_size=batch_size,
+        )
+    return len(totals)
+
+
+def dashboard(children, days):
+    """
+    Activity of `children` (users, with `activity` selected) for a parent: totals plus
+    one entry per day for the last `days` days, oldest first. Reads one stats row per
+    child and per active day, so the cost does not grow with the number of messages.
+    """
+    today = timezone.localdate()
+    first_day = today - timedelta(days=days - 1)
+    series = defaultdict(dict)
+    rows = DailyActivity.objects.filter(user__in=children, date__gte=first_day).values_list(
+        "user_id", "date", "messages", "ai_replies"
+    )
+    for user_id, date, sent, ai_replies in rows:
+        series[user_id][date] = (sent, ai_replies)
+
+    dates = [first_day + timedelta(days=n) for n in range(days)]
+    result = []
+    for child in children:
+        try:
+            stats = child.activity
+        except ActivityStats.DoesNotExist:
+            stats = ActivityStats(user=child)
+        daily = series[child.pk]
+        result.append({
+            "id": child.pk,
+            "username": child.username,
+            "messages": stats.messages,
+            "ai_replies": stats.ai_replies,
+            "last_active_at": stats.last_active_at,
+            "daily": [
+                {"date": date, "messages": daily.get(date, (0, 0))[0], "ai_replies": daily.get(date, (0, 0))[1]}
+                for date in dates
+            ],
+        })
+    return result
@@ -0,0 +1,263 @@
+import heapq
+import json
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.db.models import Q
+
+from . import metrics
+from .models import ArchivedSegment, Chat, Message, ReplyJob
+
+COMPRESSION_LEVEL = 9  # segments are written once and read rarely
+
+# Decoded segments by id, least recently used first. Segment ids are never reused,
+# so entries of segments restored or deleted since are just never asked for again.
+_segments = OrderedDict()
+_lock = threading.Lock()
+
+
+def encode(rows):
+    """Compresses `(id, user_id, ai, image, content, timestamp)` rows into a segment blob."""
+    raw = json.dumps(
+        [[pk, user_id, ai, image, content, timestamp.isoformat()] for pk, user_id, ai, image, content, timestamp in rows],
+        ensure_ascii=False, separators=(",", ":"),
+    ).encode()
+    return raw, zlib.compress(raw, COMPRESSION_LEVEL)
+
+
+def decode(data):
+    return [
+        (pk, user_id, ai, image, content, datetime.fromisoformat(timestamp))
+        for pk, user_id, ai, image, content, timestamp in json.loads(zlib.decompress(data))
+    ]
+
+
+def read_segment(segment_id, using="default"):
+    """The decoded rows of a segment, read from the database without the LRU."""
+    start = time.perf_counter()
+    rows = decode(ArchivedSegment.objects.using(using).values_list("data", flat=True).get(pk=segment_id))
+    metrics.ARCHIVE_DECODE_SECONDS.observe(time.perf_counter() - start)
+    return rows
+
+
+def load_segment(segment_id, using="default"):
+    """The decoded rows of a segment, from the in-process LRU or the database."""
+    with _lock:
+        rows = _segments.get(segment_id)
+        if rows is not None:
+            _segments.move_to_end(segment_id)
+    if rows is not None:
+        metrics.CACHE_LOOKUPS.inc("archive_segments", "hit")
+        return rows
+    metrics.CACHE_LOOKUPS.inc("archive_segments", "miss")
+    rows = read_segment(segment_id, using)
+    with _lock:
+        _segments[segment_id] = rows
+        while len(_segments) > settings.ARCHIVE_CACHE_SEGMENTS:
+            _segments.popitem(last=False)
+    return rows
+
+
+def clear_cache():
+    with _lock:
+        _segments.clear()
+
+
+def to_message(chat_id, row):
+    pk, user_id, ai, image, content, timestamp = row
+    return Message(pk=pk, chat_id=chat_id, user_id=user_id, ai=ai, image=image, content=content, timestamp=timestamp)
+
+
+def segment_messages(segment):
+    """Unsaved Message instances for the rows of `segment`."""
+    return [to_message(segment.chat_id, row) for row in decode(segment.data)]
+
+
+# --------------------------------------------------------------------------------
+# ARCHIVING AND RESTORING
+# --------------------------------------------------------------------------------
+def archivable_chats(inactive_since):
+    """Chats without activity since `inactive_since` that still have messages in the Message table."""
+    busy = ReplyJob.objects.filter(status__in=[ReplyJob.PENDING, ReplyJob.RUNNING]).values("message__chat_id")
+    return (
+        Chat.objects.filter(last_activity_at__lt=inactive_since, messages__isnull=False)
+        .exclude(pk__in=busy).distinct().order_by("pk")
+    )
+
+
+def archive_chat(chat, segment_size=None):
+    """
+    Moves every message of `chat` into segments of `segment_size` messages and returns
+    `(messages, segments, raw bytes, compressed bytes)`. The messages leave the table
+    without post_delete signals: to clients, the stats, the sync log and the search
+    index they still exist.
+    """
+    segment_size = segment_size or settings.ARCHIVE_SEGMENT_SIZE
+    messages = Message.objects.filter(chat=chat).order_by("id")
+    fields = ("id", "user_id", "ai", "image", "content", "timestamp")
+    totals = [0, 0, 0, 0]
+    with transaction.atomic():
+        last_id = 0
+        while batch := list(messages.filter(id__gt=last_id).values_list(*fields)[:segment_size]):
+            ids = [row[0] for row in batch]
+            last_id = ids[-1]
+            raw, data = encode(batch)
+            timestamps = [row[5] for row in batch]
+            ArchivedSegment.objects.create(
+                chat=chat, first_id=ids[0], last_id=ids[-1], first_at=min(timestamps), last_at=max(timestamps), count=len(batch),
+                raw_bytes=len(raw), compressed_bytes=len(data), data=data,
+            )
+            # Finished jobs only; chats with pending jobs are not archived.
+            ReplyJob.objects.filter(message_id__in=ids).delete()
+            with connections[Message.objects.db].cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {Message._meta.db_table} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids
+                )
+            for n, value in enumerate((len(batch), 1, len(raw), len(data))):
+                totals[n] += value
+        if last_id:
+            chat.archived_up_to = max(chat.archived_up_to, last_id)
+            Chat.objects.filter(pk=chat.pk).update(archived_up_to=chat.archived_up_to)
+    return tuple(totals)
+
+
+def restore(chat):
+    """
+    Moves the archived messages of `chat` back into the Message table, with their
+    ids, before the chat gets new replies. Called by `build_context`, so a chat that
+    comes back after months is answered with its full history.
+    """
+    with transaction.atomic():
+        # Only one request restores a chat; the others find it done.
+        if not Chat.objects.filter(pk=chat.pk, archived_up_to__gt=0).update(archived_up_to=0):
+            chat.archived_up_to = 0
+            return 0
+        chat.archived_up_to = 0
+        segments = chat.archived_segments.order_by("first_id")
+        messages = [message for segment in segments for message in segment_messages(segment)]
+        # Still in the search index, which keeps archived messages.
+        Message.objects.bulk_create(messages, batch_size=1000)
+        chat.archived_segments.all().delete()
+    return len(messages)
+
+
+# --------------------------------------------------------------------------------
+# READS
+# --------------------------------------------------------------------------------
+class ArchivedMessages:
+    """
+    Messages newest first, as MessageCursorPagination pages them: the segments of the
+    archived chats `chat_ids` merged with the `hot` queryset (the Message rows listed,
+    such as those imported since). A page decodes only the segments whose time range
+    reaches it, so it costs the same on the first page as on the last.
+    """
+
+    def __init__(self, chat_ids, hot, using="default"):
+        self.chat_ids = chat_ids
+        self.hot = hot
+        self.using = using
+
+    def window(self, edge, reverse, limit):
+        """
+        Up to `limit` messages older than `edge`, a `(timestamp, id)` or None for the
+        newest, newest first; or with `reverse`, the ones newer than it, oldest first.
+        Users are attached in one query, so the page serializes without further queries.
+        """
+        segments = ArchivedSegment.objects.using(self.using).filter(chat_id__in=self.chat_ids)
+        hot = self.hot
+        if reverse:
+            segments = segments.filter(last_at__gte=edge[0]).order_by("first_at")
+            hot = hot.filter(Q(timestamp__gt=edge[0]) | Q(timestamp=edge[0], pk__gt=edge[1])).order_by("timestamp", "id")
+        else:
+            if edge is not None:
+                segments = segments.filter(first_at__lte=edge[0])
+                hot = hot.filter(Q(timestamp__lt=edge[0]) | Q(timestamp=edge[0], pk__lt=edge[1]))
+            segments = segments.order_by("-last_at")
+            hot = hot.order_by("-timestamp", "-id")
+
+        def key(message):
+            return message.timestamp, message.pk
+
+        def wanted(message):
+            return edge is None or (key(message) > edge if reverse else key(message) < edge)
+
+        messages = list(hot[:limit])
+        # Segments come nearest first; once `limit` messages are nearer than the next
+        # segment's nearest timestamp, neither it nor the ones after it can add any.
+        for segment_id, chat_id, first_at, last_at in segments.values_list("pk", "chat_id", "first_at", "last_at"):
+            if len(messages) >= limit:
+                bound = messages[limit - 1].timestamp
+                if (bound < first_at) if reverse else (bound > last_at):
+                    break
+            messages += [
+                message for message in (to_message(chat_id, row) for row in load_segment(segment_id, self.using))
+                if wanted(message)
+            ]
+            messages.sort(key=key, reverse=not reverse)
+            del messages[limit:]
+
+        user_ids = {message.user_id for message in messages if message.user_id and not Message.user.is_cached(message)}
+        users = User.objects.using(self.using).in_bulk(user_ids)
+        for message in messages:
+            if message.user_id in users:
+                message.user = users[message.user_id]
+        return messages
+
+
+def index_rows(segments):
+    """`(id, chat_id, content)` of the messages of the `segments` queryset, for search.rebuild."""
+    for chat_id, data in segments.values_list("chat_id", "data").iterator(chunk_size=100):
+        for pk, _, _, _, content, _ in decode(data):
+            yield pk, chat_id, content
+
+
+def find_message(user, pk):
+    """An archived message of `user`'s chats by id, or None."""
+    segments = ArchivedSegment.objects.filter(chat__user=user, first_id__lte=pk, last_id__gte=pk)
+    for segment_id, chat_id in segments.values_list("pk", "chat_id"):
+        for row in load_segment(segment_id):
+            if row[0] == pk:
+                message = to_message(chat_id, row)
+                message.user = User.objects.filter(pk=message.user_id).first()
+                return message
+    return None
+
+
+def export_rows(chats, hot, using="default"):
+    """
+    Merges the archived messages of `chats` into the `hot` export rows, keeping the
+    export's (chat, timestamp, id) order; see exports.export_rows. Segments are read
+    in time order, bypassing the LRU, and only segments whose time ranges overlap
+    are decoded together, so memory stays that of one segment in the common case.
+    """
+    segments = ArchivedSegment.objects.using(using).filter(chat__in=chats).order_by("chat_id", "first_at", "first_id")
+    archived = list(segments.values_list("pk", "chat_id", "first_at", "last_at", "first_id", "last_id"))
+    if not archived:
+        return hot
+
+    def key(row):
+        return row[1], row[4], row[0]
+
+    def segment_rows(segment_id, chat_id):
+        rows = [(pk, chat_id, ai, content, timestamp) for pk, _, ai, _, content, timestamp in read_segment(segment_id, using)]
+        rows.sort(key=key)
+        yield from rows
+
+    def archived_rows():
+        group, end = [], None
+        for segment_id, chat_id, first_at, last_at, first_id, last_id in archived:
+            # A segment that starts after every row of the group starts a new group.
+            if group and (chat_id, first_at, first_id) > end:
+                yield from heapq.merge(*group, key=key)
+                group, end = [], None
+            group.append(segment_rows(segment_id, chat_id))
+            end = max(end, (chat_id, last_at, last_id)) if end else (chat_id, last_at, last_id)
+        yield from heapq.merge(*group, key=key)
+
+    return heapq.merge(hot, archived_rows(), key=key)
@@ -0,0 +1,114 @@
+import logging
+from dataclasses import dataclass, field
+
+from django.conf import settings
+
+from . import archive
+from .llm import LLMError, get_backend
+from .models import Chat
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ChatContext:
+    """What the model gets to remember about a chat: a rolling summary plus the latest turns."""
+    summary: str = ""
+    turns: list = field(default_factory=list)  # [(ai, content), ...] oldest first
+
+
+def estimate_tokens(text):
+    """Cheap token estimate; Arabic text averages about three characters per token."""
+    return len(text) // 3 + 1
+
+
+def build_context(chat, before_id=None):
+    """
+    Assembles the context for the next reply in `chat` within `settings.LLM_CONTEXT_TOKENS`.
+
+    The newest messages are sent verbatim. When they no longer fit, everything except
+    the newest half-budget of turns is folded into `chat.summary`, so the summary is
+    only regenerated once every half-budget of new messages rather than every turn.
+    A long unsummarized backlog (an imported history) is folded a few batches per
+    turn; until it is done, turns get the summary so far and the recent window.
+    Messages with id >= `before_id` (the message being answered) are left out.
+    """
+    if chat.archived_up_to:
+        # The chat is active again: its archived history goes back to the Message table first.
+        archive.restore(chat)
+    budget = settings.LLM_CONTEXT_TOKENS
+    messages = chat.messages.filter(id__gt=chat.summarized_up_to)
+    if before_id is not None:
+        messages = messages.filter(id__lt=before_id)
+    # Fetch one message past the cap so we know whether older ones exist.
+    limit = settings.LLM_CONTEXT_MAX_MESSAGES
+    recent = list(messages.order_by("-id").only("id", "ai", "content")[:limit + 1])
+
+    window, used = [], 0
+    for message in recent[:limit]:
+        cost = estimate_tokens(message.content)
+        if used + cost > budget:
+            break
+        window.append(message)
+        used += cost
+
+    if len(window) < len(recent):
+        # The window is full: keep the newest half and fold the rest into the summary.
+        kept, used = [], 0
+        for message in window:
+            used += estimate_tokens(message.content)
+            if used > budget // 2:
+                break
+            kept.append(message)
+        fold_before = kept[-1].id if kept else (before_id or recent[0].id + 1)
+        try:
+            fold_into_summary(chat, messages.filter(id__lt=fold_before))
+        except LLMError as e:
+            # Answer with the shorter window now; the fold is retried on the next turn.
+            logger.warning("Could not summarize chat %s: %s", chat.pk, e)
+        window = kept
+
+    return ChatContext(
+        summary=chat.summary,
+        turns=[(message.ai, message.content) for message in reversed(window)],
+    )
+
+
+def fold_into_summary(chat, messages):
+    """
+    Adds `messages` to `chat.summary`, a batch of at most one token budget per LLM call,
+    and records the last folded message so it is never summarized twice. Stops after
+    LLM_SUMMARY_MAX_BATCHES calls, so a request never waits on more; the rest is
+    folded by the following turns.
+    """
+    budget = settings.LLM_CONTEXT_TOKENS
+    batch, used, calls = [], 0, 0
+    for message in messages.order_by("id").only("id", "ai", "content").iterator(chunk_size=200):
+        batch.append(message)
+        used += estimate_tokens(message.content)
+        if used >= budget:
+            summarize_batch(chat, batch)
+            batch, used, calls = [], 0, calls + 1
+            if calls >= settings.LLM_SUMMARY_MAX_BATCHES:
+                return
+    if batch:
+        summarize_batch(chat, batch)
+
+
+def summarize_batch(chat, batch):
+    """Asks the model for an updated summary covering `batch` and saves it on the chat."""
+    prompt = f"""
+        لخص المحادثة دي في فقرة قصيرة باللغة المصرية العامية، واحتفظ بأهم المعلومات عن المستخدم.
+        الملخص السابق: {chat.summary or "لا يوجد"}
+        الرسائل الجديدة:
+        {format_turns((message.ai, message.content) for message in batch)}
+        """
+    summary = get_backend().generate(prompt)[:settings.LLM_SUMMARY_MAX_CHARS]
+    chat.summary = summary
+    chat.summarized_up_to = batch[-1].id
+    Chat.objects.filter(pk=chat.pk).update(summary=summary, summarized_up_to=chat.summarized_up_to)
+
+
+def format_turns(turns):
+    """Renders (ai, content) pairs as one line per turn."""
+    return "\n".join(f"{'المساعد' if ai else 'المستخدم'}: {content}" for ai, content in turns)
@@ -0,0 +1,80 @@
+import csv
+import io
+import json
+import zlib
+
+from . import archive
+from .models import Message
+
+FIELDS = ("id", "chat", "ai", "content", "timestamp")
+CHUNK_SIZE = 2000  # rows fetched from the database per round trip
+FLUSH_SIZE = 64 * 1024  # characters buffered before a piece is sent
+
+
+def export_rows(chats, using="default"):
+    """
+    Yields `(id, chat, ai, content, timestamp)` tuples for every message of `chats`,
+    oldest first within each chat, without loading the whole history. Archived
+    messages are merged in one decoded segment at a time (segments overlapping in
+    time are decoded together).
+    """
+    messages = (
+        Message.objects.using(using).filter(chat__in=chats)
+        .order_by("chat_id", "timestamp", "id")
+        .values_list("id", "chat_id", "ai", "content", "timestamp")
+    )
+    return archive.export_rows(chats, messages.iterator(chunk_size=CHUNK_SIZE), using=using)
+
+
+def iter_ndjson(rows):
+    """One JSON object per line."""
+    buffer = []
+    size = 0
+    for message_id, chat_id, ai, content, timestamp in rows:
+        line = json.dumps(
+            {"id": message_id, "chat": chat_id, "ai": ai, "content": content, "timestamp": timestamp.isoformat()},
+            ensure_ascii=False,
+        ) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= FLUSH_SIZE:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def iter_csv(rows):
+    """CSV with a header row. Starts with a BOM so spreadsheet apps read the Arabic text as UTF-8."""
+    buffer = io.StringIO()
+    buffer.write("\ufeff")
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for message_id, chat_id, ai, content, timestamp in rows:
+        writer.writerow((message_id, chat_id, int(ai), content, timestamp.isoformat()))
+        if buffer.tell() >= FLUSH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def encode(pieces, compress=False):
+    """Encodes text pieces as UTF-8, gzipping them on the fly when `compress` is set."""
+    if not compress:
+        for piece in pieces:
+            yield piece.encode()
+        return
+    gzip = zlib.compressobj(wbits=31)  # 31: gzip header and trailer
+    for piece in pieces:
+        data = gzip.compress(piece.encode())
+        if data:
+            yield data
+    yield gzip.flush()
+
+
+FORMATS = {
+    "ndjson": iter_ndjson,
+    "csv": iter_csv,
+}
@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.http import JsonResponse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.response import Response
+
+from .images import content_hash
+from .models import IdempotencyKey
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+POLL_SECONDS = 0.1
+
+
+class KeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = "This Idempotency-Key was already used for a different request."
+    default_code = "idempotency_key_reused"
+
+
+class RequestInProgress(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "A request with this Idempotency-Key is still being processed; retry shortly."
+    default_code = "idempotency_key_in_progress"
+
+
+def get_key(request):
+    key = request.headers.get(HEADER)
+    if key is not None and not 0 < len(key) <= 255:
+        raise ValidationError({HEADER: "Must be 1 to 255 characters long."})
+    return key
+
+
+def fingerprint(method, path, data):
+    """
+    SHA-256 of a request, so a key sent again with a different request is caught.
+    Uploaded files count by content; form data and JSON bodies by value.
+    """
+    if hasattr(data, "getlist"):
+        data = sorted(
+            (name, [content_hash(value) if hasattr(value, "read") else value for value in data.getlist(name)])
+            for name in data
+        )
+    payload = json.dumps([method, path, data], sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def claim(user, key, digest):
+    """
+    Returns `(record, created)`. `created` is True when this request is the first
+    with `key` and must be processed; otherwise `record` is the earlier request's,
+    or None when that one just gave up its key (try again).
+    """
+    now = timezone.now()
+    # Expired keys, and keys left in progress by a crashed worker, are free again.
+    IdempotencyKey.objects.filter(user=user, key=key).filter(
+        Q(created_at__lt=now - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL))
+        | Q(status_code=None, created_at__lt=now - timedelta(seconds=settings.IDEMPOTENCY_LOCK_TIMEOUT))
+    ).delete()
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(user=user, key=key, fingerprint=digest), True
+    except IntegrityError:
+        return IdempotencyKey.objects.filter(user=user, key=key).first(), False
+
+
+def refresh(record):
+    """Reloads `record`; None when its request failed and gave the key up."""
+    return IdempotencyKey.objects.filter(pk=record.pk).first()
+
+
+def save(record, status_code, data):
+    """
+    Stores the response for replay. Server errors and refusals (429) are not
+    stored: the key is given up, so a retry is processed again.
+    """
+    if status_code >= 500 or status_code == status.HTTP_429_TOO_MANY_REQUESTS:
+        record.delete()
+        return
+    record.status_code = status_code
+    record.response = data
+    record.save(update_fields=["status_code", "response"])
+
+
+def purge():
+    """Deletes expired keys and returns how many; see `manage.py purge_idempotency_keys`."""
+    expired = timezone.now() - timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+    return IdempotencyKey.objects.filter(created_at__lt=expired).delete()[0]
+
+
+# --------------------------------------------------------------------------------
+# VIEW HELPERS
+# --------------------------------------------------------------------------------
+def run(request, handler):
+    """
+    Returns `handler()` (a DRF Response) for the first request with a given
+    Idempotency-Key, and the stored copy of that response for repeats. A repeat
+    arriving while the first request is still running waits for its response
+    (up to IDEMPOTENCY_WAIT seconds) instead of running `handler` again.
+    Requests without the header just call `handler`.
+    """
+    key = get_key(request)
+    if key is None:
+        return handler()
+    digest = fingerprint(request.method, request.get_full_path(), request.data)
+    while True:
+        record, created = claim(request.user, key, digest)
+        if created:
+            break
+        if record is None:
+            continue
+        if record.fingerprint != digest:
+            raise KeyReused()
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+        while record is not None and record.status_code is None:
+            if time.monotonic() >= deadline:
+                raise RequestInProgress()
+            time.sleep(POLL_SECONDS)
+            record = refresh(record)
+        if record is not None:
+            return Response(record.response, status=record.status_code, headers={REPLAYED_HEADER: "true"})
+        # The first request failed and gave up its key; this one takes over.
+
+    try:
+        response = handler()
+    except BaseException:
+        record.delete()
+        raise
+    save(record, response.status_code, response.data)
+    return response
+
+
+async def arun(request, user, data, handler):
+    """Async version of `run` for views returning JsonResponse; `data` is the parsed JSON body."""
+    key = get_key(request)
+    if key is None:
+        return await handler()
+    digest = fingerprint(request.method, request.get_full_path(), data)
+    while True:
+        record, created = await sync_to_async(claim)(user, key, digest)
+        if created:
+            break
+        if record is None:
+            continue
+        if record.fingerprint != digest:
+            raise KeyReused()
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+        while record is not None and record.status_code is None:
+            if time.monotonic() >= deadline:
+                raise RequestInProgress()
+            await asyncio.sleep(POLL_SECONDS)
+            record = await sync_to_async(refresh)(record)
+        if record is not None:
+            return JsonResponse(
+                record.response, status=record.status_code, headers={REPLAYED_HEADER: "true"},
+                json_dumps_params={"ensure_ascii": False},
+            )
+
+    try:
+        response = await handler()
+    except BaseException:
+        await record.adelete()
+        raise
+    await sync_to_async(save)(record, response.status_code, json.loads(response.content))
+    return response
@@ -0,0 +1,172 @@
+import hashlib
+import io
+import logging
+import posixpath
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.db import models
+from PIL import Image, ImageOps, features
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg"}
+
+
+def output_format():
+    """`settings.IMAGE_FORMAT`, falling back to JPEG when Pillow was built without WebP."""
+    if settings.IMAGE_FORMAT == "WEBP" and not features.check("webp"):
+        return "JPEG"
+    return settings.IMAGE_FORMAT
+
+
+def encode(image, image_format):
+    buffer = io.BytesIO()
+    if image_format == "JPEG":
+        image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+    # No exif= argument: metadata such as GPS position is dropped from the stored file.
+    image.save(buffer, image_format, quality=settings.IMAGE_QUALITY)
+    return buffer.getvalue()
+
+
+def process_image(file, max_size):
+    """
+    Returns `(image, thumbnail)` bytes for an uploaded image file: rotated upright
+    according to its EXIF orientation, shrunk to fit `max_size` pixels and re-encoded.
+    """
+    image_format = output_format()
+    with Image.open(file) as original:
+        # Lets the JPEG decoder skip detail we are about to throw away.
+        original.draft("RGB", (max_size, max_size))
+        image = ImageOps.exif_transpose(original)
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+        main = encode(image, image_format)
+        image.thumbnail((settings.IMAGE_THUMBNAIL_SIZE, settings.IMAGE_THUMBNAIL_SIZE), Image.LANCZOS)
+        return main, encode(image, image_format)
+
+
+def content_hash(file):
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(64 * 1024), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def stored_hash(image):
+    """SHA-256 of a stored image: its name for pipeline files, otherwise read from storage."""
+    stem = posixpath.splitext(posixpath.basename(image.name))[0]
+    if is_hash(stem):
+        return stem
+    with image.open("rb") as file:
+        return content_hash(file)
+
+
+def is_hash(stem):
+    return len(stem) == 64 and all(c in "0123456789abcdef" for c in stem)
+
+
+def thumbnail_name(name):
+    """`chat_images/<hash>.webp` -> `chat_images/thumbs/<hash>.webp`."""
+    directory, filename = posixpath.split(name)
+    return posixpath.join(directory, "thumbs", filename)
+
+
+def thumbnail_url(image):
+    """URL of the thumbnail of a stored image, or None for images saved before the pipeline existed."""
+    if not image or posixpath.basename(posixpath.dirname(image.name)) == "thumbs":
+        return None
+    if not is_hash(posixpath.splitext(posixpath.basename(image.name))[0]):
+        return None
+    return image.storage.url(thumbnail_name(image.name))
+
+
+# --------------------------------------------------------------------------------
+# IMAGES FOR THE LLM
+# --------------------------------------------------------------------------------
+@dataclass(frozen=True)
+class ImagePart:
+    """An image attached to an LLM prompt; `digest` identifies its content in cache keys."""
+    mime_type: str
+    data: bytes
+    digest: str
+
+
+def encode_for_llm(file):
+    """Shrinks an image to `settings.LLM_IMAGE_SIZE` pixels and returns it as JPEG bytes."""
+    size = settings.LLM_IMAGE_SIZE
+    with Image.open(file) as original:
+        original.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(original)
+        image.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, "JPEG", quality=settings.IMAGE_QUALITY)
+        return buffer.getvalue()
+
+
+def llm_image(image):
+    """
+    Returns the ImagePart sent to the model for a stored image.
+    The encoded bytes are cached by content hash, so regenerating a reply or
+    retrying a job does not decode and resize the picture again.
+    """
+    digest = stored_hash(image)
+    cache = caches[settings.LLM_IMAGE_CACHE_ALIAS]
+    key = f"llm-image:{settings.LLM_IMAGE_SIZE}:{digest}"
+    part = cache.get(key)
+    metrics.record_cache_lookup("llm_images", part is not None)
+    if part is None:
+        with image.open("rb") as file:
+            part = ImagePart("image/jpeg", encode_for_llm(file), digest)
+        cache.set(key, part)
+    return part
+
+
+def prompt_images(message):
+    """The images to send with `message`'s prompt; unreadable files are left out."""
+    if not message.image:
+        return []
+    try:
+        return [llm_image(message.image)]
+    except (OSError, ValueError) as e:
+        logger.warning("Could not attach the image of message %s: %s", message.pk, e)
+        return []
+
+
+# --------------------------------------------------------------------------------
+# MODEL FIELD
+# --------------------------------------------------------------------------------
+class ProcessedImageField(models.ImageField):
+    """
+    ImageField that normalizes new uploads before they are stored.
+    Files are named by the SHA-256 of the uploaded bytes, so the same picture
+    uploaded twice is processed and stored once. A thumbnail is stored next to
+    each image under `thumbs/`. The maximum size is looked up by `upload_to`
+    in `settings.IMAGE_MAX_SIZES`.
+    """
+
+    def pre_save(self, model_instance, add):
+        file = getattr(model_instance, self.attname)
+        if file and not file._committed:
+            self.store(file)
+        return super().pre_save(model_instance, add)
+
+    def store(self, file):
+        image_format = output_format()
+        name = f"{self.upload_to}/{content_hash(file)}.{EXTENSIONS[image_format]}"
+        if not file.storage.exists(name):
+            max_size = settings.IMAGE_MAX_SIZES.get(self.upload_to, settings.IMAGE_MAX_SIZE)
+            main, thumbnail = process_image(file, max_size)
+            file.storage.save(thumbnail_name(name), ContentFile(thumbnail))
+            # Concurrent uploads of the same picture may both get here; the storage
+            # then keeps both copies under different names, which is harmless.
+            name = file.storage.save(name, ContentFile(main))
+        file.name = name
+        file._committed = True
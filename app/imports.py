@@ -0,0 +1,79 @@
+import codecs
+import json
+
+from rest_framework.exceptions import ParseError
+
+READ_SIZE = 64 * 1024
+_decoder = json.JSONDecoder()
+
+
+def iter_records(stream, content_type):
+    """
+    Yields the records of an import body one at a time without reading it all into memory.
+    NDJSON bodies (application/x-ndjson) hold one object per line; anything else is
+    parsed as a JSON array of objects.
+    """
+    if stream is None:
+        return
+    if content_type.startswith(("application/x-ndjson", "application/jsonl")):
+        yield from _iter_ndjson(stream)
+    else:
+        yield from _iter_json_array(stream)
+
+
+def _iter_ndjson(stream):
+    for number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise ParseError(f"Line {number} is not valid JSON: {e}")
+
+
+def _iter_json_array(stream):
+    decode = codecs.getincrementaldecoder("utf-8")().decode
+    buffer, pos, eof = "", 0, False
+
+    def fill():
+        nonlocal buffer, pos, eof
+        chunk = stream.read(READ_SIZE)
+        eof = not chunk
+        buffer = buffer[pos:] + decode(chunk or b"", final=eof)
+        pos = 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            fill()
+
+    skip_whitespace()
+    if buffer[pos:pos + 1] != "[":
+        raise ParseError("Expected a JSON array of messages.")
+    pos += 1
+    first = True
+    while True:
+        skip_whitespace()
+        if buffer[pos:pos + 1] == "]":
+            return
+        if not first:
+            if buffer[pos:pos + 1] != ",":
+                raise ParseError("Expected ',' or ']' between messages.")
+            pos += 1
+            skip_whitespace()
+        first = False
+        while True:
+            try:
+                record, pos = _decoder.raw_decode(buffer, pos)
+                break
+            except ValueError as e:
+                # The object may just be cut off at the end of the buffer.
+                if eof:
+                    raise ParseError(f"Invalid JSON: {e}")
+                fill()
+        yield record
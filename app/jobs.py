@@ -0,0 +1,91 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import reply_cache
+from .context import build_context
+from .images import prompt_images
+from .llm import get_backend
+from .models import Message, ReplyJob
+from .personas import get_persona
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_reply(message):
+    """Queues an AI reply to the user's `message`."""
+    return ReplyJob.objects.create(message=message)
+
+
+def claim_jobs(limit):
+    """
+    Marks up to `limit` due jobs as running and returns them.
+    Each claim is a conditional UPDATE, so two workers never get the same job.
+    Jobs left running by a crashed worker are claimable again after REPLY_JOB_LOCK_TIMEOUT.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.REPLY_JOB_LOCK_TIMEOUT)
+    due = (
+        Q(status=ReplyJob.PENDING, run_after__lte=now)
+        | Q(status=ReplyJob.RUNNING, locked_at__lt=stale)
+    )
+    claimed = []
+    for job_id in ReplyJob.objects.filter(due).order_by("run_after", "id").values_list("id", flat=True)[:limit]:
+        won = ReplyJob.objects.filter(due, id=job_id).update(
+            status=ReplyJob.RUNNING, locked_at=now, attempts=F("attempts") + 1
+        )
+        if won:
+            claimed.append(job_id)
+    return list(ReplyJob.objects.filter(id__in=claimed).select_related("message__chat"))
+
+
+def generate_reply(message):
+    """Builds the prompt for `message` the same way `MessageViewSet.create` does and returns the reply."""
+    from .views import MessageViewSet
+
+    chat = message.chat
+    if message.user_id != chat.user_id:
+        # The context carries the chat's summary and history, which are its owner's only.
+        raise PermissionError(f"Message {message.pk} was not written by the owner of chat {chat.pk}.")
+    persona = get_persona(chat.user_id)
+    context = build_context(chat, before_id=message.id)
+    full_prompt = MessageViewSet().create_ai_prompt(persona, message.content, context)
+    images = prompt_images(message)
+    # Unlike the view, errors propagate here so the job can be retried.
+    if chat.cache_replies:
+        return reply_cache.get_or_generate(persona, full_prompt, get_backend().generate, images)
+    return get_backend().generate(full_prompt, images)
+
+
+def run_job(job):
+    """
+    Generates and saves the reply for a claimed job, scheduling a retry with backoff
+    on failure; a job that may not run (PermissionError) fails at once.
+    """
+    try:
+        ai_text = generate_reply(job.message)
+    except PermissionError as e:
+        # Permanent: another attempt would be refused the same way.
+        logger.error("Reply job %s failed: %s", job.pk, e)
+        ReplyJob.objects.filter(pk=job.pk).update(status=ReplyJob.FAILED, error=str(e), locked_at=None)
+        return
+    except Exception as e:
+        if job.attempts >= settings.REPLY_JOB_MAX_ATTEMPTS:
+            logger.error("Reply job %s failed after %s attempts: %s", job.pk, job.attempts, e)
+            ReplyJob.objects.filter(pk=job.pk).update(status=ReplyJob.FAILED, error=str(e), locked_at=None)
+        else:
+            delay = settings.REPLY_JOB_BACKOFF * 2 ** (job.attempts - 1)
+            logger.warning("Reply job %s attempt %s failed, retrying in %.1fs: %s", job.pk, job.attempts, delay, e)
+            ReplyJob.objects.filter(pk=job.pk).update(
+                status=ReplyJob.PENDING, error=str(e), locked_at=None,
+                run_after=timezone.now() + timedelta(seconds=delay),
+            )
+        return
+
+    with transaction.atomic():
+        ai_msg = Message.objects.create(chat=job.message.chat, user=None, ai=True, content=ai_text)
+        ReplyJob.objects.filter(pk=job.pk).update(status=ReplyJob.DONE, ai_message=ai_msg, error="", locked_at=None)
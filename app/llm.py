@@ -0,0 +1,347 @@
+import asyncio
+import base64
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import Signal, receiver
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Sent after every LLM call with `backend`, `latency` (seconds), `prompt`, `reply`
+# and `error` (the exception, or None), so callers can collect latency metrics.
+llm_request_finished = Signal()
+
+
+class LLMError(Exception):
+    """Raised when the configured LLM backend cannot produce a reply."""
+
+
+class LLMTimeout(LLMError):
+    """Raised when a call runs past the backend's deadline."""
+
+
+# --------------------------------------------------------------------------------
+# BASE BACKEND
+# --------------------------------------------------------------------------------
+class BaseLLMBackend:
+    """
+    Common interface of all LLM backends.
+    Subclasses implement `_generate`, `_agenerate` and `_stream`; the public
+    methods add the per-call deadline and latency reporting around them.
+    `images` are attached pictures with `mime_type` and `data` attributes
+    (see `app.images.ImagePart`).
+    One instance is shared by all requests of a process, so subclasses keep
+    their clients and connection pools on `self`.
+    Vendor SDKs are imported in `__init__`, not at module level: this module is
+    loaded by every process (management commands included) through the signal
+    receivers, and only the one that calls the model should pay for the SDK.
+    """
+    name = None
+
+    def __init__(self, timeout=30.0):
+        self.timeout = timeout
+
+    def generate(self, prompt, images=()):
+        """Returns the full reply text."""
+        start = time.perf_counter()
+        reply, error = "", None
+        try:
+            reply = self._generate(prompt, images).strip()
+            return reply
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._report(start, prompt, reply, error)
+
+    async def agenerate(self, prompt, images=()):
+        """Async version of `generate`."""
+        start = time.perf_counter()
+        reply, error = "", None
+        try:
+            reply = (await asyncio.wait_for(self._agenerate(prompt, images), self.timeout)).strip()
+            return reply
+        except asyncio.TimeoutError as e:
+            error = LLMTimeout(f"{self.name} did not reply within {self.timeout}s")
+            raise error from e
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._report(start, prompt, reply, error)
+
+    def stream(self, prompt, images=()):
+        """Yields the reply piece by piece, giving up once the deadline has passed."""
+        start = time.perf_counter()
+        deadline = start + self.timeout
+        parts, error = [], None
+        try:
+            for text in self._stream(prompt, images):
+                if time.perf_counter() > deadline:
+                    raise LLMTimeout(f"{self.name} did not finish within {self.timeout}s")
+                parts.append(text)
+                yield text
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._report(start, prompt, "".join(parts), error)
+
+    def _generate(self, prompt, images):
+        raise NotImplementedError
+
+    async def _agenerate(self, prompt, images):
+        # Backends without a native async client run in a thread.
+        return await asyncio.to_thread(self._generate, prompt, images)
+
+    def _stream(self, prompt, images):
+        # Backends without streaming send the whole reply as one piece.
+        yield self._generate(prompt, images)
+
+    def _report(self, start, prompt, reply, error):
+        latency = time.perf_counter() - start
+        logger.info(
+            "LLM call backend=%s latency=%.3fs prompt_chars=%d reply_chars=%d error=%s",
+            self.name, latency, len(prompt), len(reply), type(error).__name__ if error else None,
+        )
+        llm_request_finished.send(
+            sender=type(self), backend=self, latency=latency, prompt=prompt, reply=reply, error=error
+        )
+
+
+# --------------------------------------------------------------------------------
+# GEMINI
+# --------------------------------------------------------------------------------
+class GeminiBackend(BaseLLMBackend):
+    """Google Gemini through the `google-generativeai` SDK."""
+    name = "gemini"
+
+    def __init__(self, api_key=None, model="gemini-2.5-flash", timeout=30.0):
+        super().__init__(timeout)
+        if not api_key:
+            raise LLMError("Gemini AI is not configured. Set the GEMINI_API_KEY environment variable.")
+        import google.generativeai as genai  # about a second of imports; see BaseLLMBackend
+
+        genai.configure(api_key=api_key)
+        # The model keeps its gRPC channel, so it is reused across requests.
+        self.model = genai.GenerativeModel(model)
+
+    def _request_options(self):
+        return {"timeout": self.timeout}
+
+    def _contents(self, prompt, images):
+        if not images:
+            return prompt
+        return [prompt, *({"mime_type": image.mime_type, "data": image.data} for image in images)]
+
+    def _generate(self, prompt, images):
+        try:
+            return self.model.generate_content(
+                self._contents(prompt, images), request_options=self._request_options()
+            ).text
+        except Exception as e:
+            raise self._translate(e) from e
+
+    async def _agenerate(self, prompt, images):
+        try:
+            response = await self.model.generate_content_async(
+                self._contents(prompt, images), request_options=self._request_options()
+            )
+            return response.text
+        except Exception as e:
+            raise self._translate(e) from e
+
+    def _stream(self, prompt, images):
+        try:
+            for chunk in self.model.generate_content(
+                self._contents(prompt, images), stream=True, request_options=self._request_options()
+            ):
+                if chunk.text:
+                    yield chunk.text
+        except Exception as e:
+            raise self._translate(e) from e
+
+    def _translate(self, error):
+        from google.api_core import exceptions as google_exceptions
+
+        if isinstance(error, google_exceptions.DeadlineExceeded):
+            return LLMTimeout(f"gemini did not reply within {self.timeout}s")
+        return LLMError(str(error))
+
+
+# --------------------------------------------------------------------------------
+# OPENAI-COMPATIBLE HTTP SERVERS (OpenAI, vLLM, llama.cpp, Ollama, ...)
+# --------------------------------------------------------------------------------
+class OpenAICompatibleBackend(BaseLLMBackend):
+    """Any server exposing the OpenAI `/chat/completions` API, e.g. a local model server."""
+    name = "openai"
+
+    def __init__(self, base_url="http://localhost:8000/v1", model="", api_key="", pool_size=20, timeout=30.0):
+        super().__init__(timeout)
+        self.url = base_url.rstrip("/") + "/chat/completions"
+        self.model = model
+        # One session per process: keeps TCP/TLS connections alive between calls.
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def _payload(self, prompt, images, stream=False):
+        content = prompt
+        if images:
+            # Images go inline as data URLs, the format vision models accept.
+            content = [{"type": "text", "text": prompt}] + [
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:{image.mime_type};base64,{base64.b64encode(image.data).decode()}"},
+                }
+                for image in images
+            ]
+        return {"model": self.model, "messages": [{"role": "user", "content": content}], "stream": stream}
+
+    def _generate(self, prompt, images):
+        try:
+            response = self.session.post(self.url, json=self._payload(prompt, images), timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()["choices"][0]["message"]["content"]
+        except requests.Timeout as e:
+            raise LLMTimeout(f"openai did not reply within {self.timeout}s") from e
+        except (requests.RequestException, KeyError, IndexError, ValueError) as e:
+            raise LLMError(str(e)) from e
+
+    def _stream(self, prompt, images):
+        try:
+            with self.session.post(
+                self.url, json=self._payload(prompt, images, stream=True), timeout=self.timeout, stream=True
+            ) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    text = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                    if text:
+                        yield text
+        except requests.Timeout as e:
+            raise LLMTimeout(f"openai did not reply within {self.timeout}s") from e
+        except (requests.RequestException, KeyError, IndexError, ValueError) as e:
+            raise LLMError(str(e)) from e
+
+
+# --------------------------------------------------------------------------------
+# FAKE BACKEND (for tests, load tests and local development, no network access)
+# --------------------------------------------------------------------------------
+class FakeBackend(BaseLLMBackend):
+    """
+    Deterministic in-process backend.
+    Replies with `reply` after `delay` seconds. When streaming, the reply is
+    split into `chunks` pieces and `delay` is waited before each piece.
+    The latest prompts are kept in `prompts`, and the images sent with each
+    of them in `images`, for tests to inspect.
+    """
+    name = "fake"
+
+    def __init__(self, reply="أهلاً بيك! أنا هنا عشان أساعدك.", chunks=None, delay=0.0, timeout=30.0):
+        super().__init__(timeout)
+        self.reply = reply
+        if chunks is None:
+            # Split on words but keep the spaces, so the joined chunks equal `reply`.
+            words = self.reply.split(" ")
+            chunks = [words[0]] + [f" {word}" for word in words[1:]]
+        self.chunks = list(chunks)
+        self.delay = delay
+        self.prompts = deque(maxlen=100)
+        self.images = deque(maxlen=100)
+
+    def _wait(self, seconds):
+        if seconds > self.timeout:
+            time.sleep(self.timeout)
+            raise LLMTimeout(f"fake did not reply within {self.timeout}s")
+        time.sleep(seconds)
+
+    def _record(self, prompt, images):
+        self.prompts.append(prompt)
+        self.images.append(list(images))
+
+    def _generate(self, prompt, images):
+        self._record(prompt, images)
+        self._wait(self.delay)
+        return self.reply
+
+    async def _agenerate(self, prompt, images):
+        self._record(prompt, images)
+        await asyncio.sleep(self.delay)
+        return self.reply
+
+    def _stream(self, prompt, images):
+        self._record(prompt, images)
+        for piece in self.chunks:
+            self._wait(self.delay)
+            yield piece
+
+
+# --------------------------------------------------------------------------------
+# REGISTRY
+# --------------------------------------------------------------------------------
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "openai": OpenAICompatibleBackend,
+    "fake": FakeBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Returns the backend selected by `settings.LLM_BACKEND`, built once per process.
+    `LLM_BACKEND` is a key of `BACKENDS` or a dotted path to a backend class;
+    its options come from `settings.LLM_BACKENDS[name]`.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = settings.LLM_BACKEND
+                backend_class = BACKENDS[name] if name in BACKENDS else import_string(name)
+                options = {"timeout": settings.LLM_TIMEOUT, **settings.LLM_BACKENDS.get(name, {})}
+                _backend = backend_class(**options)
+    return _backend
+
+
+def warm_up():
+    """
+    Builds the backend now instead of on the first AI request, so the SDK import
+    and client setup do not land on a user's request. Called by the gunicorn
+    `post_worker_init` hook when `settings.LLM_WARM_UP` is on; returns the
+    backend, or None when it could not be built (the first request then reports
+    the error as usual).
+    """
+    start = time.perf_counter()
+    try:
+        backend = get_backend()
+    except LLMError as e:
+        logger.warning("LLM warm-up failed: %s", e)
+        return None
+    logger.info("LLM backend %s ready in %.3fs", backend.name, time.perf_counter() - start)
+    return backend
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    """Rebuilds the backend when tests override the LLM settings."""
+    global _backend
+    if setting in ("LLM_BACKEND", "LLM_BACKENDS", "LLM_TIMEOUT"):
+        _backend = None
@@ -0,0 +1,77 @@
+import statistics
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from django.utils import timezone
+
+from app import archive
+from app.models import ArchivedSegment
+
+SAMPLE_SEGMENTS = 20  # segments read back to measure the read latency
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves the messages of chats inactive for ARCHIVE_AFTER_DAYS days into zlib-compressed "
+        "segments (see app/archive.py), then reports the space they take and how long reading a "
+        "segment back takes. Archived chats stay readable through the API and the exports; "
+        "a new message restores the chat."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.ARCHIVE_AFTER_DAYS, help="Days without activity.")
+        parser.add_argument("--segment-size", type=int, default=settings.ARCHIVE_SEGMENT_SIZE, help="Messages per segment.")
+        parser.add_argument("--limit", type=int, help="Archive at most this many chats.")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the chats that would be archived.")
+
+    def handle(self, *args, **options):
+        chats = archive.archivable_chats(timezone.now() - timedelta(days=options["days"]))
+        if options["limit"]:
+            chats = chats[:options["limit"]]
+        chats = list(chats)
+        if options["dry_run"]:
+            self.stdout.write(f"{len(chats)} chats would be archived.")
+            return
+
+        started = time.perf_counter()
+        totals = [0, 0, 0, 0]
+        for chat in chats:
+            for n, value in enumerate(archive.archive_chat(chat, options["segment_size"])):
+                totals[n] += value
+        messages, segments, raw, compressed = totals
+        self.stdout.write(
+            f"Archived {messages} messages of {len(chats)} chats into {segments} segments "
+            f"in {time.perf_counter() - started:.1f}s."
+        )
+        if raw:
+            self.stdout.write(f"  this run: {size(raw)} of messages stored in {size(compressed)} ({raw / compressed:.1f}x smaller)")
+        self.report()
+
+    def report(self):
+        total = ArchivedSegment.objects.aggregate(raw=Sum("raw_bytes"), compressed=Sum("compressed_bytes"))
+        if not total["raw"]:
+            return
+        self.stdout.write(
+            f"  archive: {size(total['raw'])} of messages stored in {size(total['compressed'])} "
+            f"({size(total['raw'] - total['compressed'])} saved)"
+        )
+        sample = list(ArchivedSegment.objects.order_by("-id").values_list("pk", flat=True)[:SAMPLE_SEGMENTS])
+        cold, warm = [], []
+        for segment_id in sample:
+            archive.clear_cache()
+            for timings in (cold, warm):
+                start = time.perf_counter()
+                archive.load_segment(segment_id)
+                timings.append((time.perf_counter() - start) * 1000)
+        archive.clear_cache()
+        self.stdout.write(
+            f"  reading a segment: {statistics.median(cold):.2f}ms median, {max(cold):.2f}ms max "
+            f"from the database; {statistics.median(warm):.3f}ms from the cache"
+        )
+
+
+def size(n):
+    return f"{n / 1024 / 1024:.2f} MB"
@@ -0,0 +1,87 @@
+import asyncio
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncClient, Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.authtoken.models import Token
+
+from app.models import Chat
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares concurrent message-creation throughput of the sync DRF endpoint "
+        "(limited to --workers threads, like gunicorn sync workers) and the async endpoint, "
+        "against a fake LLM that waits --delay seconds per reply. Runs on a throwaway database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200, help="Messages to create per path.")
+        parser.add_argument("--workers", type=int, default=4, help="Concurrent sync workers.")
+        parser.add_argument("--delay", type=float, default=0.5, help="Fake LLM latency in seconds.")
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        with tempfile.TemporaryDirectory() as tmp:
+            # A file-backed database, so the worker threads share one database safely.
+            connection.settings_dict["TEST"]["NAME"] = str(Path(tmp) / "bench.sqlite3")
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                self.run_benchmark(options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+
+    def run_benchmark(self, options):
+        user = User.objects.create_user(username="bench", password="bench-pass-123")
+        chat = Chat.objects.create(user=user, chat_name="bench")
+        token = Token.objects.create(user=user)
+        payload = {"chat": chat.id, "chat_id": chat.id, "content": "ازيك يا صاحبي؟"}
+        auth = f"Token {token.key}"
+        total = options["requests"]
+
+        # One user sends every request at once, so the generation limits are off.
+        with override_settings(
+            LLM_BACKEND="fake", LLM_BACKENDS={"fake": {"delay": options["delay"]}},
+            LLM_USER_RATE=0, LLM_USER_CONCURRENCY=0, LLM_CONCURRENCY=0,
+        ):
+            sync_seconds = self.run_sync(total, options["workers"], payload, auth)
+            async_seconds = asyncio.run(self.run_async(total, payload, auth))
+
+        self.report(f"sync  ({options['workers']} workers)", total, sync_seconds)
+        self.report("async (1 event loop)", total, async_seconds)
+        self.stdout.write(f"speed-up: {sync_seconds / async_seconds:.1f}x")
+
+    def run_sync(self, total, workers, payload, auth):
+        def post(_):
+            response = Client().post(
+                "/api/messages/", payload, content_type="application/json", headers={"Authorization": auth}
+            )
+            assert response.status_code == 201, response.content
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(post, range(total)))
+        return time.perf_counter() - start
+
+    async def run_async(self, total, payload, auth):
+        client = AsyncClient()
+
+        async def post():
+            response = await client.post(
+                "/api/async/messages/", payload, content_type="application/json", headers={"Authorization": auth}
+            )
+            assert response.status_code == 201, response.content
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post() for _ in range(total)))
+        return time.perf_counter() - start
+
+    def report(self, label, total, seconds):
+        self.stdout.write(f"{label}: {total} messages in {seconds:.2f}s = {total / seconds:.1f} msg/s")
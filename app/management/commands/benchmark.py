@@ -0,0 +1,202 @@
+import json
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from app.management.commands.seed_data import WORDS
+from app.models import Chat, Message
+
+SCENARIOS = ("message-create", "message-list", "chat-list", "profile")
+
+
+class Command(BaseCommand):
+    help = (
+        "Drives the real API endpoints in-process against the fake LLM backend and reports "
+        "p50/p95/p99 latency, throughput and queries per request. Uses users created by "
+        "`seed_data` (or seeds a throwaway database with --throwaway) and can write the "
+        "results as JSON to compare runs across commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+        parser.add_argument("--requests", type=int, default=200, help="Requests per scenario.")
+        parser.add_argument("--concurrency", type=int, default=1, help="Client threads per scenario.")
+        parser.add_argument("--delay", type=float, default=0.0, help="Fake LLM latency in seconds.")
+        parser.add_argument("--prefix", default="seed", help="Username prefix given to seed_data.")
+        parser.add_argument("--random-seed", type=int, default=1)
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument("--compare", help="Print the change against an earlier JSON results file.")
+        parser.add_argument(
+            "--throwaway", action="store_true",
+            help="Run on a temporary database seeded with --seed-messages messages instead of the configured one.",
+        )
+        parser.add_argument("--seed-messages", type=int, default=20_000)
+
+    def handle(self, *args, **options):
+        if not options["throwaway"]:
+            self.run(options)
+            return
+        with tempfile.TemporaryDirectory() as tmp:
+            # A file-backed database, so the client threads share one database safely.
+            connection.settings_dict["TEST"]["NAME"] = str(Path(tmp) / "benchmark.sqlite3")
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                call_command(
+                    "seed_data", users=50, messages=options["seed_messages"],
+                    prefix=options["prefix"], stdout=self.stdout,
+                )
+                self.run(options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def run(self, options):
+        users = list(User.objects.filter(username__startswith=f"{options['prefix']}-").order_by("id")[:50])
+        if not users:
+            raise CommandError(f"No {options['prefix']}-* users; run `manage.py seed_data` first.")
+        tokens = {user.pk: Token.objects.get_or_create(user=user)[0].key for user in users}
+        chats = {}
+        for chat_id, user_id in Chat.objects.filter(user__in=users).values_list("id", "user_id"):
+            chats.setdefault(user_id, []).append(chat_id)
+        users = [user for user in users if user.pk in chats]
+        rng = random.Random(options["random_seed"])
+
+        results = {}
+        with override_settings(
+            LLM_BACKEND="fake",
+            LLM_BACKENDS={"fake": {"delay": options["delay"]}},
+            # Far more requests per user than the per-user limits allow; the global ceiling stays on.
+            LLM_USER_RATE=0, LLM_USER_CONCURRENCY=0,
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"],
+        ):
+            for scenario in options["scenarios"]:
+                requests = [self.make_request(scenario, rng, users, chats, tokens) for _ in range(options["requests"])]
+                results[scenario] = self.measure(requests, options["concurrency"])
+                self.print_result(scenario, results[scenario])
+
+        report = {
+            "commit": git_commit(),
+            "created_at": timezone.now().isoformat(),
+            "options": {key: options[key] for key in ("requests", "concurrency", "delay")},
+            "database": {"vendor": connection.vendor, "messages": Message.objects.count()},
+            "scenarios": results,
+        }
+        if options["output"]:
+            Path(options["output"]).write_text(json.dumps(report, indent=2))
+            self.stdout.write(f"Results written to {options['output']}.")
+        if options["compare"]:
+            self.print_comparison(json.loads(Path(options["compare"]).read_text()), report)
+
+    def make_request(self, scenario, rng, users, chats, tokens):
+        """Returns (method, path, payload, token) for one request of `scenario`."""
+        user = rng.choice(users)
+        token = tokens[user.pk]
+        if scenario == "message-create":
+            chat_id = rng.choice(chats[user.pk])
+            content = " ".join(rng.choices(WORDS, k=rng.randint(3, 15)))
+            return "post", "/api/messages/", {"chat": chat_id, "chat_id": chat_id, "content": content}, token
+        if scenario == "message-list":
+            return "get", f"/api/messages/?chat={rng.choice(chats[user.pk])}", None, token
+        if scenario == "chat-list":
+            return "get", "/api/chats/", None, token
+        return "get", "/api/profiles/", None, token
+
+    def measure(self, requests, concurrency):
+        latencies, query_counts, errors = [], [], []
+        lock = threading.Lock()
+        local = threading.local()
+
+        def count_queries(execute, sql, params, many, context):
+            local.queries += 1
+            return execute(sql, params, many, context)
+
+        def send(request):
+            method, path, payload, token = request
+            client = Client(headers={"Authorization": f"Token {token}"})
+            local.queries = 0
+            start = time.perf_counter()
+            with connection.execute_wrapper(count_queries):
+                if method == "post":
+                    response = client.post(path, payload, content_type="application/json")
+                else:
+                    response = client.get(path)
+            seconds = time.perf_counter() - start
+            with lock:
+                latencies.append(seconds)
+                query_counts.append(local.queries)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(send, requests))
+        elapsed = time.perf_counter() - start
+
+        latencies.sort()
+        query_counts.sort()
+        return {
+            "requests": len(requests),
+            "errors": len(errors),
+            "seconds": round(elapsed, 3),
+            "throughput_rps": round(len(requests) / elapsed, 1),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2),
+            "queries_p50": percentile(query_counts, 50),
+            "queries_max": query_counts[-1],
+        }
+
+    def print_result(self, scenario, result):
+        self.stdout.write(
+            f"{scenario:15} {result['throughput_rps']:8.1f} req/s  p50 {result['p50_ms']:7.2f}ms  "
+            f"p95 {result['p95_ms']:7.2f}ms  p99 {result['p99_ms']:7.2f}ms  "
+            f"queries {result['queries_p50']} (max {result['queries_max']})  errors {result['errors']}"
+        )
+
+    def print_comparison(self, before, after):
+        self.stdout.write(f"Change since {before.get('commit') or 'baseline'}:")
+        for scenario, result in after["scenarios"].items():
+            old = before.get("scenarios", {}).get(scenario)
+            if old is None:
+                continue
+            changes = "  ".join(
+                f"{key} {change(old[key], result[key])}"
+                for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "queries_p50")
+            )
+            self.stdout.write(f"{scenario:15} {changes}")
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted `values`."""
+    index = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def change(old, new):
+    if not old:
+        return f"{old} -> {new}"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=settings.BASE_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -0,0 +1,110 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from app.management.commands.benchmark import change, git_commit
+
+# What each kind of process imports before it can do any work.
+TARGETS = {
+    # Every `manage.py` command (migrate, collectstatic, tests, the reply worker).
+    "setup": "import django; django.setup()",
+    # A web worker: the application, the URLconf and the views it loads on the first request.
+    "worker": "import project.asgi; import project.urls",
+}
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures process startup: runs fresh interpreters with `python -X importtime` that "
+        "set up Django (and load the web application), and reports wall time, total import "
+        "time and the slowest top-level imports. Results can be written as JSON and compared "
+        "across commits, like `benchmark`."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--targets", nargs="+", choices=TARGETS, default=list(TARGETS))
+        parser.add_argument("--runs", type=int, default=5, help="Interpreters started per target; the median is reported.")
+        parser.add_argument("--top", type=int, default=10, help="Slowest top-level imports to list.")
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument("--compare", help="Print the change against an earlier JSON results file.")
+
+    def handle(self, *args, **options):
+        results = {}
+        for target in options["targets"]:
+            runs = [self.run_once(TARGETS[target]) for _ in range(options["runs"])]
+            results[target] = summarize(runs, options["top"])
+            self.print_result(target, results[target])
+
+        report = {
+            "commit": git_commit(),
+            "created_at": timezone.now().isoformat(),
+            "python": sys.version.split()[0],
+            "runs": options["runs"],
+            "targets": results,
+        }
+        if options["output"]:
+            Path(options["output"]).write_text(json.dumps(report, indent=2))
+            self.stdout.write(f"Results written to {options['output']}.")
+        if options["compare"]:
+            self.print_comparison(json.loads(Path(options["compare"]).read_text()), report)
+
+    def run_once(self, code):
+        """Returns `(wall seconds, [(module, self us, cumulative us, depth), ...])` for one interpreter."""
+        env = {**os.environ, "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", "project.settings")}
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True, text=True, cwd=settings.BASE_DIR, env=env,
+        )
+        seconds = time.perf_counter() - start
+        if result.returncode != 0:
+            raise CommandError(f"`{code}` failed:\n{result.stderr[-2000:]}")
+        imports = [
+            (module, int(self_us), int(cumulative_us), len(indent) // 2)
+            for self_us, cumulative_us, indent, module in IMPORT_LINE.findall(result.stderr)
+        ]
+        return seconds, imports
+
+    def print_result(self, target, result):
+        self.stdout.write(
+            f"{target:8} wall {result['wall_ms']:7.1f}ms  imports {result['import_ms']:7.1f}ms  "
+            f"modules {result['modules']}"
+        )
+        for module, ms in result["slowest"]:
+            self.stdout.write(f"  {ms:7.1f}ms  {module}")
+
+    def print_comparison(self, before, after):
+        self.stdout.write(f"Change since {before.get('commit') or 'baseline'}:")
+        for target, result in after["targets"].items():
+            old = before.get("targets", {}).get(target)
+            if old is None:
+                continue
+            changes = "  ".join(f"{key} {change(old[key], result[key])}" for key in ("wall_ms", "import_ms", "modules"))
+            self.stdout.write(f"{target:8} {changes}")
+
+
+def summarize(runs, top):
+    """Medians over `runs`; the slowest imports are taken from the median run."""
+    walls = sorted(seconds for seconds, _ in runs)
+    by_total = sorted(runs, key=lambda run: sum(cumulative for _, _, cumulative, depth in run[1] if depth == 0))
+    _, imports = by_total[len(by_total) // 2]
+    top_level = sorted(
+        ((module, cumulative) for module, _, cumulative, depth in imports if depth == 0),
+        key=lambda item: item[1], reverse=True,
+    )
+    return {
+        "wall_ms": round(statistics.median(walls) * 1000, 1),
+        "import_ms": round(sum(cumulative for _, cumulative in top_level) / 1000, 1),
+        "modules": len(imports),
+        "slowest": [(module, round(cumulative / 1000, 1)) for module, cumulative in top_level[:top]],
+    }
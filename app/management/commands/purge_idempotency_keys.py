@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app import idempotency
+
+
+class Command(BaseCommand):
+    help = "Deletes stored Idempotency-Key responses older than IDEMPOTENCY_KEY_TTL. Run it daily, e.g. from cron."
+
+    def handle(self, *args, **options):
+        deleted = idempotency.purge()
+        self.stdout.write(f"Deleted {deleted} expired idempotency keys.")
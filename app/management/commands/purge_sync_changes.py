@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from app import sync
+
+
+class Command(BaseCommand):
+    help = "Deletes logged chat and message changes older than SYNC_CHANGE_TTL. Run it daily, e.g. from cron."
+
+    def handle(self, *args, **options):
+        deleted = sync.purge()
+        self.stdout.write(f"Deleted {deleted} expired sync changes.")
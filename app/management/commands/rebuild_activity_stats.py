@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app import activity
+from app.models import Chat, Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the activity stats shown on the parent dashboard, and the message count, "
+        "preview and last activity of every chat, from the chat messages."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000, help="Rows inserted per statement batch.")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        total = activity.rebuild(Message.objects.all(), batch_size=options["batch_size"])
+        chats = activity.rebuild_chats(Chat.objects.all())
+        self.stdout.write(
+            f"Rebuilt the activity stats of {total} users and {chats} chats in {time.perf_counter() - started:.1f}s."
+        )
@@ -0,0 +1,23 @@
+import time
+from itertools import chain
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app import archive, search
+from app.models import ArchivedSegment, Message
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the full-text search index of chat messages, archived ones included, from scratch."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=2000, help="Messages inserted per statement batch.")
+
+    def handle(self, *args, **options):
+        if not search.available():
+            raise CommandError("Full-text search needs SQLite with FTS5.")
+        started = time.perf_counter()
+        messages = Message.objects.order_by("pk").values_list("pk", "chat_id", "content")
+        rows = chain(messages.iterator(chunk_size=options["batch_size"]), archive.index_rows(ArchivedSegment.objects.all()))
+        total = search.rebuild(rows, batch_size=options["batch_size"])
+        self.stdout.write(f"Indexed {total} messages in {time.perf_counter() - started:.1f}s.")
@@ -0,0 +1,46 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from app.jobs import claim_jobs, run_job
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = "Processes queued AI replies (ReplyJob rows) with a pool of worker threads."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=8, help="Replies generated at the same time.")
+        parser.add_argument("--poll-interval", type=float, default=0.5, help="Seconds to wait when the queue is empty.")
+        parser.add_argument("--once", action="store_true", help="Exit once no job is due instead of waiting for more.")
+
+    def handle(self, *args, **options):
+        concurrency = options["concurrency"]
+        running = set()
+        processed = 0
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="reply-worker") as pool:
+            while True:
+                running = {future for future in running if not future.done()}
+                free = concurrency - len(running)
+                jobs = claim_jobs(free) if free else []
+                for job in jobs:
+                    running.add(pool.submit(self.run, job))
+                processed += len(jobs)
+
+                if not jobs and not running and options["once"]:
+                    break
+                if not jobs:
+                    time.sleep(options["poll_interval"])
+        self.stdout.write(f"Processed {processed} reply job(s).")
+
+    def run(self, job):
+        try:
+            run_job(job)
+        except Exception:
+            # The job stays claimed and is picked up again after REPLY_JOB_LOCK_TIMEOUT.
+            logger.exception("Reply job %s crashed", job.pk)
+        finally:
+            close_old_connections()
@@ -0,0 +1,136 @@
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from app import activity, search, sync
+from app.models import Chat, Message, Profile, Te_status
+
+WORDS = (
+    "انا رايح المدرسة بكرة الصبح وعندي امتحان رياضيات صعب شوية "
+    "ممكن تساعدني في الواجب النهاردة ماما عملت أكل حلو جدا "
+    "الكورة كانت جامدة امبارح وفريقنا كسب اتنين واحد "
+    "عايز اتعلم برمجة ورسم وعزف على الجيتار في الاجازة "
+    "صاحبي زعلان مني ومش عارف اصالحه ازاي "
+    "القطة بتاعتنا ولدت تلات قطط صغيرين لونهم ابيض واسود "
+    "احكيلي حكاية عن الفضاء والنجوم والكواكب "
+    "إيه رأيك في الفيلم الجديد؟ أنا شايف إنه ممتع جداً"
+).split()
+PERSONAS = (
+    "طفل عنده ٨ سنين بيحب الرسم والحيوانات",
+    "طالبة في إعدادي بتحب العلوم والقراءة",
+    "ولد في ثانوي بيحب الكورة والألعاب",
+    "",
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills the database with synthetic users, profiles, parent/son links, personas, "
+        "chats and Arabic messages for load tests and benchmarks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument("--chats-per-user", type=int, default=5)
+        parser.add_argument("--messages", type=int, default=100_000, help="Total messages, spread over all chats.")
+        parser.add_argument("--parents", type=float, default=0.2, help="Share of users that are parents.")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--prefix", default="seed", help="Username prefix; must not be in use yet.")
+        parser.add_argument("--password", default="seed-pass-123", help="Password of every seeded user.")
+        parser.add_argument("--random-seed", type=int, default=1, help="Makes runs reproducible.")
+
+    def handle(self, *args, **options):
+        prefix = options["prefix"]
+        if User.objects.filter(username__startswith=f"{prefix}-").exists():
+            raise CommandError(f"Users named {prefix}-* already exist; pick another --prefix.")
+        rng = random.Random(options["random_seed"])
+        started = time.perf_counter()
+
+        with transaction.atomic():
+            users = self.create_users(options, rng)
+            chats = self.create_chats(users, options)
+        self.stdout.write(f"Created {len(users)} users and {len(chats)} chats.")
+
+        total = self.create_messages(chats, options, rng)
+        self.stdout.write(f"Created {total} messages in {time.perf_counter() - started:.1f}s.")
+
+    def create_users(self, options, rng):
+        prefix = options["prefix"]
+        # Hashing once instead of per user: the hasher is slow on purpose.
+        password = make_password(options["password"])
+        users = User.objects.bulk_create(
+            User(username=f"{prefix}-{n}", email=f"{prefix}-{n}@example.com", password=password)
+            for n in range(options["users"])
+        )
+        parent_count = int(len(users) * options["parents"])
+        parents, children = users[:parent_count], users[parent_count:]
+        profiles = Profile.objects.bulk_create(
+            Profile(
+                user=user,
+                is_parent=index < parent_count,
+                age=rng.randint(30, 55) if index < parent_count else rng.randint(7, 17),
+                gender=rng.choice(("male", "female")),
+            )
+            for index, user in enumerate(users)
+        )
+        if parents and children:
+            Sons = Profile.sons.through
+            Sons.objects.bulk_create(
+                Sons(profile_id=profiles[index % parent_count].pk, user_id=child.pk)
+                for index, child in enumerate(children)
+            )
+        Te_status.objects.bulk_create(
+            Te_status(user=user, persona_prompt=rng.choice(PERSONAS)) for user in children
+        )
+        return users
+
+    def create_chats(self, users, options):
+        chats = Chat.objects.bulk_create(
+            Chat(user=user, chat_name=f"محادثة {n + 1}")
+            for user in users
+            for n in range(options["chats_per_user"])
+        )
+        sync.record_chats(chats)
+        return chats
+
+    def create_messages(self, chats, options, rng):
+        if not chats:
+            return 0
+        batch_size = options["batch_size"]
+        # Spread over the last year, in order, like a real history.
+        start = timezone.now() - timedelta(days=365)
+        step = timedelta(days=365) / max(options["messages"], 1)
+        total, batch = 0, []
+        for n in range(options["messages"]):
+            ai = n % 2 == 1
+            if not ai:
+                chat = rng.choice(chats)  # each user message is answered in the same chat
+            batch.append(Message(
+                chat=chat,
+                user=None if ai else chat.user,
+                ai=ai,
+                content=" ".join(rng.choices(WORDS, k=rng.randint(3, 30))),
+                timestamp=start + n * step,
+            ))
+            if len(batch) >= batch_size:
+                total += self.save_messages(batch)
+                batch = []
+                self.stdout.write(f"  {total} messages...")
+        if batch:
+            total += self.save_messages(batch)
+        return total
+
+    def save_messages(self, batch):
+        with transaction.atomic():
+            messages = Message.objects.bulk_create(batch)
+            # bulk_create sends no post_save, so the search index, the stats and the sync log are updated here.
+            search.index_messages(messages)
+            activity.record_messages(messages)
+            sync.record_messages(messages)
+        return len(messages)
@@ -0,0 +1,215 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Default histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (100, 300, 1000, 3000, 10000, 30000, 100000)
+
+
+# --------------------------------------------------------------------------------
+# IN-PROCESS REGISTRY
+# --------------------------------------------------------------------------------
+class Histogram:
+    """A Prometheus-style histogram with one series per label set."""
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        with self.lock:
+            items = [(labels, list(series)) for labels, series in self.series.items()]
+        for labels, series in sorted(items):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield "_bucket", (*zip(self.labels, labels), ("le", format_value(bound))), cumulative
+            yield "_bucket", (*zip(self.labels, labels), ("le", "+Inf")), series[-1]
+            yield "_sum", tuple(zip(self.labels, labels)), series[-2]
+            yield "_count", tuple(zip(self.labels, labels)), series[-1]
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.series.items())
+        for labels, value in items:
+            yield "", tuple(zip(self.labels, labels)), value
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time to produce the response (first byte for streams).",
+    ("method", "route", "status"),
+)
+REQUEST_QUERIES = Histogram(
+    "http_request_db_queries", "Database queries per request.", ("method", "route"), COUNT_BUCKETS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds", "Time spent in database queries per request.", ("method", "route"),
+)
+LLM_SECONDS = Histogram("llm_request_duration_seconds", "LLM call latency.", ("backend", "outcome"))
+LLM_PROMPT_CHARS = Histogram("llm_prompt_chars", "Prompt size in characters.", ("backend",), SIZE_BUCKETS)
+LLM_REPLY_CHARS = Histogram("llm_reply_chars", "Reply size in characters.", ("backend",), SIZE_BUCKETS)
+CACHE_LOOKUPS = Counter("app_cache_lookups_total", "Cache lookups by cache and result.", ("cache", "result"))
+LLM_QUEUE_SECONDS = Histogram("llm_queue_wait_seconds", "Time spent waiting for a free generation slot.")
+LLM_REJECTIONS = Counter("llm_rejections_total", "AI requests refused by the limiter (app/ratelimit.py).", ("reason",))
+ARCHIVE_DECODE_SECONDS = Histogram("archive_segment_decode_seconds", "Time to load and decode an archived segment.")
+
+REGISTRY = [
+    REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_DB_SECONDS,
+    LLM_SECONDS, LLM_PROMPT_CHARS, LLM_REPLY_CHARS, CACHE_LOOKUPS, LLM_QUEUE_SECONDS, LLM_REJECTIONS,
+    ARCHIVE_DECODE_SECONDS,
+]
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.samples():
+            label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels)
+            lines.append(f"{metric.name}{suffix}{{{label_text}}} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def reset():
+    """Clears all series (for tests)."""
+    for metric in REGISTRY:
+        with metric.lock:
+            metric.series.clear()
+
+
+# --------------------------------------------------------------------------------
+# PER-REQUEST STATS
+# --------------------------------------------------------------------------------
+@dataclass
+class RequestStats:
+    queries: int = 0
+    db_seconds: float = 0.0
+    llm_calls: int = 0
+    llm_seconds: float = 0.0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    # SQL -> [count, seconds]; only filled when the slow-request log is on.
+    query_breakdown: dict = field(default_factory=dict)
+
+
+# Set by MetricsMiddleware for the duration of a request. A context variable
+# follows the request into sync_to_async threads, so async views are covered too.
+current = contextvars.ContextVar("request_stats", default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper, installed on every connection (see `install_query_wrapper`)."""
+    stats = current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - start
+        stats.queries += 1
+        stats.db_seconds += seconds
+        if settings.SLOW_REQUEST_SECONDS is not None:
+            entry = stats.query_breakdown.setdefault(sql, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """`connection_created` receiver."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def record_llm_call(sender, backend, latency, prompt, reply, error, **kwargs):
+    """`llm_request_finished` receiver."""
+    name = backend.name or type(backend).__name__
+    LLM_SECONDS.observe(latency, name, "error" if error else "ok")
+    LLM_PROMPT_CHARS.observe(len(prompt), name)
+    LLM_REPLY_CHARS.observe(len(reply), name)
+    stats = current.get()
+    if stats is not None:
+        stats.llm_calls += 1
+        stats.llm_seconds += latency
+
+
+def record_cache_lookup(cache_name, hit):
+    CACHE_LOOKUPS.inc(cache_name, "hit" if hit else "miss")
+    stats = current.get()
+    if stats is not None:
+        if hit:
+            stats.cache_hits += 1
+        else:
+            stats.cache_misses += 1
+
+
+def finish_request(request, response, stats, seconds):
+    """Records the request in the histograms and logs it when it was slow."""
+    match = getattr(request, "resolver_match", None)
+    # URL names ("message-list") keep the label set small; unnamed routes use their pattern.
+    route = (match.view_name or match.route) if match is not None else "unmatched"
+    method = request.method
+    REQUEST_SECONDS.observe(seconds, method, route, str(response.status_code))
+    REQUEST_QUERIES.observe(stats.queries, method, route)
+    REQUEST_DB_SECONDS.observe(stats.db_seconds, method, route)
+
+    threshold = settings.SLOW_REQUEST_SECONDS
+    if threshold is not None and seconds >= threshold:
+        top = sorted(stats.query_breakdown.items(), key=lambda item: item[1][1], reverse=True)[:5]
+        breakdown = "".join(f"\n  {count}x {total * 1000:.1f}ms {sql[:200]}" for sql, (count, total) in top)
+        logger.warning(
+            "Slow request %s %s %s %.3fs: %d queries %.3fs, %d LLM calls %.3fs, cache %d hit/%d miss%s",
+            method, request.get_full_path(), response.status_code, seconds,
+            stats.queries, stats.db_seconds, stats.llm_calls, stats.llm_seconds,
+            stats.cache_hits, stats.cache_misses, breakdown,
+        )
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-17 01:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_story_storymessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='summarized_up_to',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='summary',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-17 01:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_chat_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='cache_replies',
+            field=models.BooleanField(default=True),
+        ),
+    ]
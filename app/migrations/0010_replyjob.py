@@ -0,0 +1,32 @@
+# Generated by Django 5.2.5 on 2026-10-17 01:27
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_message_chat_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReplyJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('ai_message', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='app.message')),
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='reply_job', to='app.message')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_after'], name='replyjob_status_run_after_idx')],
+            },
+        ),
+    ]
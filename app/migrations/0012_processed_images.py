@@ -0,0 +1,29 @@
+# Generated by Django 5.2.5 on 2026-10-17 01:39
+
+import app.images
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='image',
+            field=app.images.ProcessedImageField(blank=True, null=True, upload_to='chat_images'),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='image',
+            field=app.images.ProcessedImageField(blank=True, default='default.jpg', null=True, upload_to='profile_pics'),
+        ),
+        migrations.AlterField(
+            model_name='storymessage',
+            name='image',
+            field=app.images.ProcessedImageField(blank=True, null=True, upload_to='story_images'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Full-text index of message content, see app/search.py.
+
+from django.db import migrations
+
+
+def create_index(apps, schema_editor):
+    from app import search
+
+    if not search.available(schema_editor.connection):
+        return
+    connection = schema_editor.connection
+    messages = apps.get_model('app', 'Message').objects.using(connection.alias)
+    search.rebuild(messages.values_list('pk', 'chat_id', 'content').iterator(chunk_size=2000), using=connection)
+
+
+def drop_index(apps, schema_editor):
+    from app import search
+
+    if search.available(schema_editor.connection):
+        schema_editor.execute(f'DROP TABLE IF EXISTS {search.TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_processed_images'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
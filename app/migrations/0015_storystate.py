@@ -0,0 +1,32 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:14
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_idempotencykey'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoryState',
+            fields=[
+                ('story', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='state', serialize=False, to='app.story')),
+                ('characters', models.JSONField(blank=True, default=dict)),
+                ('plot_summary', models.TextField(blank=True, default='')),
+                ('beats', models.JSONField(blank=True, default=list)),
+                ('summarized_up_to', models.PositiveBigIntegerField(default=0)),
+                ('turns', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='storymessage',
+            index=models.Index(fields=['story', 'timestamp'], name='storymessage_story_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:17
+
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max
+from django.db.models.functions import TruncDate
+
+
+def fill_stats(apps, schema_editor):
+    # The same two GROUP BY queries as app.activity.rebuild, on the models of this migration.
+    using = schema_editor.connection.alias
+    ActivityStats = apps.get_model('app', 'ActivityStats')
+    DailyActivity = apps.get_model('app', 'DailyActivity')
+    grouped = apps.get_model('app', 'Message').objects.using(using).order_by().values('chat__user_id', 'ai')
+
+    totals = defaultdict(lambda: [0, 0, None])
+    for row in grouped.annotate(count=Count('id'), last=Max('timestamp')):
+        user = totals[row['chat__user_id']]
+        user[1 if row['ai'] else 0] = row['count']
+        if not row['ai']:
+            user[2] = row['last']
+    days = defaultdict(lambda: [0, 0])
+    for row in grouped.annotate(day=TruncDate('timestamp'), count=Count('id')):
+        days[row['chat__user_id'], row['day']][1 if row['ai'] else 0] = row['count']
+
+    ActivityStats.objects.using(using).bulk_create(
+        (
+            ActivityStats(user_id=user_id, messages=sent, ai_replies=ai_replies, last_active_at=last)
+            for user_id, (sent, ai_replies, last) in totals.items()
+        ),
+        batch_size=2000,
+    )
+    DailyActivity.objects.using(using).bulk_create(
+        (
+            DailyActivity(user_id=user_id, date=date, messages=sent, ai_replies=ai_replies)
+            for (user_id, date), (sent, ai_replies) in days.items()
+        ),
+        batch_size=2000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_storystate'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='activity', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('messages', models.PositiveIntegerField(default=0)),
+                ('ai_replies', models.PositiveIntegerField(default=0)),
+                ('last_active_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailyActivity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('messages', models.PositiveIntegerField(default=0)),
+                ('ai_replies', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'date'), name='dailyactivity_user_date_uniq')],
+            },
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
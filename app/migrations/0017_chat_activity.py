@@ -0,0 +1,55 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:23
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+
+
+def fill_chats(apps, schema_editor):
+    # The same UPDATE as app.activity.rebuild_chats, on the models of this migration.
+    using = schema_editor.connection.alias
+    Message = apps.get_model('app', 'Message')
+    latest = Message.objects.using(using).filter(chat=OuterRef('pk')).order_by('-timestamp', '-id')
+    counts = Message.objects.using(using).filter(chat=OuterRef('pk')).order_by().values('chat').annotate(count=Count('id'))
+    apps.get_model('app', 'Chat').objects.using(using).update(
+        message_count=Coalesce(Subquery(counts.values('count'), output_field=IntegerField()), Value(0)),
+        last_message_preview=Coalesce(Substr(Subquery(latest.values('content')[:1]), 1, 200), Value('')),
+        last_activity_at=Coalesce(Subquery(latest.values('timestamp')[:1]), F('created_at')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_activity_stats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chat',
+            name='chat_user_created_idx',
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='chat',
+            index=models.Index(fields=['user', 'last_activity_at'], name='chat_user_activity_idx'),
+        ),
+        migrations.RunPython(fill_chats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:31
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0018_sync_changes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='archived_up_to',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ArchivedSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_id', models.PositiveBigIntegerField()),
+                ('last_id', models.PositiveBigIntegerField()),
+                ('count', models.PositiveIntegerField()),
+                ('raw_bytes', models.PositiveIntegerField()),
+                ('compressed_bytes', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_segments', to='app.chat')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['chat', 'first_id'], name='segment_chat_first_idx')],
+            },
+        ),
+    ]
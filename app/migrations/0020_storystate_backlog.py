@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-17 02:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_message_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storystate',
+            name='backlog_up_to',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
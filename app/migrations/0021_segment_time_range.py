@@ -0,0 +1,47 @@
+# Generated by Django 5.2.5 on 2026-10-17 09:12
+
+import json
+import zlib
+from datetime import datetime
+
+from django.db import migrations, models
+
+
+def fill_time_ranges(apps, schema_editor):
+    # Segments are zlib-compressed JSON rows ending with the message's ISO timestamp (app/archive.py).
+    ArchivedSegment = apps.get_model('app', 'ArchivedSegment')
+    segments = ArchivedSegment.objects.using(schema_editor.connection.alias)
+    for segment in segments.only('pk', 'data').iterator(chunk_size=100):
+        timestamps = [datetime.fromisoformat(row[-1]) for row in json.loads(zlib.decompress(segment.data))]
+        segments.filter(pk=segment.pk).update(first_at=min(timestamps), last_at=max(timestamps))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0020_storystate_backlog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedsegment',
+            name='first_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='archivedsegment',
+            name='last_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(fill_time_ranges, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='archivedsegment',
+            name='first_at',
+            field=models.DateTimeField(),
+        ),
+        migrations.AlterField(
+            model_name='archivedsegment',
+            name='last_at',
+            field=models.DateTimeField(),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Rebuilds the full-text index with the chat of each message, and with the messages
+# of archived chats, which the index now keeps; see app/search.py.
+
+from itertools import chain
+
+from django.db import migrations
+
+
+def rebuild_index(apps, schema_editor):
+    from app import archive, search
+
+    connection = schema_editor.connection
+    if not search.available(connection):
+        return
+    messages = apps.get_model('app', 'Message').objects.using(connection.alias)
+    segments = apps.get_model('app', 'ArchivedSegment').objects.using(connection.alias)
+    rows = chain(messages.values_list('pk', 'chat_id', 'content').iterator(chunk_size=2000), archive.index_rows(segments))
+    search.rebuild(rows, using=connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0021_segment_time_range'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_index, migrations.RunPython.noop),
+    ]
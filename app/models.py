@@ -1,7 +1,10 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
 
+from .images import ProcessedImageField
+
 class Profile(models.Model):
     GENDER_CHOICES = [('male', 'male'), ('female', 'female')]
 
@@ -9,7 +12,7 @@ class Profile(models.Model):
     is_parent = models.BooleanField(default=False)
     sons = models.ManyToManyField(User, related_name='parent_profiles', blank=True)
 
-    image = models.ImageField(default='default.jpg', upload_to='profile_pics', null=True, blank=True)
+    image = ProcessedImageField(default='default.jpg', upload_to='profile_pics', null=True, blank=True)
     bio = models.TextField(max_length=500, blank=True, null=True, default="")
     age = models.PositiveIntegerField(null=True, blank=True, default=None)
     gender = models.CharField(max_length=6, choices=GENDER_CHOICES, null=True, blank=True, default=None)
@@ -23,6 +26,28 @@ class Chat(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chats')
     chat_name = models.CharField(max_length=100, default="New Chat")
     created_at = models.DateTimeField(default=timezone.now)
+    # Rolling summary of the older turns that no longer fit in the prompt (see app/context.py).
+    summary = models.TextField(blank=True, default="")
+    summarized_up_to = models.PositiveBigIntegerField(default=0)  # ID of the last summarized message
+    # Set to False to always get a fresh reply instead of one from the reply cache.
+    cache_replies = models.BooleanField(default=True)
+    # Kept in step with the chat's messages by app/activity.py, so the chat list needs no message queries.
+    last_message_preview = models.CharField(max_length=200, blank=True, default="")
+    last_activity_at = models.DateTimeField(default=timezone.now)  # newest message, or creation while empty
+    message_count = models.PositiveIntegerField(default=0)
+    # ID of the newest message moved to ArchivedSegment rows (see app/archive.py); 0 when none are.
+    archived_up_to = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Serves the chat list: a user's chats, most recently active first.
+            models.Index(fields=["user", "last_activity_at"], name="chat_user_activity_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and not self.message_count:
+            self.last_activity_at = self.created_at
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.chat_name
@@ -32,9 +57,17 @@ class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name="messages")
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True) 
     ai = models.BooleanField(default=False)
-    image = models.ImageField(upload_to='chat_images', null=True, blank=True)
+    image = ProcessedImageField(upload_to='chat_images', null=True, blank=True)
     content = models.TextField(default="")
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, so imported history keeps its original times (auto_now_add
+    # would overwrite them in bulk_create). editable=False keeps it read-only in the API.
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            # Serves the paginated message list of one chat, newest first.
+            models.Index(fields=["chat", "timestamp"], name="message_chat_timestamp_idx"),
+        ]
 
     def __str__(self):
         if self.ai:
@@ -42,6 +75,142 @@ class Message(models.Model):
         return f'{self.user.username}: {self.content[:30]}...'
 
 
+class ReplyJob(models.Model):
+    """A queued AI reply to `message`, processed by `manage.py run_reply_worker`."""
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    STATUS_CHOICES = [(PENDING, 'pending'), (RUNNING, 'running'), (DONE, 'done'), (FAILED, 'failed')]
+
+    message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name='reply_job')
+    ai_message = models.OneToOneField(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # Serves the worker's "next due job" lookup.
+            models.Index(fields=["status", "run_after"], name="replyjob_status_run_after_idx"),
+        ]
+
+    def __str__(self):
+        return f'Reply job {self.pk} ({self.status})'
+
+
+class IdempotencyKey(models.Model):
+    """
+    The response to a request sent with an `Idempotency-Key` header, replayed to
+    retries of that request (see app/idempotency.py). `status_code` is None while
+    the first request is still being processed.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)  # SHA-256 of the method, path and data
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            # Keys are chosen by clients, so they are only unique per user.
+            models.UniqueConstraint(fields=["user", "key"], name="idempotencykey_user_key_uniq"),
+        ]
+        indexes = [
+            # Serves the purge of expired keys.
+            models.Index(fields=["created_at"], name="idempotencykey_created_idx"),
+        ]
+
+    def __str__(self):
+        return f'Idempotency key {self.key} ({self.status_code or "in progress"})'
+
+
+class ActivityStats(models.Model):
+    """
+    Running totals of a user's chat activity, shown to their parents (see app/activity.py).
+    Kept up to date as messages are saved and deleted; `manage.py rebuild_activity_stats`
+    recomputes them from the messages.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='activity', primary_key=True)
+    messages = models.PositiveIntegerField(default=0)  # sent by the user
+    ai_replies = models.PositiveIntegerField(default=0)  # AI messages in the user's chats
+    last_active_at = models.DateTimeField(null=True, blank=True)  # newest message sent by the user
+
+    def __str__(self):
+        return f'{self.user_id} activity'
+
+
+class DailyActivity(models.Model):
+    """The same counts as ActivityStats for one day (in settings.TIME_ZONE)."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    date = models.DateField()
+    messages = models.PositiveIntegerField(default=0)
+    ai_replies = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also serves the dashboard's "these users, these days" lookup.
+            models.UniqueConstraint(fields=["user", "date"], name="dailyactivity_user_date_uniq"),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} activity on {self.date}'
+
+
+class ArchivedSegment(models.Model):
+    """
+    Messages of an inactive chat moved out of the Message table by `manage.py archive_messages`:
+    up to ARCHIVE_SEGMENT_SIZE rows as zlib-compressed JSON (see app/archive.py).
+    """
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='archived_segments')
+    first_id = models.PositiveBigIntegerField()  # message ID range of the segment
+    last_id = models.PositiveBigIntegerField()
+    first_at = models.DateTimeField()  # timestamp range, which message pages are ordered by
+    last_at = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    raw_bytes = models.PositiveIntegerField()  # size of the JSON before compression
+    compressed_bytes = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chat", "first_id"], name="segment_chat_first_idx"),
+        ]
+
+    def __str__(self):
+        return f'Messages {self.first_id}-{self.last_id} of chat {self.chat_id}'
+
+
+class SyncChange(models.Model):
+    """
+    One change to a user's chats or messages, for delta sync (see app/sync.py).
+    The id, which only grows, is the sync token handed to clients.
+    """
+    CHAT = 'chat'
+    MESSAGE = 'message'
+    KIND_CHOICES = [(CHAT, 'chat'), (MESSAGE, 'message')]
+
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    kind = models.CharField(max_length=7, choices=KIND_CHOICES)
+    object_id = models.PositiveBigIntegerField()
+    chat_id = models.PositiveBigIntegerField()  # the chat itself, or the message's chat
+    deleted = models.BooleanField(default=False)  # a tombstone
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # Serves "this user's changes after token N" and the user's latest change.
+            models.Index(fields=["user", "id"], name="syncchange_user_id_idx"),
+            models.Index(fields=["created_at"], name="syncchange_created_idx"),
+        ]
+
+    def __str__(self):
+        return f'{"Deleted" if self.deleted else "Changed"} {self.kind} {self.object_id}'
+
+
 class Te_status(models.Model):
     # تم تغيير العلاقة إلى OneToOneField لضمان حالة واحدة لكل مستخدم.
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='status')
@@ -63,11 +232,36 @@ class StoryMessage(models.Model):
     story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name="messages")
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True) 
     ai = models.BooleanField(default=False)
-    image = models.ImageField(upload_to='story_images', null=True, blank=True)
+    image = ProcessedImageField(upload_to='story_images', null=True, blank=True)
     content = models.TextField(default="")
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Serves the paginated message list of one story, newest first.
+            models.Index(fields=["story", "timestamp"], name="storymessage_story_ts_idx"),
+        ]
+
     def __str__(self):
         if self.ai:
             return f'AI: {self.content[:30]}...'
-        return f'{self.user.username}: {self.content[:30]}...'
\ No newline at end of file
+        return f'{self.user.username}: {self.content[:30]}...'
+
+class StoryState(models.Model):
+    """
+    What the model remembers about a story (see app/stories.py): its characters,
+    a summary of the plot so far and the latest beats verbatim. It is updated
+    after every turn, so prompts never resend the whole story.
+    """
+    story = models.OneToOneField(Story, on_delete=models.CASCADE, related_name='state', primary_key=True)
+    characters = models.JSONField(default=dict, blank=True)  # name -> short description
+    plot_summary = models.TextField(blank=True, default="")
+    beats = models.JSONField(default=list, blank=True)  # [[message id, ai, content], ...] oldest first
+    summarized_up_to = models.PositiveBigIntegerField(default=0)  # ID of the last StoryMessage in the summary
+    # Older messages up to this ID are still to be folded into the summary; 0 when none are.
+    backlog_up_to = models.PositiveBigIntegerField(default=0)
+    turns = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'State of {self.story}'
@@ -0,0 +1,89 @@
+from datetime import datetime
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+
+from .archive import ArchivedMessages
+
+
+class MessageCursorPagination(CursorPagination):
+    """
+    Newest messages first; the `next` link loads older ones.
+    Cursor pages seek on the (chat, timestamp) index, so a page costs the same
+    whether the chat has ten messages or a hundred thousand.
+    """
+    ordering = ("-timestamp", "-id")
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+    links = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if isinstance(queryset, ArchivedMessages):
+            return self.paginate_archive(queryset, request)
+        self.links = None
+        return super().paginate_queryset(queryset, request, view)
+
+    def paginate_archive(self, messages, request):
+        """
+        Cursor pages over archived messages (see app/archive.py), read one window at
+        a time. Cursors hold the (timestamp, id) of the page edge.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        cursor = self.decode_cursor(request)
+        edge = None
+        if cursor is not None:
+            try:
+                timestamp, pk = cursor.position.split("|")
+                edge = (datetime.fromisoformat(timestamp), int(pk))
+                if edge[0].tzinfo is None:
+                    raise ValueError
+            except (AttributeError, ValueError):
+                raise NotFound(self.invalid_cursor_message)
+        reverse = cursor is not None and cursor.reverse
+        # One message more than the page tells whether there is another page.
+        page = messages.window(edge, reverse, self.page_size + 1)
+        has_more = len(page) > self.page_size
+        page = page[:self.page_size]
+        if reverse:
+            page.reverse()
+        has_next, has_previous = (True, has_more) if reverse else (has_more, cursor is not None)
+        next_link = previous_link = None
+        if page and has_next:
+            next_link = self.encode_cursor(Cursor(offset=0, reverse=False, position=self.edge(page[-1])))
+        if page and has_previous:
+            previous_link = self.encode_cursor(Cursor(offset=0, reverse=True, position=self.edge(page[0])))
+        self.links = (next_link, previous_link)
+        return page
+
+    @staticmethod
+    def edge(message):
+        return f"{message.timestamp.isoformat()}|{message.pk}"
+
+    def get_next_link(self):
+        return self.links[0] if self.links else super().get_next_link()
+
+    def get_previous_link(self):
+        return self.links[1] if self.links else super().get_previous_link()
+
+
+class ChatCursorPagination(CursorPagination):
+    """
+    Most recently active chats first, on the (user, last_activity_at) index.
+    A chat that gets a message while the list is paged moves to the top, so it can
+    be missed by the pages after it; reload from the first page to see it.
+    """
+    ordering = ("-last_activity_at", "-id")
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+
+
+class StoryCursorPagination(CursorPagination):
+    """Newest stories first."""
+    ordering = ("-created_at", "-id")
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+from .models import Te_status
+
+DEFAULT_PERSONA = "شخصية ودودة ومرحة"
+
+
+def cache_key(user_id):
+    return f"persona:{user_id}"
+
+
+def get_persona(user_id):
+    """
+    Returns the user's persona prompt, or the default persona.
+    The value is cached per user, including the absence of a Te_status, and kept
+    fresh by the Te_status signals in app/signals.py.
+    """
+    persona = cache.get(cache_key(user_id))
+    metrics.record_cache_lookup("personas", persona is not None)
+    if persona is None:
+        persona = Te_status.objects.filter(user_id=user_id).values_list("persona_prompt", flat=True).first()
+        # "" marks "no persona", so users without one are cached too.
+        persona = persona or ""
+        cache.set(cache_key(user_id), persona, settings.PERSONA_CACHE_TTL)
+    return persona or DEFAULT_PERSONA
+
+
+async def aget_persona(user_id):
+    """Async version of `get_persona`."""
+    persona = await cache.aget(cache_key(user_id))
+    metrics.record_cache_lookup("personas", persona is not None)
+    if persona is None:
+        persona = await Te_status.objects.filter(user_id=user_id).values_list("persona_prompt", flat=True).afirst()
+        persona = persona or ""
+        await cache.aset(cache_key(user_id), persona, settings.PERSONA_CACHE_TTL)
+    return persona or DEFAULT_PERSONA
+
+
+def set_persona(user_id, persona):
+    cache.set(cache_key(user_id), persona or "", settings.PERSONA_CACHE_TTL)
+
+
+def forget_persona(user_id):
+    cache.delete(cache_key(user_id))
@@ -0,0 +1,247 @@
+import asyncio
+import math
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.exceptions import Throttled
+
+from . import metrics
+
+GLOBAL_KEY = "llm-limit:global"
+POLL_SECONDS = 0.05
+# A lock left behind by a crashed process expires after this many seconds.
+LOCK_SECONDS = 2
+# Queued requests refresh their entry on every poll; entries of requests that
+# stopped polling (client gone, worker killed) are dropped after this.
+QUEUE_HEARTBEAT_SECONDS = 2
+
+
+def get_cache():
+    return caches[settings.LLM_LIMITS_CACHE_ALIAS]
+
+
+def user_key(user_id):
+    return f"llm-limit:user:{user_id}"
+
+
+def lease_seconds():
+    """Slots of crashed workers are freed after this; a generation never runs past LLM_TIMEOUT."""
+    return settings.LLM_TIMEOUT * 2 + 10
+
+
+def user_state_timeout():
+    """A user's state can be dropped once their bucket is full again and every slot has expired."""
+    rate = settings.LLM_USER_RATE
+    return math.ceil(max(lease_seconds(), settings.LLM_USER_BURST * 60 / rate if rate else 0)) + 1
+
+
+def reset():
+    """Forgets all buckets, slots and queued requests (for tests)."""
+    get_cache().clear()
+
+
+@contextmanager
+def locked(key):
+    """
+    Serializes read-modify-write cycles on `key` across workers, using the cache's
+    add(), which only one caller can win. Shared backends (Redis, Memcached, the
+    database cache) make the limits global; with LocMemCache they are per process.
+    """
+    cache = get_cache()
+    lock_key, token = f"{key}:lock", uuid.uuid4().hex
+    while not cache.add(lock_key, token, LOCK_SECONDS):
+        time.sleep(0.002)
+    try:
+        yield cache
+    finally:
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
+
+def refuse(reason, wait, detail):
+    metrics.LLM_REJECTIONS.inc(reason)
+    raise Throttled(wait=wait, detail=detail)
+
+
+# --------------------------------------------------------------------------------
+# PER-USER TOKEN BUCKET AND IN-FLIGHT CAP
+# --------------------------------------------------------------------------------
+def admit_user(user_id, concurrent):
+    """
+    Takes a token from the user's bucket (LLM_USER_RATE replies per minute, bursts
+    of LLM_USER_BURST) and, when `concurrent`, one of their LLM_USER_CONCURRENCY
+    in-flight slots. Returns the slot id, or None when no slot was taken.
+    """
+    rate, burst = settings.LLM_USER_RATE, settings.LLM_USER_BURST
+    cap = settings.LLM_USER_CONCURRENCY if concurrent else None
+    if not rate and not cap:
+        return None
+    key = user_key(user_id)
+    now = time.time()
+    with locked(key) as cache:
+        state = cache.get(key) or {"tokens": burst, "at": now, "leases": {}}
+        leases = {lease: expires for lease, expires in state["leases"].items() if expires > now}
+        if cap and len(leases) >= cap:
+            refuse("user_concurrency", 1, f"Only {cap} replies can be generated for you at a time.")
+        tokens = state["tokens"]
+        if rate:
+            tokens = min(burst, tokens + (now - state["at"]) * rate / 60)
+            if tokens < 1:
+                refuse("user_rate", (1 - tokens) * 60 / rate, "Too many messages; wait a little before sending more.")
+            tokens -= 1
+        lease = None
+        if cap:
+            lease = uuid.uuid4().hex
+            leases[lease] = now + lease_seconds()
+        cache.set(key, {"tokens": tokens, "at": now, "leases": leases}, user_state_timeout())
+    return lease
+
+
+def release_user(user_id, lease, refund):
+    key = user_key(user_id)
+    with locked(key) as cache:
+        state = cache.get(key)
+        if state is None:
+            return
+        state["leases"].pop(lease, None)
+        if refund and settings.LLM_USER_RATE:
+            state["tokens"] = min(settings.LLM_USER_BURST, state["tokens"] + 1)
+        cache.set(key, state, user_state_timeout())
+
+
+# --------------------------------------------------------------------------------
+# GLOBAL CONCURRENCY CEILING WITH A FAIR QUEUE
+# --------------------------------------------------------------------------------
+def fair_order(queue):
+    """
+    Queued tickets in admission order: every user's oldest waiting request goes
+    before anyone's second one, so a user with many requests queued cannot
+    starve the others. Ties are broken by arrival.
+    """
+    seen = Counter()
+    ranked = []
+    for ticket, (user_id, enqueued_at, _) in sorted(queue.items(), key=lambda item: item[1][1]):
+        ranked.append((seen[user_id], enqueued_at, ticket))
+        seen[user_id] += 1
+    return [ticket for *_, ticket in sorted(ranked)]
+
+
+def take_slot(ticket, user_id):
+    """
+    Takes one of the LLM_CONCURRENCY global slots for `ticket` when it is its turn,
+    queueing it otherwise. Returns True once the slot is taken.
+    """
+    now = time.time()
+    with locked(GLOBAL_KEY) as cache:
+        state = cache.get(GLOBAL_KEY) or {"leases": {}, "queue": {}}
+        leases = {lease: expires for lease, expires in state["leases"].items() if expires > now}
+        queue = {t: entry for t, entry in state["queue"].items() if entry[2] > now}
+        free = settings.LLM_CONCURRENCY - len(leases)
+        if ticket not in queue and free <= len(queue) and len(queue) >= settings.LLM_QUEUE_SIZE:
+            refuse("queue_full", settings.LLM_QUEUE_TIMEOUT, "The assistant is busy; try again shortly.")
+        enqueued_at = queue[ticket][1] if ticket in queue else now
+        queue[ticket] = (user_id, enqueued_at, now + QUEUE_HEARTBEAT_SECONDS)
+        granted = ticket in fair_order(queue)[:max(free, 0)]
+        if granted:
+            del queue[ticket]
+            leases[ticket] = now + lease_seconds()
+        cache.set(GLOBAL_KEY, {"leases": leases, "queue": queue}, math.ceil(lease_seconds()) + 1)
+    return granted
+
+
+def release_slot(ticket):
+    """Frees the global slot of `ticket`, or takes it out of the queue."""
+    with locked(GLOBAL_KEY) as cache:
+        state = cache.get(GLOBAL_KEY)
+        if state is None:
+            return
+        state["leases"].pop(ticket, None)
+        state["queue"].pop(ticket, None)
+        cache.set(GLOBAL_KEY, state, math.ceil(lease_seconds()) + 1)
+
+
+# --------------------------------------------------------------------------------
+# PUBLIC API
+# --------------------------------------------------------------------------------
+@dataclass
+class Lease:
+    """
+    Permission to generate one reply. Release it when the reply is done,
+    or use it as a context manager.
+    """
+    user_id: int
+    user_lease: str = None
+    slot: str = None
+    released: bool = False
+
+    def release(self, refund=False):
+        """Frees the slots; `refund` gives the token back (for requests that were refused)."""
+        if self.released:
+            return
+        self.released = True
+        if self.slot is not None:
+            release_slot(self.slot)
+        if self.user_lease is not None or refund:
+            release_user(self.user_id, self.user_lease, refund)
+
+    async def arelease(self, refund=False):
+        await sync_to_async(self.release, thread_sensitive=False)(refund)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def acquire(user_id, concurrent=True):
+    """
+    Returns a Lease for generating a reply for `user_id`, or raises DRF's Throttled
+    (429 with Retry-After). `concurrent=False` only takes a token from the user's
+    bucket, for replies generated later by the job worker. Otherwise the request
+    waits up to LLM_QUEUE_TIMEOUT seconds for one of the LLM_CONCURRENCY slots.
+    """
+    lease = Lease(user_id, admit_user(user_id, concurrent))
+    if not concurrent or not settings.LLM_CONCURRENCY:
+        return lease
+    ticket = uuid.uuid4().hex
+    start = time.monotonic()
+    try:
+        while not take_slot(ticket, user_id):
+            if time.monotonic() - start >= settings.LLM_QUEUE_TIMEOUT:
+                release_slot(ticket)
+                refuse("queue_timeout", settings.LLM_QUEUE_TIMEOUT, "The assistant is busy; try again shortly.")
+            time.sleep(POLL_SECONDS)
+    except Throttled:
+        lease.release(refund=True)
+        raise
+    metrics.LLM_QUEUE_SECONDS.observe(time.monotonic() - start)
+    lease.slot = ticket
+    return lease
+
+
+async def aacquire(user_id):
+    """Async version of `acquire`; waits in the queue without blocking the event loop."""
+    lease = Lease(user_id, await sync_to_async(admit_user, thread_sensitive=False)(user_id, True))
+    if not settings.LLM_CONCURRENCY:
+        return lease
+    ticket = uuid.uuid4().hex
+    start = time.monotonic()
+    try:
+        while not await sync_to_async(take_slot, thread_sensitive=False)(ticket, user_id):
+            if time.monotonic() - start >= settings.LLM_QUEUE_TIMEOUT:
+                await sync_to_async(release_slot, thread_sensitive=False)(ticket)
+                refuse("queue_timeout", settings.LLM_QUEUE_TIMEOUT, "The assistant is busy; try again shortly.")
+            await asyncio.sleep(POLL_SECONDS)
+    except Throttled:
+        await lease.arelease(refund=True)
+        raise
+    metrics.LLM_QUEUE_SECONDS.observe(time.monotonic() - start)
+    lease.slot = ticket
+    return lease
@@ -0,0 +1,54 @@
+import csv
+import io
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+
+class ServerSentEventRenderer(BaseRenderer):
+    """
+    Lets clients send `Accept: text/event-stream` to streaming actions.
+    Successful streams are StreamingHttpResponses and skip rendering; anything
+    rendered here is an error response, sent as a single `error` event.
+    """
+    media_type = "text/event-stream"
+    format = "sse"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        payload = json.dumps(data, ensure_ascii=False)
+        return f"event: error\ndata: {payload}\n\n".encode(self.charset)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Exports are StreamingHttpResponses and skip rendering;
+    anything rendered here is an error response, sent as a single line.
+    """
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return (json.dumps(data, ensure_ascii=False) + "\n").encode(self.charset)
+
+
+class CSVRenderer(BaseRenderer):
+    """Like `NDJSONRenderer`, error responses are rendered as `field,detail` rows."""
+    media_type = "text/csv"
+    format = "csv"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        items = data.items() if isinstance(data, dict) else [("detail", data)]
+        for field, detail in items:
+            writer.writerow((field, detail))
+        return buffer.getvalue().encode(self.charset)
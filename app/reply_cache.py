@@ -0,0 +1,102 @@
+import hashlib
+import re
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+# Arabic harakat, tanween, shadda, sukun, superscript alef and other combining marks.
+ARABIC_DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed]")
+TATWEEL = "\u0640"
+WHITESPACE = re.compile(r"\s+")
+
+HITS_KEY = "reply-cache:hits"
+MISSES_KEY = "reply-cache:misses"
+
+
+def get_cache():
+    return caches[settings.LLM_REPLY_CACHE_ALIAS]
+
+
+def normalize_prompt(prompt):
+    """Strips Arabic diacritics and tatweel and collapses whitespace, so trivial variants share a key."""
+    prompt = ARABIC_DIACRITICS.sub("", prompt).replace(TATWEEL, "")
+    return WHITESPACE.sub(" ", prompt).strip()
+
+
+def make_key(persona, prompt, images=()):
+    """
+    Cache key scoped to the persona, so personas never see each other's replies.
+    Attached images are part of the key through their content digests.
+    """
+    persona_digest = hashlib.sha256((persona or "").encode()).hexdigest()[:16]
+    prompt_digest = hashlib.sha256(
+        "\n".join([normalize_prompt(prompt), *(image.digest for image in images)]).encode()
+    ).hexdigest()
+    return f"reply:{persona_digest}:{prompt_digest}"
+
+
+def _count(key):
+    cache = get_cache()
+    # add() is a no-op when the counter exists; incr() is atomic on shared backends.
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The counter was evicted between add() and incr().
+        cache.set(key, 1, timeout=None)
+
+
+async def _acount(key):
+    """Async version of `_count`."""
+    cache = get_cache()
+    await cache.aadd(key, 0, timeout=None)
+    try:
+        await cache.aincr(key)
+    except ValueError:
+        await cache.aset(key, 1, timeout=None)
+
+
+def get_or_generate(persona, prompt, generate, images=()):
+    """
+    Returns the cached reply for (persona, prompt, images), or calls `generate(prompt, images)`
+    and caches its result. Exceptions from `generate` propagate, so failures are never cached.
+    """
+    reply = lookup(persona, prompt, images)
+    if reply is None:
+        reply = generate(prompt, images)
+        store(persona, prompt, reply, images)
+    return reply
+
+
+async def aget_or_generate(persona, prompt, agenerate, images=()):
+    """Async version of `get_or_generate`."""
+    key = make_key(persona, prompt, images)
+    reply = await get_cache().aget(key)
+    metrics.record_cache_lookup("replies", reply is not None)
+    if reply is not None:
+        await _acount(HITS_KEY)
+        return reply
+    await _acount(MISSES_KEY)
+    reply = await agenerate(prompt, images)
+    await get_cache().aset(key, reply)
+    return reply
+
+
+def lookup(persona, prompt, images=()):
+    """Returns the cached reply or None, counting the hit or miss."""
+    reply = get_cache().get(make_key(persona, prompt, images))
+    metrics.record_cache_lookup("replies", reply is not None)
+    _count(MISSES_KEY if reply is None else HITS_KEY)
+    return reply
+
+
+def store(persona, prompt, reply, images=()):
+    get_cache().set(make_key(persona, prompt, images), reply)
+
+
+def stats():
+    """Hit/miss counters since the cache was last cleared."""
+    counters = get_cache().get_many([HITS_KEY, MISSES_KEY])
+    return {"hits": counters.get(HITS_KEY, 0), "misses": counters.get(MISSES_KEY, 0)}
@@ -0,0 +1,47 @@
+import contextvars
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# True while a read-heavy endpoint is running; see `reading_from_replica`.
+_use_replica = contextvars.ContextVar("use_replica", default=False)
+
+
+@contextmanager
+def reading_from_replica():
+    """Sends the ORM reads made inside the block to a replica, when any is configured."""
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def replica_alias():
+    """A random replica alias, or "default" without replicas."""
+    return random.choice(settings.DATABASE_REPLICAS) if settings.DATABASE_REPLICAS else "default"
+
+
+class ReplicaRouter:
+    """
+    Reads go to a replica only inside `reading_from_replica()`, i.e. the list
+    endpoints, which can tolerate a little replication lag. Everything else,
+    including every write and any read that must see its own writes, uses
+    the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and settings.DATABASE_REPLICAS:
+            return random.choice(settings.DATABASE_REPLICAS)
+        return None
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary.
+        databases = {"default", *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
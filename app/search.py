@@ -0,0 +1,178 @@
+import re
+
+from django.db import connection, transaction
+from django.utils.html import escape
+
+from .reply_cache import ARABIC_DIACRITICS, TATWEEL
+
+# FTS5 table holding the normalized text of every message, archived ones included;
+# its rowid is the message id.
+TABLE = "app_message_fts"
+
+ALEF_VARIANTS = re.compile("[\u0622\u0623\u0625\u0671]")  # آ أ إ ٱ
+TERM = re.compile(r"\w+")
+
+# Private-use characters mark the matches in the indexed text, which `snippet` moves
+# onto the message as written before HTML-escaping it.
+MARK_START, MARK_END = "\ue000", "\ue001"
+SNIPPET_WORDS = 12  # words of a message shown around its matches
+
+
+def normalize_arabic(text):
+    """
+    Folds the spelling variants people mix freely when typing Arabic:
+    diacritics and tatweel are dropped, أ/إ/آ become ا, ى becomes ي and ة becomes ه.
+    Both the index and the queries go through this.
+    """
+    text = ARABIC_DIACRITICS.sub("", text).replace(TATWEEL, "")
+    text = ALEF_VARIANTS.sub("ا", text)
+    return text.replace("ى", "ي").replace("ة", "ه")
+
+
+def available(using=connection):
+    """The index needs SQLite's FTS5; other databases fall back to a plain scan."""
+    return using.vendor == "sqlite"
+
+
+def create_table(cursor):
+    cursor.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} "
+        "USING fts5(content, chat_id UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+    )
+
+
+def index_messages(messages):
+    """Adds or refreshes `messages` in the index."""
+    if not available():
+        return
+    rows = [(message.pk, normalize_arabic(message.content), message.chat_id) for message in messages]
+    if rows:
+        with connection.cursor() as cursor:
+            cursor.executemany(f"INSERT OR REPLACE INTO {TABLE} (rowid, content, chat_id) VALUES (%s, %s, %s)", rows)
+
+
+def unindex_messages(ids):
+    if not available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {TABLE} WHERE rowid = %s", [(pk,) for pk in ids])
+
+
+def unindex_chat(chat_id):
+    """
+    Drops every message of a chat from the index before the chat is deleted: one
+    statement for its Message rows, and one rowid range per archived segment.
+    """
+    if not available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {TABLE} WHERE rowid IN (SELECT id FROM app_message WHERE chat_id = %s)", [chat_id])
+        cursor.execute("SELECT first_id, last_id FROM app_archivedsegment WHERE chat_id = %s", [chat_id])
+        ranges = [(first_id, last_id, chat_id) for first_id, last_id in cursor.fetchall()]
+        cursor.executemany(f"DELETE FROM {TABLE} WHERE rowid BETWEEN %s AND %s AND chat_id = %s", ranges)
+
+
+def rebuild(rows, batch_size=2000, using=connection):
+    """
+    Recreates the index from `(id, chat_id, content)` rows and returns the number of
+    indexed messages; see `manage.py rebuild_search_index`.
+    """
+    total = 0
+    # One transaction, so searches keep using the old index until the new one is complete.
+    with transaction.atomic(using=using.alias), using.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        create_table(cursor)
+        batch = []
+        for pk, chat_id, content in rows:
+            batch.append((pk, normalize_arabic(content), chat_id))
+            if len(batch) >= batch_size:
+                cursor.executemany(f"INSERT INTO {TABLE} (rowid, content, chat_id) VALUES (%s, %s, %s)", batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            cursor.executemany(f"INSERT INTO {TABLE} (rowid, content, chat_id) VALUES (%s, %s, %s)", batch)
+            total += len(batch)
+    return total
+
+
+def match_expression(query):
+    """
+    Turns free text into an FTS5 query matching messages that contain every word.
+    Each word is quoted, so FTS5 operators typed by users are searched literally.
+    """
+    terms = TERM.findall(normalize_arabic(query))
+    return " ".join(f'"{term}"' for term in terms)
+
+
+def search(user, query, chat_id=None, limit=20, offset=0):
+    """
+    Returns `[(message_id, marked), ...]` for `user`'s messages matching `query`,
+    archived ones included, best bm25 rank first. `marked` is the indexed text with
+    the matches between MARK_START and MARK_END; see `snippet`.
+    """
+    expression = match_expression(query)
+    if not expression:
+        return []
+    sql = f"""
+        SELECT rowid, highlight({TABLE}, 0, %s, %s)
+        FROM {TABLE}
+        WHERE {TABLE} MATCH %s AND chat_id IN (SELECT id FROM app_chat WHERE user_id = %s)
+    """
+    params = [MARK_START, MARK_END, expression, user.pk]
+    if chat_id is not None:
+        sql += " AND chat_id = %s"
+        params.append(int(chat_id))
+    sql += f" ORDER BY bm25({TABLE}) LIMIT %s OFFSET %s"
+    params += [limit, offset]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def match_spans(content, marked):
+    """
+    Where the matches of `marked` (see `search`) are in `content`, as `[(start, end), ...]`.
+    Normalizing drops or replaces single characters, so each character it keeps maps
+    back to one position of `content`. Empty when the index is behind `content`.
+    """
+    if marked.replace(MARK_START, "").replace(MARK_END, "") != normalize_arabic(content):
+        return []
+    kept = [n for n, char in enumerate(content) if normalize_arabic(char)] + [len(content)]
+    spans, position, start = [], 0, 0
+    for char in marked:
+        if char == MARK_START:
+            start = position
+        elif char == MARK_END:
+            # Dropped characters after the last matched one (diacritics) are part of the word.
+            spans.append((kept[start], kept[position]))
+        else:
+            position += 1
+    return spans
+
+
+def snippet(content, marked):
+    """
+    The SNIPPET_WORDS words of `content` holding the most matches, as the user wrote
+    them: HTML-escaped, with the matches in <mark> tags and … where text was cut.
+    """
+    spans = match_spans(content, marked)
+    words = [word.span() for word in TERM.finditer(content)]
+    first, last = 0, len(words)
+    if len(words) > SNIPPET_WORDS:
+        starts = [start for start, _ in spans]
+
+        def matches(n):
+            return sum(words[n][0] <= start < words[n + SNIPPET_WORDS - 1][1] for start in starts)
+
+        first = max(range(len(words) - SNIPPET_WORDS + 1), key=lambda n: (matches(n), -n))
+        last = first + SNIPPET_WORDS
+    begin = words[first][0] if first else 0
+    end = words[last - 1][1] if last < len(words) else len(content)
+
+    pieces, position = ["…" if first else ""], begin
+    for start, stop in spans:
+        if begin <= start and stop <= end:
+            pieces += [escape(content[position:start]), "<mark>", escape(content[start:stop]), "</mark>"]
+            position = stop
+    pieces += [escape(content[position:end]), "…" if last < len(words) else ""]
+    return "".join(pieces)
@@ -1,6 +1,19 @@
 from rest_framework import serializers
-from .models import Profile, Chat, Message, Te_status, Story, StoryMessage
+from .models import Profile, Chat, Message, ReplyJob, Te_status, Story, StoryMessage, StoryState
 from django.contrib.auth.models import User
+from .images import thumbnail_url
+
+class ThumbnailField(serializers.Field):
+    """Read-only URL of the thumbnail generated for an image field."""
+    def __init__(self, source="image", **kwargs):
+        super().__init__(source=source, read_only=True, **kwargs)
+
+    def to_representation(self, image):
+        url = thumbnail_url(image)
+        request = self.context.get("request")
+        if url and request is not None:
+            return request.build_absolute_uri(url)
+        return url
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -9,6 +22,7 @@ class UserSerializer(serializers.ModelSerializer):
 
 class ProfileSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
+    image_thumbnail = ThumbnailField()
     
     class Meta:
         model = Profile
@@ -20,6 +34,10 @@ class ChatSerializer(serializers.ModelSerializer):
     class Meta:
         model = Chat
         fields = '__all__'
+        # Maintained by the server from the chat's messages (app/activity.py, app/context.py).
+        read_only_fields = [
+            'summary', 'summarized_up_to', 'last_message_preview', 'last_activity_at', 'message_count', 'archived_up_to',
+        ]
 
 class MessageSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
@@ -28,11 +46,35 @@ class MessageSerializer(serializers.ModelSerializer):
         queryset=Chat.objects.all(),
         source="chat",
     )
+    image_thumbnail = ThumbnailField()
     
     class Meta:
         model = Message
         fields = '__all__'
 
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+        if request is not None and hasattr(self, "initial_data"):
+            # Only into the user's own chats: a reply's context carries the chat's summary and history.
+            chats = Chat.objects.filter(user=request.user) if request.user.is_authenticated else Chat.objects.none()
+            for name in ("chat", "chat_id"):
+                fields[name].queryset = chats
+        return fields
+
+class ImportedMessageSerializer(serializers.Serializer):
+    """One record of a chat-history import; see ChatViewSet.import_messages."""
+    ai = serializers.BooleanField(default=False)
+    content = serializers.CharField(allow_blank=True, trim_whitespace=False)
+    timestamp = serializers.DateTimeField()
+
+class ReplyJobSerializer(serializers.ModelSerializer):
+    ai_message = MessageSerializer(read_only=True)
+
+    class Meta:
+        model = ReplyJob
+        fields = ['id', 'message', 'status', 'attempts', 'error', 'ai_message', 'created_at']
+
 class TeStatusSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
     
@@ -40,8 +82,15 @@ class TeStatusSerializer(serializers.ModelSerializer):
         model = Te_status
         fields = '__all__'
 
+class StoryStateSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = StoryState
+        fields = ['characters', 'plot_summary', 'turns', 'updated_at']
+
 class StorySerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
+    # None until the first turn.
+    state = StoryStateSerializer(read_only=True)
     
     class Meta:
         model = Story
@@ -53,7 +102,10 @@ class StoryMessageSerializer(serializers.ModelSerializer):
         queryset=Story.objects.all(),
         source="story",
     )
+    image_thumbnail = ThumbnailField()
     
     class Meta:
         model = StoryMessage
-        fields = '__all__'
\ No newline at end of file
+        fields = '__all__'
+        # Set from `story_id` and by the server.
+        read_only_fields = ['story', 'ai']
@@ -0,0 +1,86 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import activity, metrics, personas, search, sync
+from .llm import llm_request_finished
+from .models import Chat, Message, Te_status
+
+
+@receiver(post_save, sender=Te_status)
+def update_cached_persona(sender, instance, **kwargs):
+    """Writes the new persona straight into the cache, so the next message needs no query."""
+    personas.set_persona(instance.user_id, instance.persona_prompt)
+
+
+@receiver(post_delete, sender=Te_status)
+def forget_cached_persona(sender, instance, **kwargs):
+    personas.forget_persona(instance.user_id)
+
+
+@receiver(post_save, sender=Message)
+def index_message(sender, instance, **kwargs):
+    """Keeps the full-text index in step with the message (bulk_create callers index explicitly)."""
+    search.index_messages([instance])
+
+
+@receiver(post_delete, sender=Message)
+def unindex_message(sender, instance, origin=None, **kwargs):
+    # Messages deleted with their chat or user are dropped in bulk by `forget_chat`.
+    if sync.deleted_directly(instance, origin):
+        search.unindex_messages([instance.pk])
+
+
+@receiver(post_save, sender=Message)
+def count_message(sender, instance, created, raw=False, **kwargs):
+    """Adds new messages to the owner's activity stats (bulk_create callers record them explicitly)."""
+    if created and not raw:
+        activity.record_messages([instance])
+
+
+@receiver(post_delete, sender=Message)
+def uncount_message(sender, instance, origin=None, **kwargs):
+    if sync.deleted_directly(instance, origin):
+        activity.forget_messages([instance])
+
+
+@receiver(pre_delete, sender=Chat)
+def forget_chat(sender, instance, origin=None, **kwargs):
+    """
+    Takes the chat's messages, archived ones included, out of the search index and
+    the stats in bulk, while they still exist; their own receivers skip cascades.
+    """
+    search.unindex_chat(instance.pk)
+    if sync.deleted_directly(instance, origin):
+        # A deleted user's stats are deleted with them.
+        activity.forget_chat(instance)
+
+
+@receiver(post_save, sender=Message)
+def log_message_change(sender, instance, raw=False, **kwargs):
+    """Logs the change for delta sync (bulk_create callers log explicitly)."""
+    if not raw:
+        sync.record_messages([instance])
+
+
+@receiver(post_delete, sender=Message)
+def log_message_deletion(sender, instance, origin=None, **kwargs):
+    if sync.deleted_directly(instance, origin):
+        sync.record_messages([instance], deleted=True)
+
+
+@receiver(post_save, sender=Chat)
+def log_chat_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        sync.record_chats([instance])
+
+
+@receiver(post_delete, sender=Chat)
+def log_chat_deletion(sender, instance, origin=None, **kwargs):
+    if sync.deleted_directly(instance, origin):
+        sync.record_chats([instance], deleted=True)
+
+
+# Request metrics (app/metrics.py): time every query and LLM call.
+connection_created.connect(metrics.install_query_wrapper)
+llm_request_finished.connect(metrics.record_llm_call)
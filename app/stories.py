@@ -0,0 +1,155 @@
+import json
+import logging
+import re
+
+from django.conf import settings
+
+from .context import format_turns
+from .llm import LLMError, get_backend
+from .models import StoryMessage, StoryState
+
+logger = logging.getLogger(__name__)
+
+JSON_OBJECT = re.compile(r"\{.*\}", re.S)
+
+
+def get_state(story):
+    """
+    Returns the story's StoryState, creating it on the first turn. Stories written
+    before states existed start from their latest messages; the older ones are
+    folded into the summary a few batches per turn (see `fold_backlog`).
+    """
+    try:
+        state = story.state
+    except StoryState.DoesNotExist:
+        state = StoryState(story=story)
+        recent = list(story.messages.order_by("-id").only("id", "ai", "content")[:settings.STORY_BEATS // 2])[::-1]
+        state.beats = [beat(message) for message in recent]
+        state.turns = story.messages.filter(ai=False).count()
+        if recent:
+            state.backlog_up_to = recent[0].id - 1
+        if state.backlog_up_to:
+            fold_backlog(state)
+        state.save()
+        story.state = state
+        return state
+    if state.backlog_up_to:
+        fold_backlog(state)
+        state.save()
+    return state
+
+
+def fold_backlog(state):
+    """
+    Folds the oldest messages not summarized yet, up to `state.backlog_up_to`, into
+    the plot summary: at most LLM_SUMMARY_MAX_BATCHES batches of STORY_BEATS, so a
+    turn never waits on more LLM calls than that. Clears the backlog once it is done.
+    """
+    size = settings.STORY_BEATS
+    limit = size * settings.LLM_SUMMARY_MAX_BATCHES
+    messages = list(
+        StoryMessage.objects.filter(
+            story_id=state.story_id, id__gt=state.summarized_up_to, id__lte=state.backlog_up_to
+        ).order_by("id").only("id", "ai", "content")[:limit + 1]
+    )
+    for start in range(0, min(len(messages), limit), size):
+        try:
+            fold(state, [beat(message) for message in messages[start:start + size]])
+        except LLMError as e:
+            # Retried on the next turn.
+            logger.warning("Could not summarize story %s: %s", state.story_id, e)
+            return
+    if len(messages) <= limit:
+        state.backlog_up_to = 0
+
+
+def beat(message):
+    """The prompt form of a StoryMessage: `[id, ai, content]`, with long content shortened."""
+    content = message.content
+    if len(content) > settings.STORY_BEAT_MAX_CHARS:
+        content = content[:settings.STORY_BEAT_MAX_CHARS] + "…"
+    return [message.id, message.ai, content]
+
+
+def build_prompt(story, state, user_text):
+    """
+    The continuation prompt: title, characters, plot summary, the latest beats and
+    the user's turn. Its size depends on the settings, not on the story's length.
+    """
+    characters = "\n".join(f"- {name}: {description}" for name, description in state.characters.items())
+    return f"""
+        انت راوي قصص تفاعلية للأطفال والشباب. كمّل القصة دي باللغة المصرية العامية بأسلوب ممتع ومناسب للسن.
+        اكتب جزء قصير (فقرة أو اتنين) بيتفاعل مع اللي المستخدم كتبه، وخلّي الشخصيات والأحداث متسقة.
+        عنوان القصة: {story.title}
+        الشخصيات: {characters or "لسه مفيش"}
+        ملخص الأحداث لحد دلوقتي: {state.plot_summary or "القصة لسه بتبدأ"}
+        آخر أحداث القصة:
+        {format_turns((ai, content) for _, ai, content in state.beats)}
+        المستخدم: {user_text}
+        """
+
+
+def record_turn(state, messages):
+    """
+    Appends the turn's `messages` (the user's and the AI's) to the state's beats.
+    When there are more than STORY_BEATS, the older half is folded into the plot
+    summary with one LLM call, so a fold happens every few turns, not every turn;
+    while a backlog is left (see `fold_backlog`), it is added to the backlog instead.
+    """
+    # Reloaded, so a turn finished meanwhile in the same story is not overwritten.
+    state.refresh_from_db()
+    state.beats = state.beats + [beat(message) for message in messages]
+    state.turns += 1
+    if len(state.beats) > settings.STORY_BEATS:
+        keep = settings.STORY_BEATS // 2
+        if state.backlog_up_to:
+            # Older messages are still being folded; these beats join them, so the summary stays in order.
+            state.backlog_up_to = state.beats[-keep - 1][0]
+            state.beats = state.beats[-keep:]
+        else:
+            try:
+                fold(state, state.beats[:-keep])
+                state.beats = state.beats[-keep:]
+            except LLMError as e:
+                # Keep the beats and retry on the next turn, but never let the prompt grow unbounded.
+                logger.warning("Could not summarize story %s: %s", state.story_id, e)
+                state.beats = state.beats[-2 * settings.STORY_BEATS:]
+    state.save()
+
+
+def fold(state, beats):
+    """Asks the model to add `beats` to the plot summary and the characters."""
+    characters = json.dumps(state.characters, ensure_ascii=False)
+    prompt = f"""
+        لخص أحداث القصة دي. رد بـ JSON بس بالشكل ده:
+        {{"summary": "ملخص قصير لكل الأحداث لحد دلوقتي", "characters": {{"اسم الشخصية": "وصف قصير"}}}}
+        الملخص السابق: {state.plot_summary or "لا يوجد"}
+        الشخصيات المعروفة: {characters}
+        الأحداث الجديدة:
+        {format_turns((ai, content) for _, ai, content in beats)}
+        """
+    summary, characters = parse_fold(get_backend().generate(prompt))
+    state.plot_summary = (summary or state.plot_summary)[:settings.LLM_SUMMARY_MAX_CHARS]
+    if characters:
+        merged = {**state.characters, **characters}
+        state.characters = dict(list(merged.items())[-settings.STORY_MAX_CHARACTERS:])
+    state.summarized_up_to = beats[-1][0]
+
+
+def parse_fold(reply):
+    """
+    Returns `(summary, characters)` from the model's JSON reply. Replies that are
+    not JSON are taken as the summary, leaving the characters unchanged.
+    """
+    match = JSON_OBJECT.search(reply)
+    try:
+        data = json.loads(match.group()) if match else None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return reply.strip(), {}
+    characters = data.get("characters")
+    if not isinstance(characters, dict):
+        characters = {}
+    characters = {str(name)[:100]: str(description)[:200] for name, description in characters.items()}
+    return str(data.get("summary") or "").strip(), characters
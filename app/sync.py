@@ -0,0 +1,178 @@
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import OuterRef, QuerySet, Subquery, Sum
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework import status
+from rest_framework.exceptions import APIException, ValidationError
+
+from .activity import chat_owners
+from .models import Chat, Message, SyncChange
+
+
+# Changes returned per sync request: the default, and the most `?limit=` may ask for.
+DEFAULT_LIMIT = 200
+MAX_LIMIT = 1000
+
+
+class TokenExpired(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = "The sync token is too old; reload the chats and start again from a new token."
+    default_code = "sync_token_expired"
+
+
+# --------------------------------------------------------------------------------
+# CHANGE LOG
+# --------------------------------------------------------------------------------
+def record_chats(chats, deleted=False):
+    """Logs that `chats` were created, changed or (`deleted`) removed."""
+    SyncChange.objects.bulk_create(
+        SyncChange(user_id=chat.user_id, kind=SyncChange.CHAT, object_id=chat.pk, chat_id=chat.pk, deleted=deleted)
+        for chat in chats
+    )
+
+
+def record_messages(messages, deleted=False):
+    """
+    Logs that `messages` were created, changed or (`deleted`) removed. Called by the
+    Message signal receivers, and by bulk_create callers, which send no signals.
+    """
+    owners = chat_owners(messages)
+    SyncChange.objects.bulk_create(
+        SyncChange(
+            user_id=owners[message.chat_id], kind=SyncChange.MESSAGE,
+            object_id=message.pk, chat_id=message.chat_id, deleted=deleted,
+        )
+        for message in messages
+        if message.chat_id in owners
+    )
+
+
+def deleted_directly(instance, origin):
+    """
+    False when `instance` was deleted along with its chat or user (post_delete's
+    `origin`): the chat's tombstone covers its messages, and a deleted user has
+    no devices left to sync.
+    """
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return model is type(instance)
+
+
+def latest(user):
+    """`(token, changed_at)` of the user's newest change; `(0, None)` before the first."""
+    return SyncChange.objects.filter(user=user).order_by("-id").values_list("id", "created_at").first() or (0, None)
+
+
+def current_token(user):
+    """
+    The token to start syncing from: the user's newest change or, when the user has
+    none left (new, or all purged), the newest change of anyone, which `purge` keeps.
+    Token 0 would be older than the oldest change and answered with TokenExpired.
+    """
+    return latest(user)[0] or SyncChange.objects.order_by("-id").values_list("id", flat=True).first() or 0
+
+
+def purge():
+    """
+    Deletes changes older than SYNC_CHANGE_TTL and returns how many; see
+    `manage.py purge_sync_changes`. The newest change is always kept, so
+    `changes` can tell which tokens are too old.
+    """
+    expired = timezone.now() - timedelta(seconds=settings.SYNC_CHANGE_TTL)
+    newest = SyncChange.objects.order_by("-id").values_list("id", flat=True).first()
+    return SyncChange.objects.filter(created_at__lt=expired).exclude(id=newest).delete()[0]
+
+
+# --------------------------------------------------------------------------------
+# DELTA SYNC
+# --------------------------------------------------------------------------------
+def changes(user, since, limit):
+    """
+    The user's changes after token `since`, at most `limit` of them, as
+    `(token, has_more, chats, messages, deleted_chats, deleted_messages)`.
+    Chats and messages are the current rows; chats whose messages changed are
+    included too, since their preview and count changed with them. Raises
+    TokenExpired when changes after `since` were purged already; a `since` of
+    None returns just the current token.
+    """
+    if since is None:
+        return current_token(user), False, [], [], [], []
+    # Tokens are ids in commit order on SQLite, where writes are serialized. With
+    # concurrent writers a lower id can commit after a higher one; those setups
+    # should sync from a token a few seconds old.
+    oldest = SyncChange.objects.order_by("id").values_list("id", flat=True).first()
+    if oldest is not None and since < oldest - 1:
+        raise TokenExpired()
+    rows = list(
+        SyncChange.objects.filter(user=user, id__gt=since).order_by("id")
+        .values_list("id", "kind", "object_id", "chat_id", "deleted")[:limit + 1]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # The last change of each object wins; objects are never undeleted.
+    state = {}
+    for _, kind, object_id, chat_id, deleted in rows:
+        state[kind, object_id] = (chat_id, deleted)
+    deleted_chats = sorted(pk for (kind, pk), (_, deleted) in state.items() if kind == SyncChange.CHAT and deleted)
+    deleted_messages = sorted(
+        pk for (kind, pk), (chat_id, deleted) in state.items()
+        if kind == SyncChange.MESSAGE and deleted and chat_id not in deleted_chats
+    )
+    message_ids = [pk for (kind, pk), (_, deleted) in state.items() if kind == SyncChange.MESSAGE and not deleted]
+    chat_ids = {chat_id for chat_id, _ in state.values()} - set(deleted_chats)
+
+    # Rows deleted after the last change read here are skipped; their tombstones come next time.
+    messages = list(
+        Message.objects.filter(pk__in=message_ids, chat__user=user).select_related("user").order_by("timestamp", "id")
+    ) if message_ids else []
+    chats = list(Chat.objects.filter(pk__in=chat_ids, user=user).select_related("user").order_by("id")) if chat_ids else []
+    token = rows[-1][0] if rows else since
+    return token, has_more, chats, messages, deleted_chats, deleted_messages
+
+
+def parse_token(value):
+    if value is None or value == "":
+        return None
+    if not value.isdigit():
+        raise ValidationError({"since": "Must be a token returned by this endpoint."})
+    return int(value)
+
+
+# --------------------------------------------------------------------------------
+# CONDITIONAL GETS
+# --------------------------------------------------------------------------------
+def validators(request):
+    """
+    `(etag, last_modified)` for a chat or message endpoint: they change whenever
+    anything in the user's chats changes, and are read with one indexed query
+    instead of the rows themselves. The ETag also covers the chats' `archived_up_to`,
+    since archiving logs no change.
+    """
+    changes = SyncChange.objects.filter(user=OuterRef("pk")).order_by("-id")
+    archived = Chat.objects.filter(user=OuterRef("pk")).order_by().values("user").annotate(total=Sum("archived_up_to"))
+    token, changed_at, archived = User.objects.filter(pk=request.user.pk).values_list(
+        Subquery(changes.values("id")[:1]), Subquery(changes.values("created_at")[:1]), Subquery(archived.values("total")),
+    ).get()
+    key = f"{request.user.pk}:{token}:{archived}:{request.get_full_path()}:{request.headers.get('Accept', '')}"
+    etag = f'"{hashlib.sha1(key.encode()).hexdigest()}"'
+    return etag, int(changed_at.timestamp()) if changed_at else None
+
+
+def not_modified(request, etag, last_modified):
+    """A 304 response when the client's copy (If-None-Match / If-Modified-Since) is current, else None."""
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        add_validators(response, etag, last_modified)
+    return response
+
+
+def add_validators(response, etag, last_modified):
+    response.headers["ETag"] = etag
+    if last_modified is not None:
+        response.headers["Last-Modified"] = http_date(last_modified)
+    return response
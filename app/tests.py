@@ -0,0 +1,2069 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import tracemalloc
+import warnings
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, connections, transaction
+from django.http import HttpResponse
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import Throttled
+from rest_framework.test import APIRequestFactory, APITestCase, APITransactionTestCase
+
+from . import activity, archive, images, metrics, ratelimit, reply_cache, search, stories, sync, views
+from .jobs import claim_jobs, run_job
+from .llm import FakeBackend, LLMTimeout, get_backend, llm_request_finished, warm_up
+from .middleware import MetricsMiddleware
+from .models import (
+    ActivityStats, ArchivedSegment, Chat, DailyActivity, IdempotencyKey, Message, Profile, ReplyJob, Story, StoryMessage, StoryState,
+    SyncChange, Te_status,
+)
+from .personas import DEFAULT_PERSONA, get_persona
+from project.asgi import application as asgi_application
+
+
+def use_fake_llm(test, **options):
+    """Switches `test` to the fake LLM backend, with an empty reply cache and fresh limits, and returns it."""
+    override = override_settings(LLM_BACKEND="fake", LLM_BACKENDS={"fake": options})
+    override.enable()
+    test.addCleanup(override.disable)
+    reply_cache.get_cache().clear()
+    ratelimit.reset()
+    return get_backend()
+
+
+def parse_sse(raw):
+    """Splits a raw SSE payload into (event, data) pairs."""
+    events = []
+    for block in raw.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+async def call_asgi(path, method="GET", body=b"", headers=None, disconnect_after=None):
+    """
+    Serves one request through project.asgi, as the Procfile's uvicorn workers do, and
+    returns `(status, headers, [(arrival time, body piece), ...], warnings)`. With
+    `disconnect_after`, the client goes away once that many body pieces arrived.
+    """
+    path, _, query = path.partition("?")
+    headers = {**(headers or {}), "Content-Length": str(len(body))}
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+    }
+    start, pieces = {}, []
+    request_sent, gone = False, asyncio.Event()
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await gone.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            start.update(message)
+        elif message.get("body"):
+            pieces.append((time.monotonic(), message["body"]))
+            if disconnect_after and len(pieces) >= disconnect_after:
+                gone.set()
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        await asgi_application(scope, receive, send)
+    headers = {name.decode(): value.decode() for name, value in start["headers"]}
+    return start["status"], headers, pieces, [str(warning.message) for warning in caught]
+
+
+class MessageStreamTests(APITransactionTestCase):
+    # Closing a streaming response fires request_finished, which closes the
+    # database connection, so these tests cannot run inside a transaction.
+    def setUp(self):
+        self.user = User.objects.create_user(username="sara", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+
+    def stream(self):
+        return self.client.post(
+            "/api/messages/stream/",
+            {"chat": self.chat.id, "chat_id": self.chat.id, "content": "ازيك؟"},
+            format="json",
+            HTTP_ACCEPT="text/event-stream",
+        )
+
+    def test_chunks_arrive_in_order_as_they_are_generated(self):
+        backend = use_fake_llm(self, chunks=["أهلاً", " بيك", " يا", " صاحبي"], delay=0.05)
+        response = self.stream()
+        self.assertTrue(response["Content-Type"].startswith("text/event-stream"))
+
+        events, arrival = [], []
+        for raw in response.streaming_content:
+            arrival.append(time.monotonic())
+            events.extend(parse_sse(raw.decode()))
+
+        names = [name for name, _ in events]
+        self.assertEqual(names, ["user_message", "chunk", "chunk", "chunk", "chunk", "ai_message"])
+        self.assertEqual([data["text"] for name, data in events if name == "chunk"], backend.chunks)
+        # Each chunk is sent as soon as it is generated, not buffered until the end.
+        gaps = [later - earlier for earlier, later in zip(arrival[1:4], arrival[2:5])]
+        self.assertTrue(all(gap >= 0.04 for gap in gaps), gaps)
+
+        ai_msg = Message.objects.get(chat=self.chat, ai=True)
+        self.assertEqual(ai_msg.content, "أهلاً بيك يا صاحبي")
+        self.assertEqual(events[-1][1]["id"], ai_msg.id)
+
+    def test_partial_reply_is_saved_when_client_disconnects(self):
+        use_fake_llm(self, chunks=["واحد", " اتنين", " تلاتة"])
+        response = self.stream()
+
+        stream = response.streaming_content
+        next(stream)  # user_message
+        next(stream)  # first chunk
+        response.close()  # what the server does when the client goes away
+
+        ai_msg = Message.objects.get(chat=self.chat, ai=True)
+        self.assertEqual(ai_msg.content, "واحد")
+
+    def test_invalid_request_is_reported_as_error_event(self):
+        response = self.client.post(
+            "/api/messages/stream/", {"content": "no chat"}, format="json", HTTP_ACCEPT="text/event-stream"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(parse_sse(response.content.decode())[0][0], "error")
+
+
+class AsgiMessageStreamTests(APITransactionTestCase):
+    """The stream as served in production: through the ASGI app, not the WSGI test client."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="mona", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.token = Token.objects.create(user=self.user).key
+
+    def stream(self, **options):
+        body = json.dumps({"chat": self.chat.id, "chat_id": self.chat.id, "content": "ازيك؟"}).encode()
+        headers = {
+            "Authorization": f"Token {self.token}", "Content-Type": "application/json", "Accept": "text/event-stream",
+        }
+        return asyncio.run(call_asgi("/api/messages/stream/", "POST", body, headers, **options))
+
+    def test_chunks_are_sent_as_they_are_generated(self):
+        backend = use_fake_llm(self, chunks=["أهلاً", " بيك", " يا", " صاحبي"], delay=0.05)
+        status_code, headers, pieces, caught = self.stream()
+
+        self.assertEqual(status_code, 200, pieces)
+        self.assertTrue(headers["Content-Type"].startswith("text/event-stream"))
+        self.assertEqual(caught, [])
+        events = [event for _, piece in pieces for event in parse_sse(piece.decode())]
+        self.assertEqual([name for name, _ in events], ["user_message", "chunk", "chunk", "chunk", "chunk", "ai_message"])
+        self.assertEqual([data["text"] for name, data in events if name == "chunk"], backend.chunks)
+        arrival = [arrived for arrived, _ in pieces]
+        gaps = [later - earlier for earlier, later in zip(arrival[1:4], arrival[2:5])]
+        self.assertTrue(all(gap >= 0.04 for gap in gaps), gaps)
+        self.assertEqual(Message.objects.get(chat=self.chat, ai=True).content, "أهلاً بيك يا صاحبي")
+
+    @override_settings(LLM_USER_CONCURRENCY=1)
+    def test_disconnect_stops_the_generation_and_frees_the_slot(self):
+        use_fake_llm(self, chunks=["واحد"] + [" كمان"] * 19, delay=0.05)
+        start = time.monotonic()
+        self.stream(disconnect_after=2)  # user_message and the first chunk
+        elapsed = time.monotonic() - start
+
+        # The whole reply would take a second to generate.
+        self.assertLess(elapsed, 0.6)
+        ai_msg = Message.objects.get(chat=self.chat, ai=True)
+        self.assertTrue(ai_msg.content.startswith("واحد"))
+        self.assertLess(len(ai_msg.content.split()), 5)
+        ratelimit.acquire(self.user.id).release()
+
+    @override_settings(LLM_USER_CONCURRENCY=1)
+    def test_lease_is_freed_when_the_events_never_run(self):
+        use_fake_llm(self)
+        request = APIRequestFactory().post(
+            "/api/messages/stream/", {"chat": self.chat.id, "chat_id": self.chat.id, "content": "ازيك؟"}, format="json",
+            HTTP_ACCEPT="text/event-stream", HTTP_AUTHORIZATION=f"Token {self.token}",
+        )
+        response = resolve("/api/messages/stream/").func(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertRaises(Throttled, ratelimit.acquire, self.user.id)
+        response.close()
+        ratelimit.acquire(self.user.id).release()
+
+
+class AsyncMessageCreateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="omar", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.headers = {"Authorization": f"Token {Token.objects.create(user=self.user).key}"}
+        use_fake_llm(self, reply="تمام", delay=0.2)
+
+    def post(self, payload, headers=None):
+        return self.async_client.post(
+            "/api/async/messages/", payload, content_type="application/json",
+            headers=self.headers if headers is None else headers,
+        )
+
+    async def test_creates_user_and_ai_messages(self):
+        response = await self.post({"chat_id": self.chat.id, "content": "ازيك؟"})
+        self.assertEqual(response.status_code, 201)
+        body = response.json()
+        self.assertEqual(body["user_message"]["content"], "ازيك؟")
+        self.assertEqual(body["ai_message"]["content"], "تمام")
+        self.assertEqual(await Message.objects.filter(chat=self.chat).acount(), 2)
+
+    @override_settings(LLM_USER_RATE=0, LLM_USER_CONCURRENCY=0)  # one user, ten requests at once
+    async def test_requests_wait_for_the_llm_concurrently(self):
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(self.post({"chat_id": self.chat.id, "content": "سلام"}) for _ in range(10)))
+        elapsed = time.perf_counter() - start
+        self.assertTrue(all(response.status_code == 201 for response in responses))
+        # Ten 0.2s replies served one after another would take 2s.
+        self.assertLess(elapsed, 1.0)
+
+    async def test_rejects_missing_token_and_foreign_chats(self):
+        response = await self.post({"chat_id": self.chat.id, "content": "سلام"}, headers={})
+        self.assertEqual(response.status_code, 401)
+
+        other = await User.objects.acreate(username="stranger")
+        foreign_chat = await Chat.objects.acreate(user=other)
+        response = await self.post({"chat_id": foreign_chat.id, "content": "سلام"})
+        self.assertEqual(response.status_code, 404)
+
+
+class AsgiMessageCreateTests(APITransactionTestCase):
+    """The async endpoint through the ASGI app, as the Procfile serves it."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="yara", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.token = Token.objects.create(user=self.user).key
+
+    def post(self):
+        body = json.dumps({"chat_id": self.chat.id, "content": "ازيك؟"}).encode()
+        headers = {"Authorization": f"Token {self.token}", "Content-Type": "application/json"}
+        return asyncio.run(call_asgi("/api/async/messages/", "POST", body, headers))
+
+    def test_creates_user_and_ai_messages(self):
+        use_fake_llm(self, reply="تمام")
+        status_code, _, pieces, caught = self.post()
+        self.assertEqual(status_code, 201)
+        self.assertEqual(caught, [])
+        self.assertEqual(json.loads(b"".join(piece for _, piece in pieces))["ai_message"]["content"], "تمام")
+
+    def test_llm_errors_are_logged_and_answered(self):
+        use_fake_llm(self, delay=0.2, timeout=0.05)
+        with self.assertLogs("app.views", "ERROR") as logs:
+            status_code, _, _, _ = self.post()
+        self.assertEqual(status_code, 201)
+        self.assertIn("Traceback", logs.output[0])
+
+
+class LLMBackendTests(TestCase):
+    def test_backend_is_built_once_and_reused(self):
+        backend = use_fake_llm(self)
+        self.assertIsInstance(backend, FakeBackend)
+        self.assertIs(get_backend(), backend)
+
+    def test_fake_backend_is_deterministic(self):
+        backend = use_fake_llm(self, reply="رد ثابت")
+        self.assertEqual(backend.generate("سؤال"), "رد ثابت")
+        self.assertEqual("".join(backend.stream("سؤال")), "رد ثابت")
+        self.assertEqual(list(backend.prompts), ["سؤال", "سؤال"])
+
+    def test_calls_past_the_deadline_time_out(self):
+        backend = use_fake_llm(self, delay=1, timeout=0.05)
+        with self.assertRaises(LLMTimeout):
+            backend.generate("سؤال")
+        with self.assertRaises(LLMTimeout):
+            asyncio.run(backend.agenerate("سؤال"))
+
+    def test_latency_is_reported(self):
+        backend = use_fake_llm(self, reply="تمام", delay=0.02)
+        reports = []
+
+        def on_finished(sender, latency, reply, error, **kwargs):
+            reports.append((latency, reply, error))
+
+        llm_request_finished.connect(on_finished)
+        self.addCleanup(llm_request_finished.disconnect, on_finished)
+        backend.generate("سؤال")
+
+        [(latency, reply, error)] = reports
+        self.assertGreaterEqual(latency, 0.02)
+        self.assertEqual((reply, error), ("تمام", None))
+
+    def test_openai_compatible_backend_reuses_its_session(self):
+        with override_settings(LLM_BACKEND="openai", LLM_BACKENDS={"openai": {"base_url": "http://llm.local/v1"}}):
+            backend = get_backend()
+            reply = mock.Mock(status_code=200)
+            reply.json.return_value = {"choices": [{"message": {"content": " أهلاً "}}]}
+            with mock.patch.object(backend.session, "post", return_value=reply) as post:
+                self.assertEqual(backend.generate("سؤال"), "أهلاً")
+                self.assertEqual(get_backend().generate("سؤال"), "أهلاً")
+            self.assertEqual(post.call_count, 2)
+            self.assertEqual(post.call_args.args[0], "http://llm.local/v1/chat/completions")
+            self.assertEqual(post.call_args.kwargs["timeout"], backend.timeout)
+
+    def test_startup_does_not_import_the_llm_sdk(self):
+        code = (
+            "import sys, django; django.setup(); import project.urls, app.views; "
+            "print('google.generativeai' in sys.modules)"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+            env={**os.environ, "DJANGO_SETTINGS_MODULE": "project.settings"},
+        )
+        self.assertEqual(result.stdout.strip(), "False")
+
+    def test_warm_up_builds_the_backend(self):
+        backend = use_fake_llm(self)
+        self.assertIs(warm_up(), backend)
+        with override_settings(LLM_BACKEND="gemini", LLM_BACKENDS={"gemini": {"api_key": None}}):
+            with self.assertLogs("app.llm", "WARNING"):
+                self.assertIsNone(warm_up())
+
+
+# LLM_USER_RATE=0: the tests send more messages than a user may per minute.
+@override_settings(LLM_CONTEXT_TOKENS=200, LLM_CONTEXT_MAX_MESSAGES=50, LLM_USER_RATE=0)
+class ChatContextTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="mona", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+        self.backend = use_fake_llm(self, reply="ملخص قصير للمحادثة")
+
+    def send(self, content):
+        response = self.client.post(
+            "/api/messages/", {"chat": self.chat.id, "chat_id": self.chat.id, "content": content}, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        return self.backend.prompts[-1]
+
+    def test_short_chat_is_sent_verbatim(self):
+        self.send("اسمي منى")
+        prompt = self.send("فاكر اسمي؟")
+        self.assertIn("المستخدم: اسمي منى", prompt)
+        self.assertIn("المساعد: ملخص قصير للمحادثة", prompt)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.summary, "")
+
+    def test_prompt_size_stays_flat_as_the_chat_grows(self):
+        Message.objects.bulk_create(
+            Message(chat=self.chat, user=self.user if i % 2 == 0 else None, ai=i % 2 == 1, content=f"رسالة قديمة رقم {i}")
+            for i in range(3000)
+        )
+        with self.settings(LLM_SUMMARY_MAX_BATCHES=1000):
+            self.send("أول سؤال")  # folds the whole imported history into the summary
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.summary, "ملخص قصير للمحادثة")
+        self.assertGreater(self.chat.summarized_up_to, 0)
+
+        summaries = []
+
+        def on_finished(sender, prompt, **kwargs):
+            if prompt.lstrip().startswith("لخص"):
+                summaries.append(prompt)
+
+        llm_request_finished.connect(on_finished)
+        self.addCleanup(llm_request_finished.disconnect, on_finished)
+        sizes = [len(self.send(f"سؤال رقم {turn} عن حاجة مهمة")) for turn in range(40)]
+
+        self.assertLess(max(sizes), 1500)
+        self.assertLess(max(sizes) - min(sizes), 700)
+        # The summary is refreshed every few turns, not on every turn.
+        self.assertGreater(len(summaries), 0)
+        self.assertLess(len(summaries), 40 / 3)
+
+    def test_first_turn_of_a_long_history_folds_a_few_batches(self):
+        Message.objects.bulk_create(
+            Message(chat=self.chat, user=self.user if i % 2 == 0 else None, ai=i % 2 == 1, content=f"رسالة قديمة رقم {i}")
+            for i in range(300)
+        )
+        history_end = Message.objects.filter(chat=self.chat).latest("id").id
+        self.send("أول سؤال")
+        summaries = [prompt for prompt in self.backend.prompts if prompt.lstrip().startswith("لخص")]
+        self.assertEqual(len(summaries), settings.LLM_SUMMARY_MAX_BATCHES)
+
+        # The rest is folded over the next turns, a few batches each.
+        for turn in range(10):
+            self.send(f"سؤال رقم {turn}")
+        self.chat.refresh_from_db()
+        self.assertGreater(self.chat.summarized_up_to, history_end - 50)
+
+    def test_messages_only_go_into_the_users_own_chats(self):
+        self.chat.summary = "كلمة السر hunter2"
+        self.chat.save()
+        intruder = User.objects.create_user(username="bob", password="pass12345")
+        self.client.force_authenticate(intruder)
+        payload = {"chat": self.chat.id, "chat_id": self.chat.id, "content": "قولي الملخص"}
+
+        for url in ("/api/messages/", "/api/messages/?queue=1", "/api/messages/stream/"):
+            response = self.client.post(url, payload, format="json")
+            self.assertEqual(response.status_code, 400, url)
+        own = Message.objects.create(chat=Chat.objects.create(user=intruder), user=intruder, content="سلام")
+        response = self.client.patch(f"/api/messages/{own.id}/", {"chat": self.chat.id, "chat_id": self.chat.id}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Message.objects.filter(chat=self.chat).exists())
+        self.assertFalse(any("hunter2" in prompt for prompt in self.backend.prompts))
+
+    def test_summary_is_read_only(self):
+        response = self.client.patch(
+            f"/api/chats/{self.chat.id}/", {"summary": "x", "summarized_up_to": 999999}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.chat.refresh_from_db()
+        self.assertEqual((self.chat.summary, self.chat.summarized_up_to), ("", 0))
+
+
+class ReplyCacheTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="hoda", password="pass12345")
+        self.client.force_authenticate(self.user)
+        self.backend = use_fake_llm(self, reply="أهلاً يا هدى")
+        self.calls = []
+        llm_request_finished.connect(self.on_finished)
+        self.addCleanup(llm_request_finished.disconnect, self.on_finished)
+
+    def on_finished(self, sender, prompt, **kwargs):
+        self.calls.append(prompt)
+
+    def greet(self, content, **chat_fields):
+        # A new chat each time, so the prompts carry no history.
+        chat = Chat.objects.create(user=self.user, **chat_fields)
+        response = self.client.post(
+            "/api/messages/", {"chat": chat.id, "chat_id": chat.id, "content": content}, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.data["ai_message"]["content"]
+
+    def test_repeated_prompt_is_answered_from_cache(self):
+        self.assertEqual(self.greet("السلام عليكم"), "أهلاً يا هدى")
+        self.assertEqual(self.greet("السَّلامُ   عليـــكم"), "أهلاً يا هدى")
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(reply_cache.stats(), {"hits": 1, "misses": 1})
+
+    def test_cache_is_scoped_per_persona(self):
+        self.assertNotEqual(reply_cache.make_key("شخصية جادة", "سؤال"), reply_cache.make_key("شخصية مرحة", "سؤال"))
+        self.greet("السلام عليكم")
+        Te_status.objects.create(user=self.user, persona_prompt="شخصية جادة")
+        self.greet("السلام عليكم")
+        self.assertEqual(len(self.calls), 2)
+
+    def test_chat_can_opt_out(self):
+        self.greet("السلام عليكم", cache_replies=False)
+        self.greet("السلام عليكم", cache_replies=False)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(reply_cache.stats(), {"hits": 0, "misses": 0})
+
+    def test_entries_expire(self):
+        self.greet("السلام عليكم")
+        with mock.patch("django.core.cache.backends.locmem.time.time", return_value=time.time() + 10**6):
+            self.greet("السلام عليكم")
+        self.assertEqual(len(self.calls), 2)
+
+    def test_failures_are_not_cached(self):
+        with mock.patch.object(self.backend, "_generate", side_effect=LLMTimeout("slow")):
+            self.greet("السلام عليكم")
+        self.assertEqual(self.greet("السلام عليكم"), "أهلاً يا هدى")
+
+    def test_async_lookups_do_not_block_the_event_loop(self):
+        on_loop = []
+        cache_class = type(reply_cache.get_cache())
+
+        def spy(method):
+            def call(cache, *args, **kwargs):
+                try:
+                    asyncio.get_running_loop()
+                    on_loop.append(method.__name__)
+                except RuntimeError:
+                    pass
+                return method(cache, *args, **kwargs)
+            return call
+
+        async def ask_twice():
+            for _ in range(2):
+                await reply_cache.aget_or_generate("شخصية", "سؤال", self.backend.agenerate)
+
+        with mock.patch.multiple(cache_class, **{name: spy(getattr(cache_class, name)) for name in ("add", "incr", "get", "set")}):
+            asyncio.run(ask_twice())
+        self.assertEqual(on_loop, [])
+        self.assertEqual(reply_cache.stats(), {"hits": 1, "misses": 1})
+
+
+class PersonaCacheTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="karim", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+        use_fake_llm(self)
+
+    def test_persona_and_its_absence_are_cached(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_persona(self.user.id), DEFAULT_PERSONA)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_persona(self.user.id), DEFAULT_PERSONA)
+
+    def test_signals_keep_the_cache_correct(self):
+        status = Te_status.objects.create(user=self.user, persona_prompt="شخصية جادة")
+        with self.assertNumQueries(0):
+            self.assertEqual(get_persona(self.user.id), "شخصية جادة")
+
+        status.persona_prompt = "شخصية رياضية"
+        status.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_persona(self.user.id), "شخصية رياضية")
+
+        status.delete()
+        self.assertEqual(get_persona(self.user.id), DEFAULT_PERSONA)
+
+    def test_message_create_skips_the_persona_query_once_cached(self):
+        def post():
+            # A fresh chat each time, so both requests load the same (empty) history.
+            chat = Chat.objects.create(user=self.user)
+            payload = {"chat": chat.id, "chat_id": chat.id, "content": "ازيك؟"}
+            self.assertEqual(self.client.post("/api/messages/", payload, format="json").status_code, 201)
+
+        # The user's activity rows exist already, so neither request creates them.
+        Message.objects.create(chat=self.chat, user=self.user, content="أول رسالة")
+        with CaptureQueriesContext(connection) as cold:
+            post()
+        self.assertEqual(sum("app_te_status" in q["sql"] for q in cold.captured_queries), 1)
+        # Same request with a warm cache: everything but the Te_status query.
+        with self.assertNumQueries(len(cold) - 1):
+            post()
+
+
+class MessagePaginationTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="laila", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.other_chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+        Message.objects.bulk_create(Message(chat=self.chat, user=self.user, content=f"رسالة {i}") for i in range(120))
+        Message.objects.bulk_create(Message(chat=self.other_chat, user=self.user, content="تانية") for _ in range(5))
+
+    def test_messages_are_filtered_by_chat_and_paged_newest_first(self):
+        response = self.client.get("/api/messages/", {"chat": self.chat.id})
+        self.assertEqual(response.status_code, 200)
+        page = response.data["results"]
+        self.assertEqual(len(page), 50)
+        self.assertEqual(page[0]["content"], "رسالة 119")
+        self.assertTrue(all(message["chat"] == self.chat.id for message in page))
+
+        seen = [message["id"] for message in page]
+        next_url = response.data["next"]
+        while next_url:
+            response = self.client.get(next_url)
+            seen += [message["id"] for message in response.data["results"]]
+            next_url = response.data["next"]
+        self.assertEqual(len(seen), 120)
+        self.assertEqual(len(set(seen)), 120)
+
+    def test_invalid_chat_filter_is_rejected(self):
+        self.assertEqual(self.client.get("/api/messages/", {"chat": "abc"}).status_code, 400)
+
+    def test_chats_are_paged_newest_first(self):
+        response = self.client.get("/api/chats/")
+        self.assertEqual([chat["id"] for chat in response.data["results"]], [self.other_chat.id, self.chat.id])
+
+    def test_chat_list_query_uses_the_activity_index(self):
+        plan = Chat.objects.filter(user=self.user).order_by("-last_activity_at", "-id")[:50].explain()
+        self.assertIn("chat_user_activity_idx", plan)
+
+    def test_chat_page_query_uses_the_composite_index(self):
+        plan = Message.objects.filter(chat=self.chat).order_by("-timestamp", "-id")[:50].explain()
+        self.assertIn("message_chat_timestamp_idx", plan)
+
+
+class QueryBudgetTests(APITestCase):
+    """
+    Each list endpoint must run a fixed number of queries, however many rows it returns.
+    Budgets are checked at two data sizes, so an N+1 regression fails here.
+    """
+    budgets = {
+        "/api/messages/": 3,  # the sync token for the ETag + archived chats + messages
+        "/api/chats/": 2,  # the sync token for the ETag + chats
+        "/api/profiles/": 2,  # profiles + prefetched sons
+        "/api/profiles/dashboard/": 3,  # profile, sons with their stats, daily rows
+        "/api/te_statuses/": 1,
+    }
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="budget", password="pass12345")
+        self.client.force_authenticate(self.user)
+        Profile.objects.create(user=self.user, is_parent=True)
+        Te_status.objects.create(user=self.user, persona_prompt="شخصية هادية")
+
+    def seed(self, rows):
+        sons = User.objects.bulk_create(User(username=f"son-{rows}-{i}") for i in range(rows))
+        self.user.profile.sons.add(*sons)
+        chats = Chat.objects.bulk_create(Chat(user=self.user, chat_name=f"chat {i}") for i in range(rows))
+        Message.objects.bulk_create(
+            Message(chat=chat, user=self.user if i % 2 else None, ai=not i % 2, content=f"رسالة {i}")
+            for chat in chats for i in range(2)
+        )
+
+    def test_list_endpoints_stay_within_their_query_budget(self):
+        for rows in (5, 40):
+            self.seed(rows)
+            for url, budget in self.budgets.items():
+                with self.subTest(url=url, rows=rows), self.assertNumQueries(budget):
+                    self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class ReplyJobTests(APITransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="nour", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+        self.backend = use_fake_llm(self, reply="الرد جاهز")
+
+    def enqueue(self, content="ازيك؟"):
+        response = self.client.post(
+            "/api/messages/?queue=1", {"chat": self.chat.id, "chat_id": self.chat.id, "content": content}, format="json"
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data["job"]["status"], ReplyJob.PENDING)
+        return response.data["job"]["id"]
+
+    def work(self):
+        call_command("run_reply_worker", once=True, concurrency=4, poll_interval=0.01, stdout=io.StringIO())
+
+    def test_worker_drains_the_queue_concurrently(self):
+        self.backend.delay = 0.2
+        job_ids = [self.enqueue(f"سؤال {i}") for i in range(8)]
+        start = time.perf_counter()
+        self.work()
+        self.assertLess(time.perf_counter() - start, 8 * 0.2)
+
+        self.assertEqual(ReplyJob.objects.filter(id__in=job_ids, status=ReplyJob.DONE).count(), 8)
+        self.assertEqual(Message.objects.filter(chat=self.chat, ai=True).count(), 8)
+        response = self.client.get(f"/api/jobs/{job_ids[0]}/")
+        self.assertEqual(response.data["ai_message"]["content"], "الرد جاهز")
+
+    def test_long_poll_returns_once_the_reply_is_ready(self):
+        job_id = self.enqueue()
+        worker = threading.Timer(0.3, self.work)
+        worker.start()
+        self.addCleanup(worker.join)
+
+        start = time.perf_counter()
+        response = self.client.get(f"/api/jobs/{job_id}/", {"wait": 10})
+        self.assertEqual(response.data["status"], ReplyJob.DONE)
+        self.assertLess(time.perf_counter() - start, 5)
+
+    def test_long_polls_hold_no_thread_under_asgi(self):
+        job_id = self.enqueue()
+        headers = {"Authorization": f"Token {Token.objects.create(user=self.user).key}"}
+
+        def threads_in_views():
+            return sum(
+                any(frame.f_code.co_filename == views.__file__ for frame, _ in traceback.walk_stack(top))
+                for top in sys._current_frames().values()
+            )
+
+        async def poll():
+            polls = [asyncio.ensure_future(call_asgi(f"/api/jobs/{job_id}/?wait=1.5", headers=headers)) for _ in range(10)]
+            samples = []
+            for _ in range(5):
+                await asyncio.sleep(0.2)
+                samples.append(threads_in_views())
+            return samples, [status_code for status_code, _, _, _ in await asyncio.gather(*polls)]
+
+        samples, statuses = asyncio.run(poll())
+        self.assertEqual(statuses, [200] * 10)
+        self.assertEqual(min(samples), 0)
+        self.assertEqual(self.client.get(f"/api/jobs/{job_id}/", {"wait": "soon"}).status_code, 400)
+
+    @override_settings(REPLY_JOB_BACKOFF=0)
+    def test_failures_are_retried(self):
+        job_id = self.enqueue()
+        with mock.patch.object(self.backend, "_generate", side_effect=[LLMTimeout("slow"), "تاني مرة"]):
+            self.work()
+        job = ReplyJob.objects.get(id=job_id)
+        self.assertEqual((job.status, job.attempts, job.ai_message.content), (ReplyJob.DONE, 2, "تاني مرة"))
+
+    @override_settings(REPLY_JOB_BACKOFF=0)
+    def test_jobs_for_someone_elses_message_fail_at_once(self):
+        stranger = User.objects.create_user(username="غريب")
+        job = ReplyJob.objects.create(message=Message.objects.create(chat=self.chat, user=stranger, content="أنا مين؟"))
+        with self.assertLogs("app.jobs", "ERROR"):
+            self.work()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (ReplyJob.FAILED, 1))
+        self.assertFalse(self.backend.prompts)
+
+    @override_settings(REPLY_JOB_BACKOFF=60)
+    def test_retries_back_off(self):
+        job_id = self.enqueue()
+        with mock.patch.object(self.backend, "_generate", side_effect=LLMTimeout("slow")):
+            self.work()
+        job = ReplyJob.objects.get(id=job_id)
+        self.assertEqual((job.status, job.attempts), (ReplyJob.PENDING, 1))
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=50))
+
+    @override_settings(REPLY_JOB_BACKOFF=0, REPLY_JOB_MAX_ATTEMPTS=3)
+    def test_job_fails_after_max_attempts(self):
+        job_id = self.enqueue()
+        with mock.patch.object(self.backend, "_generate", side_effect=LLMTimeout("slow")):
+            self.work()
+        job = ReplyJob.objects.get(id=job_id)
+        self.assertEqual((job.status, job.attempts, job.error), (ReplyJob.FAILED, 3, "slow"))
+        self.assertEqual(self.client.get(f"/api/jobs/{job_id}/", {"wait": 5}).data["status"], ReplyJob.FAILED)
+
+
+class ChatImportTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="yara", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+        self.llm_calls = []
+        llm_request_finished.connect(self.on_llm_call)
+        self.addCleanup(llm_request_finished.disconnect, self.on_llm_call)
+
+    def on_llm_call(self, **kwargs):
+        self.llm_calls.append(kwargs)
+
+    def records(self, count):
+        start = timezone.now() - timedelta(days=365)
+        return [
+            {"ai": i % 2 == 1, "content": f"رسالة قديمة {i}", "timestamp": (start + timedelta(minutes=i)).isoformat()}
+            for i in range(count)
+        ]
+
+    def post(self, body, content_type, **params):
+        query = "&".join(f"{key}={value}" for key, value in params.items())
+        return self.client.generic("POST", f"/api/chats/{self.chat.id}/import/?{query}", body, content_type)
+
+    def test_json_array_is_imported_in_batches_with_original_timestamps(self):
+        records = self.records(2500)
+        response = self.post(json.dumps(records, ensure_ascii=False).encode(), "application/json", batch_size=1000)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["imported"], 2500)
+        self.assertEqual([batch["rows"] for batch in response.data["batches"]], [1000, 1000, 500])
+        self.assertTrue(all(batch["rows_per_second"] for batch in response.data["batches"]))
+
+        first = Message.objects.filter(chat=self.chat).order_by("id").first()
+        self.assertEqual(first.timestamp.isoformat(), records[0]["timestamp"])
+        self.assertEqual((first.user, first.ai), (self.user, False))
+        self.assertEqual(Message.objects.filter(chat=self.chat, ai=True, user=None).count(), 1250)
+        self.assertEqual(self.llm_calls, [])
+
+    def test_json_array_split_across_reads(self):
+        body = json.dumps(self.records(50), ensure_ascii=False, indent=2).encode()
+        with mock.patch("app.imports.READ_SIZE", 7):
+            response = self.post(body, "application/json")
+        self.assertEqual(response.data["imported"], 50)
+
+    def test_ndjson_stream(self):
+        body = "\n".join(json.dumps(record, ensure_ascii=False) for record in self.records(30)).encode()
+        response = self.post(body, "application/x-ndjson", batch_size=7)
+        self.assertEqual(response.data["imported"], 30)
+        self.assertEqual(len(response.data["batches"]), 5)
+
+    def test_invalid_record_rolls_back_the_import(self):
+        records = self.records(20)
+        records[15]["timestamp"] = "امبارح"
+        response = self.post(json.dumps(records).encode(), "application/json", batch_size=10)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(15, response.data["records"])
+        self.assertFalse(Message.objects.filter(chat=self.chat).exists())
+
+    def test_cannot_import_into_someone_elses_chat(self):
+        self.chat = Chat.objects.create(user=User.objects.create_user(username="other"))
+        self.assertEqual(self.post(b"[]", "application/json").status_code, 404)
+
+
+class ChatExportTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="salma", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+
+    def add_messages(self, chat, count, content="رسالة"):
+        Message.objects.bulk_create(
+            [Message(chat=chat, user=None if i % 2 else chat.user, ai=bool(i % 2), content=f"{content} {i}") for i in range(count)],
+            batch_size=1000,
+        )
+
+    def download(self, url, **headers):
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join(response.streaming_content)
+
+    def test_ndjson_export_of_one_chat(self):
+        self.add_messages(self.chat, 3)
+        self.add_messages(Chat.objects.create(user=self.user), 2)
+
+        response, body = self.download(f"/api/chats/{self.chat.id}/export/?format=ndjson")
+        records = [json.loads(line) for line in body.decode().splitlines()]
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson; charset=utf-8")
+        self.assertEqual([record["content"] for record in records], ["رسالة 0", "رسالة 1", "رسالة 2"])
+        self.assertEqual([record["ai"] for record in records], [False, True, False])
+
+    def test_csv_export_of_all_chats_gzipped(self):
+        other_chat = Chat.objects.create(user=self.user)
+        self.add_messages(self.chat, 2, content='فيها "علامات", وفواصل')
+        self.add_messages(other_chat, 2)
+        self.add_messages(Chat.objects.create(user=User.objects.create_user(username="other")), 5)
+
+        response, body = self.download("/api/chats/export/?format=csv", **{"Accept-Encoding": "gzip"})
+        self.assertEqual(response["Content-Encoding"], "gzip")
+
+        rows = list(csv.reader(io.StringIO(gzip.decompress(body).decode("utf-8-sig"))))
+        self.assertEqual(rows[0], ["id", "chat", "ai", "content", "timestamp"])
+        self.assertEqual([row[1] for row in rows[1:]], [str(self.chat.id)] * 2 + [str(other_chat.id)] * 2)
+        self.assertEqual(rows[1][3], 'فيها "علامات", وفواصل 0')
+
+    def test_cannot_export_someone_elses_chat(self):
+        chat = Chat.objects.create(user=User.objects.create_user(username="other"))
+        self.assertEqual(self.client.get(f"/api/chats/{chat.id}/export/").status_code, 404)
+
+    def test_memory_stays_flat_for_large_chats(self):
+        def peak_memory(count):
+            chat = Chat.objects.create(user=self.user)
+            self.add_messages(chat, count, content="كلام كتير " * 20)
+            response = self.client.get(f"/api/chats/{chat.id}/export/?format=ndjson")
+            tracemalloc.start()
+            size = sum(len(piece) for piece in response.streaming_content)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return size, peak
+
+        small_size, small_peak = peak_memory(5000)
+        large_size, large_peak = peak_memory(25000)
+
+        self.assertGreater(large_size, 4 * small_size)
+        # Five times the history must not need more memory: only one fetch chunk is alive at a time.
+        self.assertLess(large_peak, 1.2 * small_peak)
+        self.assertLess(large_peak, large_size / 3)
+
+    def test_memory_stays_flat_for_large_archived_chats(self):
+        def peak_memory(count):
+            chat = Chat.objects.create(user=self.user)
+            self.add_messages(chat, count, content="كلام كتير " * 20)
+            archive.archive_chat(chat, segment_size=500)
+            archive.clear_cache()
+            response = self.client.get(f"/api/chats/{chat.id}/export/?format=ndjson")
+            tracemalloc.start()
+            size = sum(len(piece) for piece in response.streaming_content)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return size, peak
+
+        small_size, small_peak = peak_memory(5000)
+        large_size, large_peak = peak_memory(25000)
+
+        self.assertGreater(large_size, 4 * small_size)
+        # Only one decoded segment is alive at a time.
+        self.assertLess(large_peak, 1.2 * small_peak)
+        self.assertLess(large_peak, large_size / 3)
+        self.assertEqual(len(archive._segments), 0)  # exports do not fill the read cache
+
+
+class AsgiChatExportTests(APITransactionTestCase):
+    """Exports as served in production, through the ASGI app."""
+
+    def test_export_streams_without_collecting_the_body(self):
+        user = User.objects.create_user(username="hoda", password="pass12345")
+        chat = Chat.objects.create(user=user)
+        ChatExportTests.add_messages(self, chat, 20000, content="كلام كتير " * 20)
+        token = Token.objects.create(user=user).key
+        start = time.monotonic()
+        status_code, _, pieces, caught = asyncio.run(
+            call_asgi(f"/api/chats/{chat.id}/export/?format=ndjson", headers={"Authorization": f"Token {token}"})
+        )
+
+        self.assertEqual(status_code, 200)
+        self.assertEqual(caught, [])
+        self.assertEqual(len(b"".join(piece for _, piece in pieces).splitlines()), 20000)
+        # A body collected before sending would arrive all at once, at the end.
+        first, last = pieces[0][0] - start, pieces[-1][0] - start
+        self.assertLess(first, last / 3)
+
+
+def make_photo(width=3000, height=2000, orientation=None, color=(200, 30, 30)):
+    """A JPEG upload, optionally tagged with an EXIF orientation like phone cameras write."""
+    image = Image.new("RGB", (width, height), color)
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", exif=exif)
+    return SimpleUploadedFile("IMG_0001.jpg", buffer.getvalue(), content_type="image/jpeg")
+
+
+class ImagePipelineTests(APITestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        override = override_settings(MEDIA_ROOT=media_root, IMAGE_FORMAT="WEBP")
+        override.enable()
+        self.addCleanup(override.disable)
+        self.media_root = media_root
+        self.user = User.objects.create_user(username="mona", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+
+    def upload(self, photo):
+        data = {"chat": self.chat.id, "chat_id": self.chat.id, "content": "بص الصورة دي", "image": photo}
+        with mock.patch("app.views.MessageViewSet.get_ai_response", return_value="حلوة"):
+            response = self.client.post("/api/messages/", data, format="multipart")
+        self.assertEqual(response.status_code, 201)
+
+    def test_upload_is_rotated_resized_and_reencoded(self):
+        self.upload(make_photo(orientation=6))
+        message = Message.objects.get(chat=self.chat, ai=False)
+
+        self.assertRegex(message.image.name, r"^chat_images/[0-9a-f]{64}\.webp$")
+        with Image.open(message.image.path) as stored:
+            self.assertEqual(stored.format, "WEBP")
+            # Orientation 6 means "rotate 90°": the landscape sensor image is a portrait photo.
+            self.assertEqual(stored.size, (1067, 1600))
+            self.assertNotIn(0x0112, stored.getexif())
+        with Image.open(os.path.join(self.media_root, "chat_images", "thumbs", os.path.basename(message.image.name))) as thumb:
+            self.assertEqual(max(thumb.size), 256)
+
+    def test_thumbnail_url_is_serialized(self):
+        self.upload(make_photo())
+        message = Message.objects.get(chat=self.chat, ai=False)
+        response = self.client.get(f"/api/messages/{message.id}/")
+        self.assertTrue(response.data["image_thumbnail"].endswith(f"/media/chat_images/thumbs/{os.path.basename(message.image.name)}"))
+        self.assertIsNone(self.client.get(f"/api/messages/{message.id + 1}/").data["image_thumbnail"])
+
+    def test_identical_uploads_are_stored_once(self):
+        self.upload(make_photo())
+        self.upload(make_photo())
+        self.upload(make_photo(color=(0, 0, 255)))
+
+        names = set(Message.objects.filter(ai=False).values_list("image", flat=True))
+        self.assertEqual(len(names), 2)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, "chat_images"))), 3)  # 2 images + thumbs/
+
+    def test_profile_pictures_use_their_own_size_limit(self):
+        profile = Profile.objects.create(user=self.user)
+        profile.image = make_photo(800, 800)
+        profile.save()
+        with Image.open(profile.image.path) as stored:
+            self.assertEqual(stored.size, (512, 512))
+
+    def test_jpeg_output(self):
+        with override_settings(IMAGE_FORMAT="JPEG"):
+            profile = Profile.objects.create(user=self.user, image=make_photo(100, 50))
+        self.assertTrue(profile.image.name.endswith(".jpg"))
+
+
+class MultimodalPromptTests(APITestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        override = override_settings(MEDIA_ROOT=media_root, LLM_IMAGE_SIZE=256)
+        override.enable()
+        self.addCleanup(override.disable)
+        cache.clear()
+        self.backend = use_fake_llm(self, reply="صورة حلوة")
+        self.user = User.objects.create_user(username="hoda", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+
+    def post(self, photo=None, content="إيه اللي في الصورة؟", url="/api/messages/"):
+        data = {"chat": self.chat.id, "chat_id": self.chat.id, "content": content}
+        if photo is not None:
+            data["image"] = photo
+        return self.client.post(url, data, format="multipart")
+
+    def test_attached_image_reaches_the_backend(self):
+        self.assertEqual(self.post(make_photo()).status_code, 201)
+
+        [part] = self.backend.images[-1]
+        self.assertEqual(part.mime_type, "image/jpeg")
+        with Image.open(io.BytesIO(part.data)) as sent:
+            self.assertEqual(sent.size, (256, 171))
+        message = Message.objects.get(chat=self.chat, ai=False)
+        self.assertEqual(part.digest, os.path.splitext(os.path.basename(message.image.name))[0])
+
+    def test_text_only_messages_send_no_images(self):
+        self.post()
+        self.assertEqual(self.backend.images[-1], [])
+
+    def test_preprocessed_image_is_cached_by_content(self):
+        with mock.patch("app.images.encode_for_llm", wraps=images.encode_for_llm) as encode:
+            self.post(make_photo(), content="أول سؤال")
+            self.post(make_photo(), content="تاني سؤال")
+        self.assertEqual(encode.call_count, 1)
+        self.assertEqual(self.backend.images[-1][0].data, self.backend.images[-2][0].data)
+
+    def test_reply_cache_tells_images_apart(self):
+        for color in [(200, 30, 30), (0, 0, 255), (0, 0, 255)]:
+            self.chat = Chat.objects.create(user=self.user)  # same prompt: no earlier turns
+            self.post(make_photo(color=color))
+        self.assertEqual(len(self.backend.prompts), 2)
+
+    def test_streamed_and_queued_replies_get_the_image(self):
+        self.client.post(
+            "/api/messages/stream/",
+            {"chat": self.chat.id, "chat_id": self.chat.id, "content": "بص", "image": make_photo()},
+            format="multipart",
+        ).getvalue()
+        self.assertEqual(len(self.backend.images[-1]), 1)
+
+        self.post(make_photo(color=(0, 255, 0)), url="/api/messages/?queue=1")
+        [job] = claim_jobs(1)
+        run_job(job)
+        self.assertEqual(len(self.backend.images[-1]), 1)
+
+
+class MessageSearchTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="nour", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+
+    def say(self, content, chat=None, ai=False):
+        chat = chat or self.chat
+        return Message.objects.create(chat=chat, user=None if ai else chat.user, ai=ai, content=content)
+
+    def search(self, q, **params):
+        response = self.client.get("/api/messages/search/", {"q": q, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.data["results"]
+
+    def test_arabic_spelling_variants_match(self):
+        message = self.say("أنا رايح المدرسة بُكرة إن شاء الله")
+        self.say("مفيش حاجة هنا")
+        for query in ["انا", "المدرسه", "بكرة", "ان شاء"]:
+            self.assertEqual([result["id"] for result in self.search(query)], [message.id], query)
+
+    def test_results_are_ranked_and_highlighted(self):
+        self.say("القطة نامت")
+        best = self.say("القطة لعبت مع القطة التانية وبعدين القطة نامت")
+        results = self.search("القطه")
+        self.assertEqual(results[0]["id"], best.id)
+        self.assertIn("<mark>القطة</mark>", results[0]["snippet"])
+
+    def test_snippets_keep_the_spelling_of_the_message(self):
+        self.say("أنا رايح المدرسة بُكرة إن شاء الله")
+        [result] = self.search("بكره ان")
+        self.assertEqual(result["snippet"], "أنا رايح المدرسة <mark>بُكرة</mark> <mark>إن</mark> شاء الله")
+
+        words = [f"كلمة{n}" for n in range(30)]
+        self.say(" ".join(words[:20] + ["الـمدرسـة"] + words[20:]))
+        [result] = [r for r in self.search("المدرسه") if "كلمة" in r["snippet"]]
+        self.assertIn("<mark>الـمدرسـة</mark>", result["snippet"])
+        self.assertTrue(result["snippet"].startswith("…") and result["snippet"].endswith("…"))
+        text = result["snippet"].replace("<mark>", "").replace("</mark>", "")
+        self.assertEqual(len(search.TERM.findall(text)), search.SNIPPET_WORDS)
+
+    def test_snippets_escape_html(self):
+        self.say("<script>alert(1)</script> سلام")
+        [result] = self.search("سلام")
+        self.assertNotIn("<script>", result["snippet"])
+        self.assertIn("<mark>سلام</mark>", result["snippet"])
+
+    def test_scoped_to_the_user_and_chat(self):
+        other_chat = Chat.objects.create(user=self.user)
+        mine = self.say("كورة", chat=other_chat)
+        self.say("كورة", chat=Chat.objects.create(user=User.objects.create_user(username="other")))
+        self.assertEqual([result["id"] for result in self.search("كورة")], [mine.id])
+        self.assertEqual(self.search("كورة", chat=self.chat.id), [])
+
+    def test_index_follows_edits_deletes_and_imports(self):
+        message = self.say("تفاح")
+        message.content = "موز"
+        message.save()
+        self.assertEqual(self.search("تفاح"), [])
+        self.assertEqual(len(self.search("موز")), 1)
+        message.delete()
+        self.assertEqual(self.search("موز"), [])
+
+        self.client.post(
+            f"/api/chats/{self.chat.id}/import/",
+            [{"content": "برتقال", "timestamp": "2024-01-01T10:00:00Z"}],
+            format="json",
+        )
+        self.assertEqual(len(self.search("برتقال")), 1)
+
+    def test_query_syntax_is_not_interpreted(self):
+        self.say('قال "أهلاً" AND مشى')
+        self.assertEqual(len(self.search('"أهلاً AND (')), 1)
+        self.assertEqual(self.client.get("/api/messages/search/", {"q": "  "}).status_code, 400)
+
+    def test_archived_messages_are_still_found(self):
+        message = self.say("جوافة")
+        self.say("جوافة تانية", chat=Chat.objects.create(user=self.user))
+        archive.archive_chat(self.chat)
+        archive.clear_cache()
+        self.addCleanup(archive.clear_cache)
+
+        [result] = self.search("جوافة", chat=self.chat.id)
+        self.assertEqual((result["id"], result["content"]), (message.id, "جوافة"))
+        self.assertEqual(len(self.search("جوافة")), 2)
+        call_command("rebuild_search_index", stdout=io.StringIO())
+        self.assertEqual(len(self.search("جوافة")), 2)
+
+        self.client.delete(f"/api/chats/{self.chat.id}/")
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT rowid FROM {search.TABLE}")
+            self.assertNotIn((message.id,), cursor.fetchall())
+
+    def test_rebuild_command(self):
+        self.say("مانجا")
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {search.TABLE}")
+        self.assertEqual(self.search("مانجا"), [])
+        out = io.StringIO()
+        call_command("rebuild_search_index", stdout=out)
+        self.assertIn("Indexed 1 messages", out.getvalue())
+        self.assertEqual(len(self.search("مانجا")), 1)
+
+
+@override_settings(METRICS_TOKEN="s3cret")
+class MetricsTests(APITestCase):
+    def setUp(self):
+        metrics.reset()
+        cache.clear()
+        self.backend = use_fake_llm(self, reply="تمام")
+        self.user = User.objects.create_user(username="karim", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+
+    def send(self):
+        return self.client.post(
+            "/api/messages/", {"chat": self.chat.id, "chat_id": self.chat.id, "content": "سلام"}, format="json"
+        )
+
+    def scrape(self, **headers):
+        response = self.client.get("/metrics", headers={"Authorization": "Bearer s3cret", **headers})
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_requests_llm_calls_and_cache_lookups_are_exported(self):
+        self.send()
+        self.send()
+        body = self.scrape()
+
+        self.assertIn('http_request_duration_seconds_count{method="POST",route="message-list",status="201"} 2', body)
+        self.assertIn('llm_request_duration_seconds_count{backend="fake",outcome="ok"} 2', body)
+        self.assertIn('app_cache_lookups_total{cache="replies",result="miss"} 2', body)
+        self.assertIn('app_cache_lookups_total{cache="personas",result="hit"} 1', body)
+        self.assertIn('http_request_duration_seconds_bucket{method="POST",route="message-list",status="201",le="+Inf"} 2', body)
+
+        [series] = [series for labels, series in metrics.REQUEST_QUERIES.series.items() if labels[0] == "POST"]
+        self.assertGreater(series[-2], 0)  # sum of the query counts
+
+    @override_settings(SLOW_REQUEST_SECONDS=0)
+    def test_slow_requests_are_logged_with_their_queries(self):
+        with self.assertLogs("app.metrics", "WARNING") as logs:
+            self.send()
+        [line] = logs.output
+        self.assertIn("Slow request POST /api/messages/ 201", line)
+        self.assertIn("1 LLM calls", line)
+        self.assertIn('INSERT INTO "app_message"', line)
+
+    def test_llm_errors_are_logged(self):
+        use_fake_llm(self, delay=0.2, timeout=0.05)
+        with self.assertLogs("app.views", "ERROR") as logs:
+            self.assertEqual(self.send().status_code, 201)
+        self.assertIn("Error generating AI response", logs.output[0])
+        self.assertIn("Traceback", logs.output[0])
+
+    def test_token_protects_the_endpoint(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer nope"}).status_code, 401)
+        self.scrape()
+
+    @override_settings(METRICS_TOKEN="")
+    def test_endpoint_is_off_without_a_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+        self.assertEqual(self.client.get("/metrics", headers={"Authorization": "Bearer "}).status_code, 404)
+
+    def test_middleware_overhead_is_small(self):
+        request = APIRequestFactory().get("/")
+        response = HttpResponse()
+        bare = lambda request: response  # noqa: E731
+        wrapped = MetricsMiddleware(bare)
+        runs = 5000
+
+        def per_call(handler):
+            start = time.perf_counter()
+            for _ in range(runs):
+                handler(request)
+            return (time.perf_counter() - start) / runs
+
+        overhead = per_call(wrapped) - per_call(bare)
+        self.assertLess(overhead, 0.0002)  # measured at about 10µs
+
+
+class AsyncMetricsTests(TestCase):
+    async def test_async_views_are_measured(self):
+        metrics.reset()
+        use_fake_llm(self)
+        user = await User.objects.acreate(username="laila")
+        chat = await Chat.objects.acreate(user=user)
+        token = await Token.objects.acreate(user=user)
+        response = await self.async_client.post(
+            "/api/async/messages/", {"chat_id": chat.id, "content": "سلام"},
+            content_type="application/json", headers={"Authorization": f"Token {token.key}"},
+        )
+        self.assertEqual(response.status_code, 201)
+        [(labels, series)] = metrics.REQUEST_QUERIES.series.items()
+        self.assertEqual(labels, ("POST", "message-create-async"))
+        self.assertGreaterEqual(series[-2], 4)
+
+
+class SeedAndBenchmarkTests(APITransactionTestCase):
+    def test_seed_data(self):
+        call_command("seed_data", users=10, chats_per_user=2, messages=301, batch_size=100, stdout=io.StringIO())
+
+        self.assertEqual(User.objects.filter(username__startswith="seed-").count(), 10)
+        self.assertEqual(Profile.objects.filter(is_parent=True).count(), 2)
+        self.assertEqual(Profile.sons.through.objects.count(), 8)
+        self.assertEqual(Chat.objects.count(), 20)
+        self.assertEqual(Message.objects.count(), 301)
+        self.assertEqual(Message.objects.filter(ai=True, user=None).count(), 150)
+        # Seeded messages are searchable like any other.
+        message = Message.objects.filter(ai=False).first()
+        self.assertTrue(search.search(message.user, message.content.split()[0]))
+
+        with self.assertRaises(CommandError):
+            call_command("seed_data", users=1, stdout=io.StringIO())
+
+    def test_benchmark_writes_comparable_results(self):
+        call_command("seed_data", users=5, messages=100, stdout=io.StringIO())
+        with tempfile.TemporaryDirectory() as tmp:
+            first, second = os.path.join(tmp, "first.json"), os.path.join(tmp, "second.json")
+            call_command("benchmark", requests=5, output=first, stdout=io.StringIO())
+            out = io.StringIO()
+            call_command("benchmark", requests=5, output=second, compare=first, stdout=out)
+
+            with open(second) as file:
+                report = json.load(file)
+        self.assertEqual(set(report["scenarios"]), {"message-create", "message-list", "chat-list", "profile"})
+        for result in report["scenarios"].values():
+            self.assertEqual(result["errors"], 0)
+            self.assertLessEqual(result["p50_ms"], result["p95_ms"])
+            self.assertLessEqual(result["p95_ms"], result["p99_ms"])
+            self.assertGreater(result["queries_p50"], 0)
+        self.assertIn("message-list", out.getvalue().split("Change since")[1])
+
+    def test_startup_benchmark(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "startup.json")
+            call_command("benchmark_startup", targets=["setup"], runs=1, output=output, stdout=io.StringIO())
+            with open(output) as file:
+                report = json.load(file)
+        result = report["targets"]["setup"]
+        self.assertGreater(result["modules"], 100)
+        self.assertGreaterEqual(result["wall_ms"], result["import_ms"])
+        self.assertTrue(result["slowest"])
+
+
+class DatabaseConfigTests(APITransactionTestCase):
+    def test_sqlite_connections_are_tuned(self):
+        with connection.cursor() as cursor:
+            pragmas = {}
+            for pragma in ("journal_mode", "synchronous", "busy_timeout", "mmap_size"):
+                cursor.execute(f"PRAGMA {pragma}")
+                pragmas[pragma] = cursor.fetchone()[0]
+        self.assertEqual(pragmas["journal_mode"], "wal")
+        self.assertEqual(pragmas["synchronous"], 1)  # NORMAL
+        self.assertEqual(pragmas["busy_timeout"], 20000)
+        self.assertGreater(pragmas["mmap_size"], 0)
+
+    def test_concurrent_writers_wait_instead_of_failing(self):
+        user = User.objects.create_user(username="writer")
+        errors = []
+
+        def write(n):
+            try:
+                for i in range(20):
+                    with transaction.atomic():
+                        chat = Chat.objects.create(user=user, chat_name=f"{n}-{i}")
+                        Message.objects.create(chat=chat, user=user, content="سلام")
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Chat.objects.count(), 160)
+
+
+class ReplicaRoutingTests(APITestCase):
+    """Runs with a second SQLite file as the replica, holding different rows than the primary."""
+    databases = "__all__"  # includes the replica added in setUpClass
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        connections.settings["replica"] = {
+            **connections.settings["default"], "NAME": os.path.join(cls.tmp, "replica.sqlite3"),
+        }
+        call_command("migrate", database="replica", verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections["replica"].close()
+        del connections["replica"]
+        del connections.settings["replica"]
+        shutil.rmtree(cls.tmp)
+
+    def setUp(self):
+        override = override_settings(DATABASE_REPLICAS=["replica"])
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.user = User.objects.create_user(username="rana")
+        self.client.force_authenticate(self.user)
+        self.primary_chat = Chat.objects.create(user=self.user, chat_name="primary")
+        # The same chat on the replica, told apart by its name and a message only the replica has.
+        User.objects.using("replica").create(id=self.user.id, username="rana")
+        Chat.objects.using("replica").create(id=self.primary_chat.id, user_id=self.user.id, chat_name="replica")
+        Message.objects.using("replica").create(chat_id=self.primary_chat.id, user_id=self.user.id, content="من النسخة")
+
+    def test_list_endpoints_read_from_the_replica(self):
+        chats = self.client.get("/api/chats/").data["results"]
+        self.assertEqual([chat["chat_name"] for chat in chats], ["replica"])
+        messages = self.client.get("/api/messages/").data["results"]
+        self.assertEqual([message["content"] for message in messages], ["من النسخة"])
+
+        response = self.client.get(f"/api/chats/{self.primary_chat.id}/export/")
+        self.assertIn("من النسخة", b"".join(response.streaming_content).decode())
+
+    def test_writes_and_detail_reads_use_the_primary(self):
+        self.assertEqual(self.client.get(f"/api/chats/{self.primary_chat.id}/").data["chat_name"], "primary")
+
+        response = self.client.post("/api/chats/", {"chat_name": "جديدة"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Chat.objects.using("default").filter(chat_name="جديدة").exists())
+        self.assertFalse(Chat.objects.using("replica").filter(chat_name="جديدة").exists())
+
+
+@override_settings(
+    LLM_USER_RATE=60, LLM_USER_BURST=3, LLM_USER_CONCURRENCY=1,
+    LLM_CONCURRENCY=2, LLM_QUEUE_SIZE=2, LLM_QUEUE_TIMEOUT=0.3,
+)
+class RateLimitTests(APITransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="nour", password="pass12345")
+        self.other = User.objects.create_user(username="adam", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+        use_fake_llm(self, reply="تمام")
+        metrics.reset()
+
+    def post(self, path="/api/messages/"):
+        return self.client.post(path, {"chat": self.chat.id, "chat_id": self.chat.id, "content": "سلام"}, format="json")
+
+    def test_bucket_refuses_bursts_with_retry_after(self):
+        self.assertEqual([self.post().status_code for _ in range(3)], [201, 201, 201])
+        response = self.post()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+        # The refused message was not saved, and other users keep their own bucket.
+        self.assertEqual(Message.objects.filter(chat=self.chat).count(), 6)
+        ratelimit.acquire(self.other.id).release()
+        self.assertIn('llm_rejections_total{reason="user_rate"} 1', metrics.render())
+
+        time.sleep(1.05)  # one token per second at 60/minute
+        self.assertEqual(self.post().status_code, 201)
+
+    def test_in_flight_cap_per_user(self):
+        lease = ratelimit.acquire(self.user.id)
+        response = self.post()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(Message.objects.count(), 0)
+        # Queued replies are generated by the worker and only count against the rate.
+        self.assertEqual(self.post("/api/messages/?queue=1").status_code, 202)
+        lease.release()
+        self.assertEqual(self.post().status_code, 201)
+
+    def test_stream_holds_its_slot_until_the_end(self):
+        response = self.post("/api/messages/stream/")
+        self.assertEqual(self.post().status_code, 429)
+        b"".join(response.streaming_content)
+        self.assertEqual(self.post().status_code, 201)
+
+    @override_settings(LLM_USER_RATE=0, LLM_USER_CONCURRENCY=0)
+    def test_global_ceiling_queues_then_refuses(self):
+        running = [ratelimit.acquire(self.other.id), ratelimit.acquire(self.other.id)]
+        start = time.perf_counter()
+        with self.assertRaises(Throttled):
+            ratelimit.acquire(self.user.id)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.3)
+
+        # A waiting request gets the slot as soon as one is freed.
+        threading.Timer(0.1, running.pop().release).start()
+        ratelimit.acquire(self.user.id).release()
+        running.pop().release()
+        self.assertIn('llm_rejections_total{reason="queue_timeout"} 1', metrics.render())
+
+    @override_settings(LLM_USER_RATE=0, LLM_USER_CONCURRENCY=0, LLM_QUEUE_SIZE=0)
+    def test_full_queue_refuses_at_once(self):
+        running = [ratelimit.acquire(self.other.id), ratelimit.acquire(self.other.id)]
+        start = time.perf_counter()
+        response = self.post()
+        self.assertEqual(response.status_code, 429)
+        self.assertLess(time.perf_counter() - start, 0.2)
+        for lease in running:
+            lease.release()
+
+    def test_queue_is_fair_between_users(self):
+        queue = {
+            "a1": (1, 1.0, 9), "a2": (1, 2.0, 9), "a3": (1, 3.0, 9),
+            "b1": (2, 4.0, 9), "c1": (3, 5.0, 9), "b2": (2, 6.0, 9),
+        }
+        self.assertEqual(ratelimit.fair_order(queue), ["a1", "b1", "c1", "a2", "b2", "a3"])
+
+    @override_settings(LLM_USER_RATE=0, LLM_USER_CONCURRENCY=0, LLM_QUEUE_SIZE=10, LLM_QUEUE_TIMEOUT=5)
+    def test_concurrency_ceiling_holds_across_threads(self):
+        for backend in ("locmem.LocMemCache", "filebased.FileBasedCache"):
+            with self.subTest(backend), tempfile.TemporaryDirectory() as tmp, override_settings(CACHES={
+                **settings.CACHES, "llm_limits": {"BACKEND": f"django.core.cache.backends.{backend}", "LOCATION": tmp},
+            }):
+                active, peak, lock = [0], [0], threading.Lock()
+
+                def generate(user_id):
+                    with ratelimit.acquire(user_id):
+                        with lock:
+                            active[0] += 1
+                            peak[0] = max(peak[0], active[0])
+                        time.sleep(0.05)
+                        with lock:
+                            active[0] -= 1
+
+                threads = [threading.Thread(target=generate, args=(n,)) for n in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual(peak[0], 2)
+
+    async def test_async_endpoint_is_limited(self):
+        token = await Token.objects.acreate(user=self.user)
+        lease = await ratelimit.aacquire(self.user.id)
+        response = await self.async_client.post(
+            "/api/async/messages/", {"chat_id": self.chat.id, "content": "سلام"},
+            content_type="application/json", headers={"Authorization": f"Token {token.key}"},
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "1")
+        await lease.arelease()
+        self.assertEqual(await Message.objects.acount(), 0)
+
+
+class IdempotencyTests(APITransactionTestCase):
+    # Concurrent duplicates run in threads, which need committed data.
+    def setUp(self):
+        self.user = User.objects.create_user(username="malak", password="pass12345")
+        self.chat = Chat.objects.create(user=self.user)
+        self.client.force_authenticate(self.user)
+        self.backend = use_fake_llm(self, reply="تمام")
+
+    def post(self, key, content="سلام", client=None, path="/api/messages/"):
+        return (client or self.client).post(
+            path, {"chat": self.chat.id, "chat_id": self.chat.id, "content": content},
+            format="json", HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def test_retry_replays_the_first_response(self):
+        first = self.post("key-1")
+        retry = self.post("key-1")
+        self.assertEqual((first.status_code, retry.status_code), (201, 201))
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(len(self.backend.prompts), 1)
+
+        # A new key is a new request.
+        self.assertEqual(self.post("key-2").status_code, 201)
+        self.assertEqual(Message.objects.count(), 4)
+
+    def test_key_reused_for_a_different_request(self):
+        self.post("key-1")
+        response = self.post("key-1", content="حاجة تانية")
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_concurrent_duplicate_waits_for_the_original(self):
+        self.backend.delay = 0.3
+        responses = []
+
+        def send():
+            client = type(self.client)()
+            client.force_authenticate(self.user)
+            responses.append(self.post("key-1", client=client))
+
+        threads = [threading.Thread(target=send) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([response.status_code for response in responses], [201, 201, 201])
+        self.assertEqual(len({response.json()["ai_message"]["id"] for response in responses}), 1)
+        self.assertEqual(sum(response.has_header("Idempotent-Replayed") for response in responses), 2)
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(len(self.backend.prompts), 1)
+
+    @override_settings(LLM_USER_CONCURRENCY=1)
+    def test_refused_requests_are_not_stored(self):
+        lease = ratelimit.acquire(self.user.id)
+        self.assertEqual(self.post("key-1").status_code, 429)
+        lease.release()
+        response = self.post("key-1")
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(response.has_header("Idempotent-Replayed"))
+
+    def test_keys_expire_and_are_per_user(self):
+        self.post("key-1")
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(days=2))
+        self.assertFalse(self.post("key-1").has_header("Idempotent-Replayed"))
+        self.assertEqual(Message.objects.count(), 4)
+
+        other = User.objects.create_user(username="yara", password="pass12345")
+        self.chat = Chat.objects.create(user=other)
+        self.client.force_authenticate(other)
+        self.assertFalse(self.post("key-1").has_header("Idempotent-Replayed"))
+
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(days=2))
+        out = io.StringIO()
+        call_command("purge_idempotency_keys", stdout=out)
+        self.assertIn("Deleted 2", out.getvalue())
+
+    async def test_async_endpoint_replays(self):
+        token = await Token.objects.acreate(user=self.user)
+        headers = {"Authorization": f"Token {token.key}", "Idempotency-Key": "key-1"}
+
+        async def post():
+            return await self.async_client.post(
+                "/api/async/messages/", {"chat_id": self.chat.id, "content": "سلام"},
+                content_type="application/json", headers=headers,
+            )
+
+        first, retry = await post(), await post()
+        self.assertEqual((first.status_code, retry.status_code), (201, 201))
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(await Message.objects.acount(), 2)
+
+
+# LLM_USER_RATE=0: the long-story test plays more turns than a user may per minute.
+@override_settings(STORY_BEATS=8, LLM_USER_RATE=0)
+class StoryTests(APITestCase):
+    FOLD_REPLY = '{"summary": "ليلى لقت خريطة كنز", "characters": {"ليلى": "بنت شجاعة"}}'
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="lila", password="pass12345")
+        self.client.force_authenticate(self.user)
+        self.backend = use_fake_llm(self, reply=self.FOLD_REPLY)
+        self.story = Story.objects.create(user=self.user, title="الكنز المفقود")
+
+    def turn(self, content, story=None):
+        return self.client.post(
+            "/api/story_messages/", {"story_id": (story or self.story).id, "content": content}, format="json"
+        )
+
+    def test_story_crud_is_per_user(self):
+        response = self.client.post("/api/stories/", {"title": "رحلة للقمر"}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["user"]["id"], self.user.id)
+        self.assertIsNone(response.data["state"])
+
+        other = User.objects.create_user(username="omar2")
+        foreign = Story.objects.create(user=other, title="مش بتاعتك")
+        titles = [story["title"] for story in self.client.get("/api/stories/").data["results"]]
+        self.assertEqual(sorted(titles), sorted(["الكنز المفقود", "رحلة للقمر"]))
+        self.assertEqual(self.turn("أهلاً", story=foreign).status_code, 400)
+
+    def test_turn_returns_the_continuation_and_updates_the_state(self):
+        response = self.turn("ليلى فتحت الباب القديم")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["user_message"]["content"], "ليلى فتحت الباب القديم")
+        self.assertTrue(response.data["ai_message"]["ai"])
+        self.assertIn("الكنز المفقود", self.backend.prompts[-1])
+
+        state = StoryState.objects.get(story=self.story)
+        self.assertEqual(state.turns, 1)
+        self.assertEqual([ai for _, ai, _ in state.beats], [False, True])
+
+        listed = self.client.get(f"/api/story_messages/?story={self.story.id}").data["results"]
+        self.assertEqual(len(listed), 2)
+        message_id = listed[0]["id"]
+        self.assertEqual(self.client.delete(f"/api/story_messages/{message_id}/").status_code, 405)
+
+    def test_prompt_stays_bounded_as_the_story_grows(self):
+        continuations, folds = [], []
+
+        def on_finished(sender, prompt, **kwargs):
+            (folds if prompt.lstrip().startswith("لخص") else continuations).append(len(prompt))
+
+        llm_request_finished.connect(on_finished)
+        self.addCleanup(llm_request_finished.disconnect, on_finished)
+        for turn in range(120):
+            self.assertEqual(self.turn(f"الجزء رقم {turn}: ليلى مشيت ناحية الجبل").status_code, 201)
+            if turn == 10:
+                with CaptureQueriesContext(connection) as early:
+                    self.turn("سؤال")
+        with CaptureQueriesContext(connection) as late:
+            self.turn("سؤال")
+
+        # Prompt size depends on STORY_BEATS, not on the 240 messages written so far.
+        self.assertLess(max(continuations[20:]), max(continuations[:20]) * 1.2)
+        # One fold per few turns, each covering only the beats added since the last one.
+        self.assertLess(len(folds), 120 / 2)
+        self.assertLess(max(folds), min(folds) * 2)
+        self.assertLessEqual(len(late), len(early) + 1)
+
+        self.story.state.refresh_from_db()
+        state = self.story.state
+        self.assertEqual(state.turns, 122)
+        self.assertEqual(state.plot_summary, "ليلى لقت خريطة كنز")
+        self.assertEqual(state.characters, {"ليلى": "بنت شجاعة"})
+        self.assertLessEqual(len(state.beats), 8)
+        self.assertEqual(self.client.get(f"/api/stories/{self.story.id}/").data["state"]["characters"], state.characters)
+
+    def test_older_story_is_summarized_on_its_first_turn(self):
+        StoryMessage.objects.bulk_create(
+            StoryMessage(story=self.story, user=None if i % 2 else self.user, ai=bool(i % 2), content=f"حدث {i}")
+            for i in range(30)
+        )
+        self.turn("وبعدين؟")
+        state = StoryState.objects.get(story=self.story)
+        self.assertEqual(state.turns, 16)
+        self.assertGreater(state.summarized_up_to, 0)
+        self.assertLessEqual(len(state.beats), 8)
+
+    def test_long_older_story_is_summarized_a_few_batches_per_turn(self):
+        StoryMessage.objects.bulk_create(
+            StoryMessage(story=self.story, user=None if i % 2 else self.user, ai=bool(i % 2), content=f"حدث {i}")
+            for i in range(100)
+        )
+        ids = list(StoryMessage.objects.filter(story=self.story).order_by("id").values_list("id", flat=True))
+        last_older = ids[-settings.STORY_BEATS // 2 - 1]
+        self.turn("وبعدين؟")
+        folds = [prompt for prompt in self.backend.prompts if prompt.lstrip().startswith("لخص")]
+        self.assertEqual(len(folds), settings.LLM_SUMMARY_MAX_BATCHES)
+        state = StoryState.objects.get(story=self.story)
+        self.assertEqual(state.summarized_up_to, ids[settings.STORY_BEATS * settings.LLM_SUMMARY_MAX_BATCHES - 1])
+
+        for turn in range(15):
+            self.assertEqual(self.turn(f"الجزء رقم {turn}").status_code, 201)
+        state.refresh_from_db()
+        # Caught up, in order: the backlog is gone and the beats are folded as usual again.
+        self.assertEqual(state.backlog_up_to, 0)
+        self.assertLess(state.summarized_up_to, state.beats[0][0])
+        self.assertGreater(state.summarized_up_to, last_older)
+        self.assertLessEqual(len(state.beats), settings.STORY_BEATS)
+
+    def test_failed_continuations_are_logged(self):
+        use_fake_llm(self, delay=0.2, timeout=0.05)
+        with self.assertLogs("app.views", "ERROR") as logs:
+            self.assertEqual(self.turn("وبعدين؟").status_code, 201)
+        self.assertIn("Traceback", logs.output[0])
+
+    def test_fold_reply_that_is_not_json(self):
+        self.assertEqual(stories.parse_fold("مجرد ملخص"), ("مجرد ملخص", {}))
+        self.assertEqual(
+            stories.parse_fold('```json\n{"summary": "ملخص", "characters": ["x"]}\n```'), ("ملخص", {})
+        )
+
+
+class ActivityDashboardTests(APITestCase):
+    def setUp(self):
+        self.parent = User.objects.create_user(username="mama", password="pass12345")
+        Profile.objects.create(user=self.parent, is_parent=True)
+        self.son = User.objects.create_user(username="ziad", password="pass12345")
+        self.parent.profile.sons.add(self.son)
+        self.chat = Chat.objects.create(user=self.son)
+        use_fake_llm(self, reply="رد")
+        override = override_settings(LLM_USER_RATE=0)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def stats(self):
+        totals = list(ActivityStats.objects.order_by("user").values_list("user", "messages", "ai_replies", "last_active_at"))
+        days = list(DailyActivity.objects.order_by("user", "date").values_list("user", "date", "messages", "ai_replies"))
+        return totals, days
+
+    def test_stats_follow_creates_deletes_and_imports(self):
+        self.client.force_authenticate(self.son)
+        for content in ("أهلاً", "عامل ايه", "باي"):
+            response = self.client.post(
+                "/api/messages/", {"chat": self.chat.id, "chat_id": self.chat.id, "content": content}, format="json"
+            )
+            self.assertEqual(response.status_code, 201)
+        self.client.delete(f"/api/messages/{response.data['ai_message']['id']}/")
+        old = (timezone.now() - timedelta(days=3)).isoformat()
+        records = [{"ai": False, "content": "قديمة", "timestamp": old}, {"ai": True, "content": "رد قديم", "timestamp": old}]
+        self.client.post(f"/api/chats/{self.chat.id}/import/", records, format="json")
+
+        stats = self.son.activity
+        stats.refresh_from_db()
+        self.assertEqual((stats.messages, stats.ai_replies), (4, 3))
+        self.assertEqual(stats.last_active_at, Message.objects.filter(ai=False).latest("timestamp").timestamp)
+        incremental = self.stats()
+        activity.rebuild(Message.objects.all())
+        self.assertEqual(self.stats(), incremental)
+
+    def test_deleting_a_chat_updates_stats_and_index_in_bulk(self):
+        kept = Message.objects.create(chat=Chat.objects.create(user=self.son), user=self.son, content="رسالة باقية")
+        now = timezone.now()
+        for i in range(200):
+            Message.objects.create(
+                chat=self.chat, user=None if i % 2 else self.son, ai=bool(i % 2), content=f"رسالة رقم {i}",
+                timestamp=now - timedelta(days=i % 3),
+            )
+
+        with CaptureQueriesContext(connection) as queries:
+            self.chat.delete()
+
+        self.assertLess(len(queries), 20)
+        stats = ActivityStats.objects.get(user=self.son)
+        self.assertEqual((stats.messages, stats.ai_replies), (1, 0))
+        days = DailyActivity.objects.exclude(messages=0, ai_replies=0).values_list("date", "messages", "ai_replies")
+        self.assertEqual(list(days), [(timezone.localdate(), 1, 0)])
+        if search.available():
+            self.assertEqual([pk for pk, _ in search.search(self.son, "رسالة")], [kept.pk])
+            with connection.cursor() as cursor:
+                cursor.execute(f"SELECT count(*) FROM {search.TABLE}")
+                self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_dashboard_shows_each_son_with_a_zero_filled_series(self):
+        Message.objects.create(chat=self.chat, user=self.son, content="أهلاً")
+        Message.objects.create(chat=self.chat, ai=True, content="أهلاً بيك")
+        idle = User.objects.create_user(username="nour")
+        self.parent.profile.sons.add(idle)
+        self.client.force_authenticate(self.parent)
+
+        response = self.client.get("/api/profiles/dashboard/?days=7")
+        self.assertEqual(response.status_code, 200)
+        son, other = response.data["children"]
+        self.assertEqual((son["username"], son["messages"], son["ai_replies"]), ("ziad", 1, 1))
+        self.assertEqual(len(son["daily"]), 7)
+        self.assertEqual(son["daily"][-1], {"date": timezone.localdate(), "messages": 1, "ai_replies": 1})
+        self.assertEqual(sum(day["messages"] for day in son["daily"]), 1)
+        self.assertEqual((other["messages"], other["last_active_at"]), (0, None))
+        self.assertEqual(self.client.get("/api/profiles/dashboard/?days=91").status_code, 400)
+
+    def test_dashboard_is_for_parents_only(self):
+        self.client.force_authenticate(self.son)
+        self.assertEqual(self.client.get("/api/profiles/dashboard/").status_code, 403)
+
+    def test_rebuild_command(self):
+        Message.objects.bulk_create([Message(chat=self.chat, user=self.son, content="بدون إشارات")])
+        self.assertFalse(ActivityStats.objects.exists())
+        out = io.StringIO()
+        call_command("rebuild_activity_stats", stdout=out)
+        self.assertIn("1 users", out.getvalue())
+        self.assertEqual(ActivityStats.objects.get(user=self.son).messages, 1)
+
+
+class ChatListTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="hana", password="pass12345")
+        self.client.force_authenticate(self.user)
+        self.old_chat = Chat.objects.create(user=self.user, chat_name="قديمة")
+        self.new_chat = Chat.objects.create(user=self.user, chat_name="جديدة")
+        use_fake_llm(self, reply="رد المساعد")
+
+    def send(self, chat, content):
+        response = self.client.post("/api/messages/", {"chat": chat.id, "chat_id": chat.id, "content": content}, format="json")
+        self.assertEqual(response.status_code, 201)
+        return response.data
+
+    def chats(self):
+        return self.client.get("/api/chats/").data["results"]
+
+    def test_list_is_ordered_by_activity_with_preview_and_count(self):
+        self.assertEqual([chat["id"] for chat in self.chats()], [self.new_chat.id, self.old_chat.id])
+        sent = self.send(self.old_chat, "صباح الخير")
+
+        first, second = self.chats()
+        self.assertEqual(first["id"], self.old_chat.id)
+        self.assertEqual((first["message_count"], first["last_message_preview"]), (2, "رد المساعد"))
+        self.assertEqual(first["last_activity_at"], sent["ai_message"]["timestamp"])
+        self.assertEqual((second["message_count"], second["last_message_preview"]), (0, ""))
+
+        response = self.client.patch(f"/api/chats/{self.old_chat.id}/", {"message_count": 99}, format="json")
+        self.assertEqual(response.data["message_count"], 2)
+
+    def test_imports_and_deletes_keep_the_fields_right(self):
+        sent = self.send(self.new_chat, "سؤال")
+        old = (timezone.now() - timedelta(days=30)).isoformat()
+        records = [{"ai": False, "content": "رسالة قديمة", "timestamp": old}]
+        self.assertEqual(self.client.post(f"/api/chats/{self.new_chat.id}/import/", records, format="json").status_code, 201)
+        self.new_chat.refresh_from_db()
+        self.assertEqual((self.new_chat.message_count, self.new_chat.last_message_preview), (3, "رد المساعد"))
+
+        self.client.delete(f"/api/messages/{sent['ai_message']['id']}/")
+        self.new_chat.refresh_from_db()
+        self.assertEqual((self.new_chat.message_count, self.new_chat.last_message_preview), (2, "سؤال"))
+
+        incremental = list(Chat.objects.order_by("id").values_list("message_count", "last_message_preview", "last_activity_at"))
+        activity.rebuild_chats(Chat.objects.all())
+        self.assertEqual(list(Chat.objects.order_by("id").values_list("message_count", "last_message_preview", "last_activity_at")), incremental)
+
+    def test_long_messages_are_shortened_in_the_preview(self):
+        Message.objects.create(chat=self.old_chat, user=self.user, content="ك" * 500)
+        self.old_chat.refresh_from_db()
+        self.assertEqual(self.old_chat.last_message_preview, "ك" * activity.PREVIEW_CHARS)
+
+
+class SyncTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="salma", password="pass12345")
+        self.client.force_authenticate(self.user)
+        self.chat = Chat.objects.create(user=self.user, chat_name="أول محادثة")
+        self.message = Message.objects.create(chat=self.chat, user=self.user, content="أهلاً")
+
+    def sync(self, since=None, **params):
+        if since is not None:
+            params["since"] = since
+        response = self.client.get("/api/sync/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_changes_since_a_token_with_tombstones(self):
+        token = self.sync()["token"]
+        self.assertEqual(self.sync(token)["chats"], [])
+
+        other = Chat.objects.create(user=self.user, chat_name="تانية")
+        added = Message.objects.create(chat=other, user=self.user, content="جديدة")
+        self.client.patch(f"/api/chats/{self.chat.id}/", {"chat_name": "اسم جديد"}, format="json")
+        self.client.delete(f"/api/messages/{self.message.id}/")
+        Chat.objects.create(user=User.objects.create_user(username="غريب"))
+
+        data = self.sync(token)
+        self.assertEqual(sorted(chat["id"] for chat in data["chats"]), [self.chat.id, other.id])
+        self.assertEqual([message["id"] for message in data["messages"]], [added.id])
+        self.assertEqual(data["deleted"], {"chats": [], "messages": [self.message.id]})
+        self.assertFalse(data["has_more"])
+        after = self.sync(data["token"])
+        self.assertEqual((after["token"], after["chats"], after["messages"]), (data["token"], [], []))
+
+    def test_deleted_chat_is_one_tombstone_and_pages_are_limited(self):
+        token = self.sync()["token"]
+        for i in range(3):
+            Message.objects.create(chat=self.chat, content=f"رسالة {i}")
+        self.client.delete(f"/api/chats/{self.chat.id}/")
+        self.assertEqual(SyncChange.objects.filter(id__gt=token, deleted=True).count(), 1)
+
+        data = self.sync(token, limit=1)
+        self.assertTrue(data["has_more"])
+        data = self.sync(data["token"])
+        self.assertEqual(data["deleted"], {"chats": [self.chat.id], "messages": []})
+        self.assertEqual(data["chats"], [])
+
+    def test_deleting_a_user_logs_nothing(self):
+        self.user.delete()
+        self.assertFalse(SyncChange.objects.exists())
+
+    def test_purged_tokens_are_gone(self):
+        token = self.sync()["token"]
+        Message.objects.create(chat=self.chat, user=self.user, content="تاني")
+        SyncChange.objects.update(created_at=timezone.now() - timedelta(days=60))
+        Message.objects.create(chat=self.chat, user=self.user, content="تالت")
+        self.assertEqual(sync.purge(), 3)
+        self.assertEqual(self.client.get("/api/sync/", {"since": token}).status_code, 410)
+        self.assertEqual(self.client.get("/api/sync/", {"since": "abc"}).status_code, 400)
+
+    def test_fresh_sync_after_everything_of_the_user_was_purged(self):
+        other = User.objects.create_user(username="غريب")
+        Chat.objects.create(user=other, chat_name="تانية")
+        SyncChange.objects.update(created_at=timezone.now() - timedelta(days=60))
+        sync.purge()
+        self.assertFalse(SyncChange.objects.filter(user=self.user).exists())
+
+        token = self.sync()["token"]
+        self.assertNotEqual(token, 0)
+        self.assertEqual(self.sync(token)["token"], token)
+        added = Message.objects.create(chat=self.chat, user=self.user, content="رجعت")
+        self.assertEqual([message["id"] for message in self.sync(token)["messages"]], [added.id])
+
+    def test_lists_and_details_answer_304_until_something_changes(self):
+        for url in ("/api/chats/", f"/api/chats/{self.chat.id}/", f"/api/messages/?chat={self.chat.id}"):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertIn("Last-Modified", response)
+                with self.assertNumQueries(1):
+                    cached = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+                self.assertEqual(cached.status_code, 304)
+                self.assertEqual(cached["ETag"], response["ETag"])
+
+        etag = self.client.get("/api/chats/")["ETag"]
+        Message.objects.create(chat=self.chat, user=self.user, content="جديدة")
+        self.assertEqual(self.client.get("/api/chats/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_profiles_get_etags_from_their_body(self):
+        Profile.objects.create(user=self.user)
+        response = self.client.get("/api/profiles/")
+        self.assertEqual(self.client.get("/api/profiles/", HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+
+
+@override_settings(ARCHIVE_SEGMENT_SIZE=3, ARCHIVE_CACHE_SEGMENTS=2)
+class ArchiveTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="adel", password="pass12345")
+        self.client.force_authenticate(self.user)
+        self.chat = Chat.objects.create(user=self.user)
+        start = timezone.now() - timedelta(days=400)
+        for i in range(7):
+            Message.objects.create(
+                chat=self.chat, user=None if i % 2 else self.user, ai=bool(i % 2),
+                content=f"رسالة قديمة {i}", timestamp=start + timedelta(minutes=i),
+            )
+        Chat.objects.filter(pk=self.chat.pk).update(last_activity_at=start)
+        archive.clear_cache()
+        self.addCleanup(archive.clear_cache)
+
+    def archive(self):
+        call_command("archive_messages", stdout=io.StringIO())
+        self.chat.refresh_from_db()
+
+    def pages(self):
+        contents, url = [], f"/api/messages/?chat={self.chat.id}&page_size=2"
+        while url:
+            data = self.client.get(url).data
+            contents.append([message["content"] for message in data["results"]])
+            url = data["next"]
+        return contents, data["previous"]
+
+    def export(self):
+        return self.client.get(f"/api/chats/{self.chat.id}/export/").getvalue()
+
+    def test_archived_chat_reads_like_before(self):
+        message = Message.objects.filter(chat=self.chat).order_by("id")[2]
+        before = self.pages(), self.client.get(f"/api/messages/{message.id}/").data, self.export()
+        self.archive()
+
+        self.assertFalse(Message.objects.filter(chat=self.chat).exists())
+        self.assertEqual(ArchivedSegment.objects.filter(chat=self.chat).count(), 3)
+        self.assertEqual(self.chat.message_count, 7)
+        after = self.pages(), self.client.get(f"/api/messages/{message.id}/").data, self.export()
+        self.assertEqual(after[0][0], before[0][0])
+        self.assertEqual(after[1:], before[1:])
+        contents, previous = after[0]
+        self.assertEqual([len(page) for page in contents], [2, 2, 2, 1])
+        self.assertEqual(
+            [m["content"] for m in self.client.get(previous).data["results"]], contents[-2]
+        )
+        self.assertEqual(self.client.delete(f"/api/messages/{message.id}/").status_code, 404)
+
+    def test_decoded_segments_are_cached(self):
+        self.archive()
+        url = f"/api/messages/?chat={self.chat.id}&page_size=50"
+        with override_settings(ARCHIVE_CACHE_SEGMENTS=10):
+            archive.clear_cache()
+            with CaptureQueriesContext(connection) as cold:
+                self.client.get(url)
+            with CaptureQueriesContext(connection) as warm:
+                self.client.get(url)
+        self.assertEqual(len(cold) - len(warm), 3)  # one query per segment, none once decoded
+
+        archive.clear_cache()
+        self.client.get(url)
+        self.assertEqual(len(archive._segments), 2)
+
+    def test_pages_decode_only_the_segments_they_reach(self):
+        self.archive()
+        segments = list(ArchivedSegment.objects.filter(chat=self.chat).order_by("first_id").values_list("pk", flat=True))
+        Message.objects.create(chat=self.chat, user=self.user, content="مستوردة", timestamp=timezone.now() - timedelta(days=1))
+        url = f"/api/messages/?chat={self.chat.id}"
+        with override_settings(ARCHIVE_CACHE_SEGMENTS=10):
+            archive.clear_cache()
+            data = self.client.get(url + "&page_size=1").data
+            self.assertEqual([m["content"] for m in data["results"]], ["مستوردة"])
+            self.assertEqual(list(archive._segments), [segments[2]])
+
+            data = self.client.get(url + "&page_size=2").data
+            while data["next"]:
+                archive.clear_cache()
+                data = self.client.get(data["next"]).data
+            self.assertEqual([m["content"] for m in data["results"]], ["رسالة قديمة 1", "رسالة قديمة 0"])
+            self.assertEqual(list(archive._segments), segments[:1])
+            self.assertEqual(self.client.get(url + "&cursor=" + "x" * 8).status_code, 404)
+
+    def test_unfiltered_list_includes_archived_messages_and_changes_its_etag(self):
+        other = Chat.objects.create(user=self.user)
+        start = timezone.now() - timedelta(days=400, seconds=90)
+        for i in range(3):
+            Message.objects.create(chat=other, user=self.user, content=f"محادثة تانية {i}", timestamp=start + timedelta(minutes=2 * i))
+
+        def listing():
+            contents, url = [], "/api/messages/?page_size=3"
+            while url:
+                data = self.client.get(url).data
+                contents += [message["content"] for message in data["results"]]
+                url = data["next"]
+            return contents
+
+        before = listing()
+        etags = [self.client.get(url)["ETag"] for url in ("/api/messages/", "/api/chats/")]
+        archive.archive_chat(self.chat)
+        self.assertFalse(Message.objects.filter(chat=self.chat).exists())
+        self.assertEqual(len(before), 10)
+        self.assertEqual(listing(), before)
+        for url, etag in zip(("/api/messages/", "/api/chats/"), etags):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_new_message_restores_the_chat(self):
+        ids = list(Message.objects.filter(chat=self.chat).values_list("id", flat=True))
+        self.archive()
+        backend = use_fake_llm(self)
+        response = self.client.post(
+            "/api/messages/", {"chat": self.chat.id, "chat_id": self.chat.id, "content": "رجعت"}, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertIn("رسالة قديمة 6", backend.prompts[-1])
+        self.assertEqual(list(Message.objects.filter(chat=self.chat, id__in=ids).values_list("id", flat=True)), ids)
+        self.assertFalse(ArchivedSegment.objects.exists())
+        self.chat.refresh_from_db()
+        self.assertEqual((self.chat.archived_up_to, self.chat.message_count), (0, 9))
+
+    def test_stats_count_archived_messages(self):
+        self.archive()
+        stats = list(ActivityStats.objects.values_list("user", "messages", "ai_replies", "last_active_at"))
+        activity.rebuild(Message.objects.all())
+        self.assertEqual(list(ActivityStats.objects.values_list("user", "messages", "ai_replies", "last_active_at")), stats)
+
+        self.client.delete(f"/api/chats/{self.chat.id}/")
+        self.assertEqual(ActivityStats.objects.get(user=self.user).messages, 0)
@@ -1,13 +1,23 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ProfileViewSet, ChatViewSet, MessageViewSet, TeStatusViewSet
+from .views import (
+    ProfileViewSet, ChatViewSet, MessageViewSet, ReplyJobViewSet, StoryMessageViewSet, StoryViewSet, TeStatusViewSet,
+    create_message_async, reply_job_detail, sync_changes,
+)
 
 router = DefaultRouter()
 router.register(r'profiles', ProfileViewSet)
 router.register(r'chats', ChatViewSet)
 router.register(r'messages', MessageViewSet)
 router.register(r'te_statuses', TeStatusViewSet)
+router.register(r'jobs', ReplyJobViewSet)
+router.register(r'stories', StoryViewSet)
+router.register(r'story_messages', StoryMessageViewSet)
 
 urlpatterns = [
+    path('async/messages/', create_message_async, name='message-create-async'),
+    path('sync/', sync_changes, name='sync'),
+    # Ahead of the router, whose detail route it wraps with the async long-poll.
+    path('jobs/<int:pk>/', reply_job_detail, name='replyjob-detail'),
     path('', include(router.urls)),
-]
\ No newline at end of file
+]
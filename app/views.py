@@ -2,22 +2,48 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from django.contrib.auth.models import User
-import os
 from rest_framework.authtoken.models import Token
 from rest_framework.decorators import action
-# --------------------------------------------------------------------------------
-# NEW IMPORTS FOR THE GEMINI AI API
-# --------------------------------------------------------------------------------
-import google.generativeai as genai
-from .models import Profile, Chat, Message, Te_status
+from rest_framework.exceptions import APIException, ValidationError
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+import asyncio
+import itertools
+import json
+import logging
+import time
+import weakref
+from . import activity, archive, exports, idempotency, metrics, ratelimit, reply_cache, search, stories, sync
+from .context import build_context, format_turns
+from .llm import get_backend
+from .images import prompt_images
+from .imports import iter_records
+from .jobs import enqueue_reply
+from .models import Profile, Chat, Message, ReplyJob, Story, StoryMessage, Te_status
+from .pagination import ChatCursorPagination, MessageCursorPagination, StoryCursorPagination
+from .personas import aget_persona, get_persona
+from .renderers import CSVRenderer, NDJSONRenderer, ServerSentEventRenderer
+from .routers import reading_from_replica, replica_alias
 from .serializers import (
     ProfileSerializer,
     ChatSerializer,
+    ImportedMessageSerializer,
     MessageSerializer,
+    ReplyJobSerializer,
+    StoryMessageSerializer,
+    StorySerializer,
     TeStatusSerializer,
     UserSerializer,
 )
 
+logger = logging.getLogger(__name__)
+
 # --------------------------------------------------------------------------------
 # IMPROVED REGISTER VIEW
 # --------------------------------------------------------------------------------
@@ -80,39 +106,131 @@ def register(request):
 
 
 # --------------------------------------------------------------------------------
-# CONFIGURE GEMINI AI (from environment variable for security)
+# REFACTORED VIEWS WITH BETTER LOGIC AND SECURITY
 # --------------------------------------------------------------------------------
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    gemini_model = genai.GenerativeModel('gemini-2.5-flash')
-    print("✅ Gemini AI configured successfully!")
-else:
-    print("❌ GEMINI_API_KEY not found. Please set the environment variable.")
-    gemini_model = None
+class ReplicaListMixin:
+    """Serves `list` from a read replica when one is configured (see app/routers.py)."""
+
+    def list(self, request, *args, **kwargs):
+        with reading_from_replica():
+            return super().list(request, *args, **kwargs)
+
+
+class ConditionalGetMixin:
+    """
+    Sends ETag and Last-Modified with `list` and `retrieve`, and answers 304 Not
+    Modified when nothing in the user's chats changed since the client's copy.
+    The check reads the user's latest sync change (app/sync.py), not the rows.
+    """
+
+    def list(self, request, *args, **kwargs):
+        etag, last_modified = sync.validators(request)
+        response = sync.not_modified(request, etag, last_modified) or super().list(request, *args, **kwargs)
+        return sync.add_validators(response, etag, last_modified)
+
+    def retrieve(self, request, *args, **kwargs):
+        etag, last_modified = sync.validators(request)
+        response = sync.not_modified(request, etag, last_modified) or super().retrieve(request, *args, **kwargs)
+        return sync.add_validators(response, etag, last_modified)
 
 
 # --------------------------------------------------------------------------------
-# REFACTORED VIEWS WITH BETTER LOGIC AND SECURITY
+# STREAMING RESPONSES
 # --------------------------------------------------------------------------------
-class MessageViewSet(viewsets.ModelViewSet):
+def served_over_asgi(request):
+    """
+    True when `request` came in through project.asgi (the Procfile). Django buffers
+    the whole body of a streaming response whose iterator does not match the server,
+    sync under ASGI or async under WSGI, so streaming views pick the matching kind.
+    """
+    return isinstance(getattr(request, "_request", request), ASGIRequest)
+
+
+async def aiterate(iterator):
+    """
+    Iterates the sync `iterator` from the event loop, one item per hop to the
+    request's worker thread, so each item is sent as soon as it is produced.
+    Closing the result (or cancelling it) closes `iterator` too.
+    """
+    done = object()
+    next_item = sync_to_async(next)
+    try:
+        while (item := await next_item(iterator, done)) is not done:
+            yield item
+    finally:
+        if hasattr(iterator, "close"):
+            await sync_to_async(iterator.close)()
+
+
+class EventStreamResponse(StreamingHttpResponse):
+    """
+    Server-Sent Events holding a generation lease (app/ratelimit.py). The lease is
+    freed when the server closes the response, or when the response is dropped
+    without being sent, so it never depends on the events being iterated.
+    """
+
+    def __init__(self, events, lease):
+        super().__init__(events, content_type="text/event-stream")
+        self.release_lease = weakref.finalize(self, lease.release)
+        self["Cache-Control"] = "no-cache"
+        self["X-Accel-Buffering"] = "no"  # Stop nginx from buffering the stream
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.release_lease()
+
+
+class MessageViewSet(ReplicaListMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     """
     A viewset for managing chat messages and handling AI responses.
     """
-    queryset = Message.objects.all().order_by("timestamp")
+    # select_related: the serializer nests each message's user.
+    queryset = Message.objects.select_related("user").order_by("timestamp")
     serializer_class = MessageSerializer
+    pagination_class = MessageCursorPagination
 
     def get_queryset(self):
         """
         Filters messages to only show those for the current user's chats.
+        `?chat=<id>` narrows the list to one chat.
         Handles unauthenticated users gracefully.
         """
         if self.request.user.is_authenticated:
-            return self.queryset.filter(
-                chat__user=self.request.user
-            ).order_by("timestamp")
+            queryset = self.queryset.filter(chat__user=self.request.user)
+            chat_id = self.request.query_params.get("chat")
+            if chat_id is not None:
+                if not chat_id.isdigit():
+                    raise ValidationError({"chat": "Must be a chat id."})
+                queryset = queryset.filter(chat_id=chat_id)
+            return queryset.order_by("timestamp")
         return Message.objects.none()
 
+    def paginate_queryset(self, queryset):
+        """Messages of archived chats are paged from their decoded segments (see app/archive.py)."""
+        if not self.request.user.is_authenticated:
+            return super().paginate_queryset(queryset)
+        archived = Chat.objects.filter(user=self.request.user, archived_up_to__gt=0)
+        chat_id = self.request.query_params.get("chat")
+        if chat_id is not None:
+            archived = archived.filter(pk=chat_id)
+        chat_ids = list(archived.values_list("pk", flat=True))
+        if chat_ids:
+            queryset = archive.ArchivedMessages(chat_ids, queryset, using=queryset.db)
+        return super().paginate_queryset(queryset)
+
+    def get_object(self):
+        """Archived messages can be read by id, but not changed or deleted."""
+        try:
+            return super().get_object()
+        except Http404:
+            message = None
+            if self.action == "retrieve" and str(self.kwargs["pk"]).isdigit():
+                message = archive.find_message(self.request.user, int(self.kwargs["pk"]))
+            if message is None:
+                raise
+            return message
 
     def create(self, request, *args, **kwargs):
         """
@@ -121,25 +239,37 @@ class MessageViewSet(viewsets.ModelViewSet):
         """
         if not self.request.user.is_authenticated:
             return Response({"error": "Authentication required to create a message."}, status=status.HTTP_401_UNAUTHORIZED)
-        
-        # Create a mutable copy of the request data
-        request_data = request.data.copy()
-        request_data['user'] = request.user.id
-
-        serializer = self.get_serializer(data=request_data)
-        serializer.is_valid(raise_exception=True)
+        # Retries carrying the same Idempotency-Key header get the first response back
+        # instead of a second message and LLM call (see app/idempotency.py).
+        return idempotency.run(request, lambda: self.create_messages(request))
 
+    def create_messages(self, request):
+        """Saves the user's message and the AI reply (or queues the reply); see `create`."""
         user_instance = self.request.user
-        chat_instance = serializer.validated_data['chat']
-        content = serializer.validated_data['content']
+        # With ?queue=1 the reply is generated by `manage.py run_reply_worker`;
+        # the client polls GET /api/jobs/<id>/?wait=<seconds> for it.
+        queued = bool(request.query_params.get("queue"))
 
-        # 1) Save the user's message
-        user_msg = serializer.save(user=user_instance, chat=chat_instance, content=content, ai=False)
+        # Limits how fast and how much at once a user can generate (429 when over);
+        # queued replies only count against the rate, the worker bounds concurrency.
+        with ratelimit.acquire(user_instance.id, concurrent=not queued):
+            # 1) Save the user's message
+            user_msg = self.save_user_message(request)
+            chat_instance = user_msg.chat
+            content = user_msg.content
 
-        # 2) Generate AI reply using the Gemini API
-        persona = self.get_or_create_persona(user_instance, content)
-        full_prompt = self.create_ai_prompt(persona, content)
-        ai_text = self.get_ai_response(full_prompt)
+            if queued:
+                job = enqueue_reply(user_msg)
+                return Response({
+                    "user_message": MessageSerializer(user_msg, context={'request': request}).data,
+                    "job": ReplyJobSerializer(job, context={'request': request}).data,
+                }, status=status.HTTP_202_ACCEPTED)
+
+            # 2) Generate AI reply using the configured LLM backend
+            persona = self.get_or_create_persona(user_instance, content)
+            context = build_context(chat_instance, before_id=user_msg.id)
+            full_prompt = self.create_ai_prompt(persona, content, context)
+            ai_text = self.get_ai_response(full_prompt, persona, chat_instance, prompt_images(user_msg))
 
         # 3) Save the AI's response to the database
         ai_msg = Message.objects.create(chat=chat_instance, user=None, ai=True, content=ai_text)
@@ -150,38 +280,197 @@ class MessageViewSet(viewsets.ModelViewSet):
             "ai_message": MessageSerializer(ai_msg, context={'request': request}).data,
         }, status=status.HTTP_201_CREATED)
 
-    def get_ai_response(self, full_prompt):
-        """Generates AI response using the configured Gemini model."""
-        if not gemini_model:
-            return "Gemini AI is not configured. Check server logs."
-        
+    @action(detail=False)
+    def search(self, request, *args, **kwargs):
+        """
+        Full-text search over the user's messages: `?q=<words>`, optionally `&chat=<id>`,
+        paged with `&limit=` (default 20, max 100) and `&offset=`. Best matches come first;
+        each result carries a `snippet` with the matched words in <mark> tags.
+        """
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            raise ValidationError({"q": "This parameter is required."})
+        chat_id = request.query_params.get("chat")
+        if chat_id is not None and not chat_id.isdigit():
+            raise ValidationError({"chat": "Must be a chat id."})
         try:
-            response = gemini_model.generate_content(full_prompt)
-            # The generated content is in the 'text' attribute of the response
-            return response.text.strip()
+            limit = min(int(request.query_params.get("limit", 20)), 100)
+            offset = int(request.query_params.get("offset", 0))
+        except ValueError:
+            raise ValidationError({"limit": "limit and offset must be numbers."})
+
+        if search.available():
+            hits = search.search(request.user, query, chat_id, max(limit, 1), max(offset, 0))
+        else:
+            # No FTS5: a plain scan, newest first.
+            matches = self.get_queryset().filter(content__icontains=query).order_by("-timestamp")
+            hits = [(pk, None) for pk in matches.values_list("pk", flat=True)[offset:offset + limit]]
+        messages = self.queryset.in_bulk([pk for pk, _ in hits])
+        results = []
+        for pk, marked in hits:
+            # Hits missing from the Message table are archived (see app/archive.py).
+            message = messages.get(pk) or archive.find_message(request.user, pk)
+            if message is None:
+                continue
+            data = MessageSerializer(message, context={'request': request}).data
+            data["snippet"] = search.snippet(message.content, marked) if marked else None
+            results.append(data)
+        return Response({"results": results})
+
+    def save_user_message(self, request):
+        """Validates the request data and saves the user's message."""
+        # Create a mutable copy of the request data
+        request_data = request.data.copy()
+        request_data['user'] = request.user.id
+
+        serializer = self.get_serializer(data=request_data)
+        serializer.is_valid(raise_exception=True)
+
+        chat_instance = serializer.validated_data['chat']
+        content = serializer.validated_data['content']
+        return serializer.save(user=request.user, chat=chat_instance, content=content, ai=False)
+
+    @action(
+        detail=False,
+        methods=["post"],
+        renderer_classes=[*viewsets.ModelViewSet.renderer_classes, ServerSentEventRenderer],
+    )
+    def stream(self, request, *args, **kwargs):
+        """
+        Same as `create`, but sends the AI reply as Server-Sent Events while it is generated.
+        Events: `user_message`, then one `chunk` per piece of text, then `ai_message`.
+        The reply is saved when the stream ends, or partially if the client disconnects.
+        """
+        if not self.request.user.is_authenticated:
+            return Response({"error": "Authentication required to create a message."}, status=status.HTTP_401_UNAUTHORIZED)
+
+        # Held until the stream ends; see `create`.
+        lease = ratelimit.acquire(request.user.id)
+        try:
+            user_msg = self.save_user_message(request)
+            persona = self.get_or_create_persona(request.user, user_msg.content)
+            context = build_context(user_msg.chat, before_id=user_msg.id)
+            full_prompt = self.create_ai_prompt(persona, user_msg.content, context)
+            # Under ASGI the events must be an async iterator, or Django sends them all at the end.
+            stream_events = self.astream_events if served_over_asgi(request) else self.stream_events
+            events = stream_events(request, user_msg, user_msg.chat, full_prompt, persona, prompt_images(user_msg), lease)
+        except BaseException:
+            lease.release()
+            raise
+        return EventStreamResponse(events, lease)
+
+    def stream_events(self, request, user_msg, chat_instance, full_prompt, persona=None, images=(), lease=None):
+        """Yields the SSE events for `stream` and saves the AI message at the end."""
+        parts = []
+        finished = False
+        try:
+            yield self.message_event(request, "user_message", user_msg)
+            for text in self.stream_ai_response(full_prompt, persona, chat_instance, images):
+                parts.append(text)
+                yield self.sse_event("chunk", {"text": text})
+            finished = True
+        finally:
+            # Runs on normal completion and when the client goes away (GeneratorExit),
+            # so whatever was generated so far is never lost.
+            ai_msg = self.finish_stream(chat_instance, parts, finished, lease)
+
+        yield self.message_event(request, "ai_message", ai_msg)
+
+    async def astream_events(self, request, user_msg, chat_instance, full_prompt, persona=None, images=(), lease=None):
+        """
+        `stream_events` for ASGI. The backend's stream is read in the request's worker
+        thread a piece at a time; when the client goes away the server cancels this
+        generator, which closes the backend's stream before the partial reply is saved.
+        """
+        parts = []
+        finished = False
+        chunks = aiterate(self.stream_ai_response(full_prompt, persona, chat_instance, images))
+        try:
+            yield await sync_to_async(self.message_event)(request, "user_message", user_msg)
+            async for text in chunks:
+                parts.append(text)
+                yield self.sse_event("chunk", {"text": text})
+            finished = True
+        finally:
+            await chunks.aclose()
+            ai_msg = await sync_to_async(self.finish_stream)(chat_instance, parts, finished, lease)
+
+        yield await sync_to_async(self.message_event)(request, "ai_message", ai_msg)
+
+    def finish_stream(self, chat_instance, parts, finished, lease=None):
+        """Frees the lease and saves the streamed reply, or what was generated of it; see `stream`."""
+        if lease is not None:
+            lease.release()
+        ai_text = "".join(parts).strip()
+        if finished or ai_text:
+            return Message.objects.create(chat=chat_instance, user=None, ai=True, content=ai_text)
+        return None
+
+    def message_event(self, request, event, message):
+        return self.sse_event(event, MessageSerializer(message, context={'request': request}).data)
+
+    def sse_event(self, event, data):
+        """Formats one Server-Sent Event."""
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    def stream_ai_response(self, full_prompt, persona=None, chat=None, images=()):
+        """
+        Yields the AI reply piece by piece using the backend's streaming generation.
+        A cached reply is sent as a single piece; see `get_ai_response`.
+        """
+        use_cache = chat is not None and chat.cache_replies
+        if use_cache:
+            cached = reply_cache.lookup(persona, full_prompt, images)
+            if cached is not None:
+                yield cached
+                return
+
+        try:
+            parts = []
+            for text in get_backend().stream(full_prompt, images):
+                parts.append(text)
+                yield text
+            if use_cache:
+                reply_cache.store(persona, full_prompt, "".join(parts).strip(), images)
         except Exception as e:
-            print(f"Error generating AI response: {e}")
+            logger.exception("Error streaming AI response")
+            yield f"خطأ في توليد الرد من الذكاء الاصطناعي: {e}"
+
+    def get_ai_response(self, full_prompt, persona=None, chat=None, images=()):
+        """
+        Generates AI response using the configured LLM backend (see settings.LLM_BACKEND).
+        `images` are the pictures attached to the message (see app/images.py).
+        Replies are served from the reply cache unless `chat` opted out with `cache_replies`.
+        """
+        try:
+            if chat is not None and chat.cache_replies:
+                return reply_cache.get_or_generate(persona, full_prompt, get_backend().generate, images)
+            return get_backend().generate(full_prompt, images)
+        except Exception as e:
+            logger.exception("Error generating AI response")
             return f"خطأ في توليد الرد من الذكاء الاصطناعي: {e}"
 
     def get_or_create_persona(self, user, content):
-        """Retrieves user's persona or returns a default."""
-        try:
-            te_status = Te_status.objects.get(user=user)
-            if te_status.persona_prompt:
-                return te_status.persona_prompt
-        except Te_status.DoesNotExist:
-            pass
-        return "شخصية ودودة ومرحة"
-
-    def create_ai_prompt(self, persona, user_message):
+        """Retrieves user's persona or returns a default (cached, see app/personas.py)."""
+        return get_persona(user.id)
+
+    def create_ai_prompt(self, persona, user_message, context=None):
         """
-        Creates the full prompt for Gemini.
+        Creates the full prompt for the LLM.
+        `context` is the chat's ChatContext (summary and recent turns), if any.
         """
+        history = ""
+        if context is not None:
+            if context.summary:
+                history += f"ملخص المحادثة لحد دلوقتي: {context.summary}\n"
+            if context.turns:
+                history += f"آخر رسائل في المحادثة:\n{format_turns(context.turns)}\n"
         return f"""
         انت مساعد افتراضي مصري. 🇪🇬 مهمتك هي مساعدة المستخدمين من خلال الرد عليهم بأسلوب ودود ومساعد.
         استخدم اللغة المصرية العامية فقط.
         تأكد أن ردك يكون بناءً على شخصية المستخدم: {persona}
         اجعل ردك طبيعياً ومختصراً قدر الإمكان.
+        {history}
         {user_message}
         """
 
@@ -189,7 +478,7 @@ class ProfileViewSet(viewsets.ModelViewSet):
     """
     A viewset for managing user profiles.
     """
-    queryset = Profile.objects.all()
+    queryset = Profile.objects.select_related("user").prefetch_related("sons")
     serializer_class = ProfileSerializer
 
     def get_queryset(self):
@@ -215,12 +504,32 @@ class ProfileViewSet(viewsets.ModelViewSet):
         else:
             return Response({"error": "Authentication required to update a profile."}, status=status.HTTP_401_UNAUTHORIZED)
 
-class ChatViewSet(viewsets.ModelViewSet):
+    @action(detail=False)
+    def dashboard(self, request, *args, **kwargs):
+        """
+        Activity of the parent's sons: messages sent, AI replies, last active time and
+        a daily series for the last `?days=` days (default 14, max 90). Read from the
+        stats kept by app/activity.py, in three queries however much the sons chat.
+        """
+        try:
+            days = int(request.query_params.get("days", activity.DEFAULT_DAYS))
+        except ValueError:
+            raise ValidationError({"days": "Must be a number."})
+        if not 1 <= days <= activity.MAX_DAYS:
+            raise ValidationError({"days": f"Must be between 1 and {activity.MAX_DAYS}."})
+        profile = Profile.objects.filter(user=request.user, is_parent=True).first()
+        if profile is None:
+            return Response({"error": "Only parents have a dashboard."}, status=status.HTTP_403_FORBIDDEN)
+        children = list(profile.sons.select_related("activity").order_by("id"))
+        return Response({"days": days, "children": activity.dashboard(children, days)})
+
+class ChatViewSet(ReplicaListMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     """
     A viewset for managing chat sessions.
     """
-    queryset = Chat.objects.all()
+    queryset = Chat.objects.select_related("user")
     serializer_class = ChatSerializer
+    pagination_class = ChatCursorPagination
 
     def get_queryset(self):
         """
@@ -238,11 +547,162 @@ class ChatViewSet(viewsets.ModelViewSet):
         else:
             return Response({"error": "Authentication required to create a chat."}, status=status.HTTP_401_UNAUTHORIZED)
 
+    @action(detail=True, renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request, *args, **kwargs):
+        """
+        Streams every message of the chat as `?format=ndjson` (default) or `?format=csv`.
+        Memory use stays flat however long the chat is; the body is gzipped on
+        the fly when the client sends `Accept-Encoding: gzip`.
+        """
+        chat = self.get_object()
+        return self.export_response(request, [chat.pk], f"chat-{chat.pk}")
+
+    @action(detail=False, url_path="export", renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export_all(self, request, *args, **kwargs):
+        """Same as `export`, for all chats of the current user."""
+        return self.export_response(request, list(self.get_queryset().values_list("pk", flat=True)), "chats")
+
+    def export_response(self, request, chats, filename):
+        export_format = request.accepted_renderer.format
+        compress = "gzip" in request.headers.get("Accept-Encoding", "")
+        # The rows are read while the response streams, after the view has returned,
+        # so the replica is picked here rather than by `reading_from_replica`.
+        pieces = exports.FORMATS[export_format](exports.export_rows(chats, using=replica_alias()))
+        body = exports.encode(pieces, compress)
+        if served_over_asgi(request):
+            # Each piece is built in the request's worker thread from one fetched chunk
+            # of rows, so the export is never collected in memory; see `aiterate`.
+            body = aiterate(body)
+        response = StreamingHttpResponse(
+            body,
+            content_type=f"{request.accepted_renderer.media_type}; charset=utf-8",
+        )
+        response["Content-Disposition"] = f'attachment; filename="{filename}.{export_format}"'
+        response["Vary"] = "Accept-Encoding"
+        if compress:
+            response["Content-Encoding"] = "gzip"
+        return response
+
+    @action(detail=True, methods=["post"], url_path="import")
+    def import_messages(self, request, pk=None):
+        """
+        Imports past messages into the chat without generating AI replies.
+        The body is a JSON array or NDJSON stream of `{ai, content, timestamp}` records.
+        Records are validated and inserted in batches of `?batch_size=` (default 1000)
+        inside one transaction, so a bad record rolls back the whole import.
+        """
+        chat = self.get_object()
+        try:
+            batch_size = min(int(request.query_params.get("batch_size", 1000)), 5000)
+        except ValueError:
+            raise ValidationError({"batch_size": "Must be a number."})
+        if batch_size < 1:
+            raise ValidationError({"batch_size": "Must be at least 1."})
+
+        records = iter_records(request.stream, request.content_type or "")
+        batches, total = [], 0
+        started = time.perf_counter()
+        with transaction.atomic():
+            while True:
+                batch = list(itertools.islice(records, batch_size))
+                if not batch:
+                    break
+                batch_started = time.perf_counter()
+                serializer = ImportedMessageSerializer(data=batch, many=True)
+                if not serializer.is_valid():
+                    # Report the offending records by their position in the whole import.
+                    errors = {total + index: error for index, error in enumerate(serializer.errors) if error}
+                    raise ValidationError({"records": errors})
+                imported = Message.objects.bulk_create(
+                    [
+                        Message(
+                            chat=chat,
+                            user=None if record["ai"] else chat.user,
+                            ai=record["ai"],
+                            content=record["content"],
+                            timestamp=record["timestamp"],
+                        )
+                        for record in serializer.validated_data
+                    ],
+                    batch_size=batch_size,
+                )
+                # bulk_create sends no post_save, so the search index, the stats and the sync log are updated here.
+                search.index_messages(imported)
+                activity.record_messages(imported)
+                sync.record_messages(imported)
+                seconds = time.perf_counter() - batch_started
+                total += len(batch)
+                batches.append({
+                    "rows": len(batch),
+                    "seconds": round(seconds, 4),
+                    "rows_per_second": round(len(batch) / seconds) if seconds else None,
+                })
+
+        seconds = time.perf_counter() - started
+        return Response({
+            "imported": total,
+            "seconds": round(seconds, 4),
+            "rows_per_second": round(total / seconds) if seconds else None,
+            "batches": batches,
+        }, status=status.HTTP_201_CREATED)
+
+class ReplyJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Status of queued AI replies (POST /api/messages/?queue=1).
+    `GET /api/jobs/<id>/?wait=<seconds>` long-polls until the reply is ready.
+    """
+    queryset = ReplyJob.objects.select_related("ai_message__user")
+    serializer_class = ReplyJobSerializer
+
+    def get_queryset(self):
+        """Restricts queryset to jobs for the current user's chats."""
+        if self.request.user.is_authenticated:
+            return self.queryset.filter(message__chat__user=self.request.user).order_by("-id")
+        return ReplyJob.objects.none()
+
+    def retrieve(self, request, *args, **kwargs):
+        """Returns the job; `reply_job_detail` repeats this while `?wait=` lasts."""
+        job = self.get_object()
+        wait_seconds(request)
+        return Response(self.get_serializer(job).data)
+
+
+def wait_seconds(request):
+    """The `?wait=` of a job request, at most REPLY_JOB_MAX_WAIT."""
+    try:
+        return min(float(request.GET.get("wait", 0)), settings.REPLY_JOB_MAX_WAIT)
+    except ValueError:
+        raise ValidationError({"wait": "Must be a number of seconds."})
+
+
+retrieve_reply_job = ReplyJobViewSet.as_view({"get": "retrieve"})
+
+
+async def reply_job_detail(request, pk):
+    """
+    GET /api/jobs/<id>/: `ReplyJobViewSet.retrieve`, asked again with backoff until the
+    job finishes or `?wait=` seconds pass. The waits are awaited and each check runs
+    on the shared thread pool, so under ASGI (the Procfile) a long-polling client
+    holds no thread between its checks.
+    """
+    retrieve = sync_to_async(retrieve_reply_job, thread_sensitive=False)
+    response = await retrieve(request, pk=pk)
+    if request.method != "GET" or response.status_code != status.HTTP_200_OK:
+        return response
+    deadline = time.monotonic() + wait_seconds(request)
+    interval = 0.05
+    while response.data["status"] not in (ReplyJob.DONE, ReplyJob.FAILED) and time.monotonic() < deadline:
+        await asyncio.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+        interval = min(interval * 2, 1.0)
+        response = await retrieve(request, pk=pk)
+    return response
+
+
 class TeStatusViewSet(viewsets.ModelViewSet):
     """
     A viewset for managing the user's Te_status, which includes the AI persona.
     """
-    queryset = Te_status.objects.all()
+    queryset = Te_status.objects.select_related("user")
     serializer_class = TeStatusSerializer
 
     def get_queryset(self):
@@ -266,4 +726,210 @@ class TeStatusViewSet(viewsets.ModelViewSet):
         if self.request.user.is_authenticated:
             serializer.save(user=self.request.user)
         else:
-            return Response({"error": "Authentication required to update a status."}, status=status.HTTP_401_UNAUTHORIZED)
\ No newline at end of file
+            return Response({"error": "Authentication required to update a status."}, status=status.HTTP_401_UNAUTHORIZED)
+
+
+# --------------------------------------------------------------------------------
+# STORIES
+# --------------------------------------------------------------------------------
+class StoryViewSet(ReplicaListMixin, viewsets.ModelViewSet):
+    """
+    A viewset for managing interactive stories. Each story carries its `state`:
+    the characters and plot summary the AI keeps while the story grows.
+    """
+    queryset = Story.objects.select_related("user", "state")
+    serializer_class = StorySerializer
+    pagination_class = StoryCursorPagination
+
+    def get_queryset(self):
+        """Restricts queryset to the current user's stories."""
+        if self.request.user.is_authenticated:
+            return self.queryset.filter(user=self.request.user)
+        return Story.objects.none()
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+
+
+class StoryMessageViewSet(ReplicaListMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    The turns of the user's stories, newest first; `?story=<id>` narrows the list to one story.
+    POST adds the user's turn and returns it with the AI's continuation. Turns cannot be
+    edited or deleted, since the story's state already builds on them.
+    """
+    queryset = StoryMessage.objects.select_related("user")
+    serializer_class = StoryMessageSerializer
+    pagination_class = MessageCursorPagination
+
+    def get_queryset(self):
+        if self.request.user.is_authenticated:
+            queryset = self.queryset.filter(story__user=self.request.user)
+            story_id = self.request.query_params.get("story")
+            if story_id is not None:
+                if not story_id.isdigit():
+                    raise ValidationError({"story": "Must be a story id."})
+                queryset = queryset.filter(story_id=story_id)
+            return queryset
+        return StoryMessage.objects.none()
+
+    def create(self, request, *args, **kwargs):
+        # Same rules as chat messages: idempotency keys, then the generation limits.
+        return idempotency.run(request, lambda: self.create_turn(request))
+
+    def create_turn(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.fields["story_id"].queryset = Story.objects.filter(user=request.user)
+        serializer.is_valid(raise_exception=True)
+        story = serializer.validated_data["story"]
+
+        with ratelimit.acquire(request.user.id):
+            # The prompt is built from the story's state, not from all of its messages,
+            # so it stays the same size however long the story gets.
+            state = stories.get_state(story)
+            user_msg = serializer.save(user=request.user, ai=False)
+            prompt = stories.build_prompt(story, state, user_msg.content)
+            try:
+                ai_text, generated = get_backend().generate(prompt, prompt_images(user_msg)), True
+            except Exception as e:
+                logger.exception("Error generating story continuation")
+                ai_text, generated = f"خطأ في توليد الرد من الذكاء الاصطناعي: {e}", False
+
+            ai_msg = StoryMessage.objects.create(story=story, user=None, ai=True, content=ai_text)
+            if generated:
+                # Failed turns stay out of the state, so the story continues from the last good one.
+                stories.record_turn(state, [user_msg, ai_msg])
+
+        return Response({
+            "user_message": StoryMessageSerializer(user_msg, context={'request': request}).data,
+            "ai_message": StoryMessageSerializer(ai_msg, context={'request': request}).data,
+        }, status=status.HTTP_201_CREATED)
+
+
+# --------------------------------------------------------------------------------
+# DELTA SYNC
+# --------------------------------------------------------------------------------
+@api_view(["GET"])
+def sync_changes(request):
+    """
+    Chats and messages created, changed or deleted since `?since=<token>`, oldest
+    change first, at most `?limit=` (default 200, max 1000) per call. Deletions come
+    as ids under `deleted`. Send the returned `token` as `since` next time, at once
+    while `has_more` is true. Without `since` only the current token is returned:
+    take it, load the chats and messages, then sync from it.
+    """
+    since = sync.parse_token(request.query_params.get("since"))
+    try:
+        limit = int(request.query_params.get("limit", sync.DEFAULT_LIMIT))
+    except ValueError:
+        raise ValidationError({"limit": "Must be a number."})
+    limit = min(max(limit, 1), sync.MAX_LIMIT)
+    token, has_more, chats, messages, deleted_chats, deleted_messages = sync.changes(request.user, since, limit)
+    context = {"request": request}
+    return Response({
+        "token": str(token),
+        "has_more": has_more,
+        "chats": ChatSerializer(chats, many=True, context=context).data,
+        "messages": MessageSerializer(messages, many=True, context=context).data,
+        "deleted": {"chats": deleted_chats, "messages": deleted_messages},
+    })
+
+
+# --------------------------------------------------------------------------------
+# ASYNC MESSAGE CREATION (served natively under ASGI)
+# --------------------------------------------------------------------------------
+async def get_token_user(request):
+    """Async version of DRF's TokenAuthentication: returns the user or None."""
+    auth = request.headers.get("Authorization", "").split()
+    if len(auth) != 2 or auth[0].lower() != "token":
+        return None
+    try:
+        token = await Token.objects.select_related("user").aget(key=auth[1])
+    except Token.DoesNotExist:
+        return None
+    return token.user if token.user.is_active else None
+
+
+@csrf_exempt
+@require_POST
+async def create_message_async(request):
+    """
+    Async equivalent of `MessageViewSet.create`.
+    The ORM work uses the async query methods and the Gemini call is awaited,
+    so the event loop keeps serving other requests while a reply is generated.
+    """
+    user = await get_token_user(request)
+    if user is None:
+        return JsonResponse({"error": "Authentication required to create a message."}, status=status.HTTP_401_UNAUTHORIZED)
+
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"error": "Request body must be valid JSON."}, status=status.HTTP_400_BAD_REQUEST)
+    chat_id = data.get("chat_id") or data.get("chat")
+    content = data.get("content")
+    if not chat_id or not isinstance(content, str) or not content.strip():
+        return JsonResponse({"error": "chat_id and content are required."}, status=status.HTTP_400_BAD_REQUEST)
+
+    chat_instance = await Chat.objects.filter(pk=chat_id, user=user).afirst()
+    if chat_instance is None:
+        return JsonResponse({"error": "Chat not found."}, status=status.HTTP_404_NOT_FOUND)
+
+    # Retries with the same Idempotency-Key get the first response; see `MessageViewSet.create`.
+    try:
+        return await idempotency.arun(
+            request, user, data, lambda: create_messages_async(request, user, chat_instance, content)
+        )
+    except APIException as e:
+        response = JsonResponse({"error": e.detail}, status=e.status_code)
+        if getattr(e, "wait", None):
+            response["Retry-After"] = str(e.wait)
+        return response
+
+
+async def create_messages_async(request, user, chat_instance, content):
+    """Saves the user's message and the AI reply; see `create_message_async`."""
+    # Same limits as `MessageViewSet.create`; waiting for a slot does not block the event loop.
+    lease = await ratelimit.aacquire(user.id)
+    try:
+        # 1) Save the user's message
+        user_msg = await Message.objects.acreate(chat=chat_instance, user=user, ai=False, content=content)
+
+        # 2) Generate AI reply without blocking the event loop
+        persona = await aget_persona(user.id)
+        context = await sync_to_async(build_context)(chat_instance, before_id=user_msg.id)
+        full_prompt = MessageViewSet().create_ai_prompt(persona, content, context)
+        ai_text = await get_ai_response_async(full_prompt, persona, chat_instance)
+    finally:
+        await lease.arelease()
+
+    # 3) Save the AI's response to the database
+    ai_msg = await Message.objects.acreate(chat=chat_instance, user=None, ai=True, content=ai_text)
+
+    return JsonResponse({
+        "user_message": MessageSerializer(user_msg, context={'request': request}).data,
+        "ai_message": MessageSerializer(ai_msg, context={'request': request}).data,
+    }, status=status.HTTP_201_CREATED, json_dumps_params={"ensure_ascii": False})
+
+
+async def get_ai_response_async(full_prompt, persona=None, chat=None):
+    """Async version of `MessageViewSet.get_ai_response`."""
+    try:
+        if chat is not None and chat.cache_replies:
+            return await reply_cache.aget_or_generate(persona, full_prompt, get_backend().agenerate)
+        return await get_backend().agenerate(full_prompt)
+    except Exception as e:
+        logger.exception("Error generating AI response")
+        return f"خطأ في توليد الرد من الذكاء الاصطناعي: {e}"
+
+
+# --------------------------------------------------------------------------------
+# METRICS
+# --------------------------------------------------------------------------------
+def metrics_view(request):
+    """Prometheus scrape endpoint; see app/metrics.py. Off until METRICS_TOKEN is set."""
+    token = settings.METRICS_TOKEN
+    if not token:
+        return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+    if not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,11 @@
+# Read by gunicorn from the working directory (see Procfile).
+
+
+def post_worker_init(worker):
+    """Runs in each worker once the application is loaded, before it accepts requests."""
+    from django.conf import settings
+
+    if settings.LLM_WARM_UP:
+        from app.llm import warm_up
+
+        warm_up()